@@ -4,6 +4,8 @@ import threading
 
 HEADER = 1
 FORMAT = 'utf-8'
+BUFFER_SIZE = 1024  # Bytes read per recv_into, into one buffer reused for every read
+TERMINATE = b'terminate'
 SUBSCRIBERS = {}  # Dictionary to store subscriber connections
 PUBLISHERS = {}   # Dictionary to store publisher connections
 
@@ -39,21 +41,30 @@ def handle_client(conn, address):
             return
               
         connected = True
+        # Messages are read into this buffer and forwarded as raw bytes, so binary payloads
+        # pass through unchanged
+        buffer = bytearray(BUFFER_SIZE)
+        view = memoryview(buffer)
+        # The sender label is the same for every message on this connection, so encode it once
+        prefix = f"[FROM PUBLISHER {address}]: ".encode(FORMAT)
 
         while connected:
             try:
-                message = conn.recv(1024).decode(FORMAT)
-                if not message or message.lower() == 'terminate':
+                received = conn.recv_into(buffer)
+                message = view[:received]
+                if not received or (received == len(TERMINATE) and message.tobytes().lower() == TERMINATE):
                     connected = False
                     print(f"[DISCONNECT] {address} disconnected.")
                     break
 
                 # If this is a publisher, distribute the message to all subscribers
                 if address in PUBLISHERS and message:
-                    print(f"[MESSAGE FROM PUBLISHER {address}]: {message}")
-                    distribute_messages(message, address)
+                    # Subscribers get the raw bytes; only the log line and the ack show them as text
+                    text = str(message, FORMAT, errors='replace')
+                    print(f"[MESSAGE FROM PUBLISHER {address}]: {text}")
+                    distribute_messages(message, prefix)
                     # Send acknowledgment back to publisher
-                    conn.send(f"Message '{message}' sent to {len(SUBSCRIBERS)} subscribers".encode(FORMAT))
+                    conn.send(f"Message '{text}' sent to {len(SUBSCRIBERS)} subscribers".encode(FORMAT))
                 
                 # If this is a subscriber, they shouldn't be sending messages (except terminate)
                 elif address in SUBSCRIBERS and message:
@@ -76,17 +87,21 @@ def handle_client(conn, address):
         print_status()
         conn.close()
 
-def distribute_messages(message, publisher_address):
+def distribute_messages(message, prefix):
+    # message is a view of the publisher's receive buffer, sent before that buffer is reused
     if not SUBSCRIBERS:
         print("[INFO] No subscribers to send message to")
         return
     
     disconnected_subscribers = []
     
-    for subscriber_address, subscriber_conn in SUBSCRIBERS.items():
+    for subscriber_address, subscriber_conn in list(SUBSCRIBERS.items()):
         try:
-            formatted_message = f"[FROM PUBLISHER {publisher_address}]: {message}"
-            subscriber_conn.send(formatted_message.encode(FORMAT))
+            # Label and payload go out in one vectored write, without joining them first
+            sent = subscriber_conn.sendmsg((prefix, message))
+            if sent < len(prefix) + len(message):
+                # A nearly full socket buffer took only part of it; sendall the rest
+                subscriber_conn.sendall(b''.join((prefix, message))[sent:])
             print(f"[MESSAGE SENT] to subscriber {subscriber_address}")
         except Exception as e:
             print(f"[ERROR] Failed to send message to subscriber {subscriber_address}: {e}")
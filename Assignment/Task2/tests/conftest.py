@@ -0,0 +1,5 @@
+import os
+import sys
+
+# server.py and client.py are run as scripts from Task2/, so tests import them by bare name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import socket
+import subprocess
+import pytest
+import server
+
+SERVER = os.path.join(os.path.dirname(server.__file__), 'server.py')
+
+
+class TrickleSocket:
+    """Takes only the first few bytes of a sendmsg, like a nearly full socket buffer."""
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.received = b''
+
+    def sendmsg(self, buffers):
+        data = b''.join(buffers)[:self.chunk]
+        self.received += data
+        return len(data)
+
+    def sendall(self, data):
+        self.received += data
+
+
+@pytest.mark.parametrize('chunk', [0, 5, 1000])
+def test_partial_vectored_write_is_finished(monkeypatch, chunk):
+    subscriber = TrickleSocket(chunk)
+    monkeypatch.setattr(server, 'SUBSCRIBERS', {('sub', 1): subscriber})
+    payload = memoryview(bytearray(b'\x00binary\xff'))
+    server.distribute_messages(payload, b'[FROM PUBLISHER x]: ')
+    assert subscriber.received == b'[FROM PUBLISHER x]: \x00binary\xff'
+
+
+@pytest.fixture
+def address():
+    with socket.socket() as probe:
+        probe.bind(('', 0))
+        port = probe.getsockname()[1]
+    host = socket.gethostbyname(socket.gethostname())  # Where server.py binds
+    process = subprocess.Popen([sys.executable, SERVER, str(port)], stdout=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=0.2).close()
+            break
+        except OSError:
+            if time.time() > deadline:
+                process.kill()
+                raise
+            time.sleep(0.05)
+    yield host, port
+    process.kill()
+    process.wait()
+
+
+def connect(address, role):
+    conn = socket.create_connection(address, timeout=5)
+    conn.send(role.encode())
+    time.sleep(0.2)  # The role is read on its own, so don't let the first message join it
+    return conn
+
+
+def test_binary_payload_passes_through_and_is_acked(address):
+    subscriber = connect(address, 'SUBSCRIBER')
+    publisher = connect(address, 'PUBLISHER')
+    with subscriber, publisher:
+        publisher.send(b'caf\xc3\xa9 \xff')
+        assert publisher.recv(1024) == "Message 'café �' sent to 1 subscribers".encode()
+        received = b''
+        while not received.endswith(b'\xff'):
+            received += subscriber.recv(1024)
+        assert received.startswith(b'[FROM PUBLISHER (')
+        assert received.endswith(b']: caf\xc3\xa9 \xff')
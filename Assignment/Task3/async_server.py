@@ -0,0 +1,197 @@
+import os
+import socket
+import asyncio
+import resource
+import itertools
+import broker
+from broker import METRICS, GROUPS, WHEEL, HEARTBEAT_FRAME, Client, advance_liveness, expire_sessions
+from protocol import FrameDecoder
+from topic_log import FileRegion
+from shm_transport import SHM_CODEC
+from groups import SWEEP_INTERVAL
+from timer_wheel import TICK
+from sessions import SESSION_SWEEP, SNAPSHOT_INTERVAL
+from metrics import log, INFO, ERROR as LOG_ERROR
+
+READ_SIZE = 65536  # One read can carry many pipelined frames
+BACKLOG = 4096  # Pending connection queue, sized for large subscriber bursts
+LOCAL_IDS = itertools.count(1)
+WRITER_TASKS = set()  # Strong references so running writer tasks aren't garbage collected
+
+# Routing, groups, sessions and the shared state live in broker.py; this module is the
+# event-loop I/O around them.
+
+
+def raise_file_limit():
+    # Every connection is a file descriptor, so lift the soft limit up to the hard limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+async def server_program(port=5000, host=None, reuse_port=False):
+    host = host or socket.gethostbyname(socket.gethostname())
+    limit = raise_file_limit()
+    # With reuse_port several worker processes bind the same port and the kernel spreads connections
+    server = await asyncio.start_server(handle_client, host, port, backlog=BACKLOG, reuse_port=reuse_port)
+    print(f"[SERVER LISTENING] on {host}:{port} (event loop, fd limit {limit})\n")
+    print("------------------------------------")
+    sweeper = asyncio.create_task(redeliver_periodically())
+    liveness = asyncio.create_task(check_liveness())
+    sessions = asyncio.create_task(maintain_sessions())
+    local = None
+    if broker.LOCAL_SOCKET:
+        # Same-host clients connect here; subscribers among them can take messages from the ring
+        if os.path.exists(broker.LOCAL_SOCKET):
+            os.unlink(broker.LOCAL_SOCKET)  # Left behind by a broker that didn't exit cleanly
+        local = await asyncio.start_unix_server(handle_client, broker.LOCAL_SOCKET, backlog=BACKLOG)
+        print(f"[LOCAL LISTENING] on {broker.LOCAL_SOCKET}, shared-memory ring {broker.RING.name}")
+
+    async with server:
+        try:
+            await server.serve_forever()
+        finally:
+            sweeper.cancel()
+            liveness.cancel()
+            sessions.cancel()
+            if local:
+                local.close()
+
+
+async def read_frames(reader, decoder):
+    # Returns None once the peer has closed the connection
+    data = await reader.read(READ_SIZE)
+    if not data:
+        return None
+    return decoder.feed(data)
+
+
+async def handle_client(reader, writer):
+    # Unix socket peers have no address, so each gets a number in its place
+    address = writer.get_extra_info('peername') or ('local', next(LOCAL_IDS))
+    METRICS.add('connections')
+    decoder = FrameDecoder()
+    client = Client(address)
+    WHEEL.add(address, (writer, None))  # Even a client that never says HELLO gets reaped
+    try:
+        frames = []
+        while not frames:
+            frames = await read_frames(reader, decoder)
+            if frames is None:
+                return
+            WHEEL.touch(address)
+        # The transport only buffers up to its high-water mark; beyond that frames wait in
+        # the bounded queue, where the overflow policy applies
+        ready = asyncio.Event()
+        local = writer.get_extra_info('socket').family == socket.AF_UNIX
+        refused = client.hello(frames.pop(0), writer, local=local, on_ready=ready.set)
+        if refused:
+            writer.write(refused)
+            return
+        if client.queue:
+            task = asyncio.create_task(subscriber_writer(address, client.queue, ready))
+            WRITER_TASKS.add(task)
+            task.add_done_callback(WRITER_TASKS.discard)
+        WHEEL.add(address, (writer, client.queue))
+
+        while client.connected:
+            replies, published = client.handle(frames)
+            for frame in replies:
+                reply(writer, client.queue, frame)
+            if not client.connected:
+                break
+            # Apply back-pressure from the publisher's own socket before reading more
+            await writer.drain()
+            if published and broker.BUS is not None:
+                await broker.BUS.drain()
+            frames = await read_frames(reader, decoder)
+            if frames is None:
+                break
+            WHEEL.touch(address)  # Any frame, HEARTBEAT answers included, proves the client alive
+        log(INFO, f"[DISCONNECT] {address} disconnected.")
+
+    except Exception as e:
+        log(LOG_ERROR, f"[ERROR] Error handling client {address}: {e}")
+    finally:
+        # Clean up when client disconnects
+        client.close()
+        writer.close()
+
+
+def reply(writer, queue, frame):
+    # Subscriber transports are fed by their writer task, so replies go through the queue
+    if queue:
+        queue.put((frame,))
+    else:
+        writer.write(frame)
+
+
+async def subscriber_writer(address, queue, ready):
+    writer = queue.conn
+    try:
+        while True:
+            await ready.wait()
+            ready.clear()
+            items = queue.take(timeout=0)
+            if items is None:
+                break
+            if queue.depth:
+                ready.set()  # take() hands out one batch at a time; come back for the rest
+            # Local subscribers get one NOTIFY for each run of messages in the ring
+            for item in broker.RING.coalesce(items) if queue.codec == SHM_CODEC else items:
+                if isinstance(item, FileRegion):
+                    # Log replays go from the file to the socket with sendfile
+                    await writer.drain()
+                    with item.file as segment:
+                        await asyncio.get_running_loop().sendfile(writer.transport, segment, item.position, item.count)
+                    continue
+                for part in item:
+                    writer.write(part)
+            # Wait for the socket to catch up; meanwhile new frames pile up in the bounded queue
+            await writer.drain()
+            METRICS.delivered(items)
+    except Exception as e:
+        if not queue.closed:
+            log(LOG_ERROR, f"[ERROR] Failed to send message to subscriber {address}: {e}")
+    finally:
+        queue.close()
+        writer.close()
+
+
+async def maintain_sessions():
+    loop = asyncio.get_running_loop()
+    compacted = loop.time()
+    while True:
+        await asyncio.sleep(SESSION_SWEEP)
+        expire_sessions()
+        if loop.time() - compacted >= SNAPSHOT_INTERVAL:
+            await loop.run_in_executor(None, broker.SESSIONS.compact)  # Keep the fsync off the loop
+            compacted = loop.time()
+
+
+async def redeliver_periodically():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        GROUPS.sweep()
+
+
+async def check_liveness():
+    # One task drives the timer wheel for every connection
+    while True:
+        await asyncio.sleep(TICK)
+        pings, reaps = advance_liveness()
+        for address, (writer, queue) in pings:
+            reply(writer, queue, HEARTBEAT_FRAME)
+        for address, (writer, queue) in reaps:
+            # The handler's read then ends and it cleans up as on any disconnect
+            writer.transport.abort()
+
+
+if __name__ == "__main__":
+    port, host = broker.configure("async_server.py")
+    print(f"[SERVER STARTING] on port {port}")
+    try:
+        asyncio.run(server_program(port, host))
+    except KeyboardInterrupt:
+        print("[SERVER STOPPED]")
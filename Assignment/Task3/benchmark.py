@@ -0,0 +1,293 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import resource
+import selectors
+import threading
+import subprocess
+from protocol import (HELLO, PUBLISH, MESSAGE, STATS, HEARTBEAT, FrameDecoder, encode_frame,
+                      recv_frames, send_frame)
+from publisher import Publisher
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVERS = {
+    'threaded': os.path.join(HERE, 'server.py'),
+    'async': os.path.join(HERE, 'async_server.py'),
+}
+
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+QUEUE_LIMIT = 1 << 20  # Large enough that throughput runs never hit the overflow policy
+DECODERS = {}  # {socket: FrameDecoder}, so a frame split across two helpers' reads still decodes
+PUBLISH_LOCK = threading.Lock()  # Keeps the drain thread's heartbeat replies out of the middle of a publish
+
+
+def start_server(kind, host, port):
+    # Server logs go to /dev/null so stdout throughput doesn't skew the numbers
+    process = subprocess.Popen([sys.executable, SERVERS[kind], str(port), host, str(QUEUE_LIMIT)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"{kind} server did not start on {host}:{port}")
+
+
+def process_stats(pid):
+    # RSS and thread count straight from procfs (Linux only)
+    stats = {}
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM", "Threads"):
+                stats[key] = int(value.split()[0])
+    return stats
+
+
+def connect_subscribers(host, port, count, topic):
+    # Connecting thousands can take longer than the broker's idle timeout, so the ones already
+    # connected answer heartbeats in between
+    subscribers = []
+    selector = selectors.DefaultSelector()
+    for _ in range(count):
+        sock = socket.create_connection((host, port))
+        send_frame(sock, HELLO, topic, "SUBSCRIBER")
+        subscribers.append(sock)
+        selector.register(sock, selectors.EVENT_READ)
+        for key, _ in selector.select(timeout=0):
+            read_frames(key.fileobj)
+    selector.close()
+    return subscribers
+
+
+def read_frames(sock, size=65536):
+    # One read's worth of frames, with the broker's heartbeats answered and left out, so runs
+    # longer than its idle timeout aren't reaped. None once the broker has closed the socket.
+    frames = recv_frames(sock, DECODERS.setdefault(sock, FrameDecoder()), size)
+    if frames is None:
+        return None
+    if any(opcode == HEARTBEAT for opcode, _, _ in frames):
+        send_frame(sock, HEARTBEAT)
+    return [frame for frame in frames if frame[0] != HEARTBEAT]
+
+
+def wait_for_fanout(subscribers, timeout):
+    # Wait until every subscriber has received a message
+    selector = selectors.DefaultSelector()
+    for sock in subscribers:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+    pending = len(subscribers)
+    deadline = time.time() + timeout
+    while pending and time.time() < deadline:
+        for key, _ in selector.select(timeout=0.5):
+            try:
+                frames = read_frames(key.fileobj)
+            except BlockingIOError:
+                continue
+            if frames is None or any(opcode == MESSAGE for opcode, _, _ in frames):
+                selector.unregister(key.fileobj)
+                pending -= 1
+    selector.close()
+    return len(subscribers) - pending
+
+
+def query_stats(host, port):
+    # Broker counters over a short-lived MONITOR connection
+    with socket.create_connection((host, port)) as sock:
+        send_frame(sock, HELLO, "", "MONITOR")
+        send_frame(sock, STATS)
+        decoder = FrameDecoder()
+        frames = []
+        while not frames:
+            frames = recv_frames(sock, decoder)
+        return json.loads(frames[0][2])
+
+
+def wait_for_payload(subscribers, size, timeout):
+    # Count subscribers that received a message of at least `size` payload bytes
+    selector = selectors.DefaultSelector()
+    received = {}
+    for sock in subscribers:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+        received[sock] = False
+    pending = len(subscribers)
+    deadline = time.time() + timeout
+    while pending and time.time() < deadline:
+        for key, _ in selector.select(timeout=0.5):
+            try:
+                frames = read_frames(key.fileobj, 1 << 20)
+            except BlockingIOError:
+                continue
+            if frames:
+                received[key.fileobj] = any(opcode == MESSAGE and len(payload) >= size
+                                            for opcode, _, payload in frames)
+            if frames is None or received[key.fileobj]:
+                selector.unregister(key.fileobj)
+                pending -= 1
+    selector.close()
+    return sum(received.values())
+
+
+def measure_large_publish(host, port, pid, publisher, subscribers, topic, large_payload):
+    # One big publish to every remaining subscriber: how much does the broker copy and grow?
+    before = query_stats(host, port)
+    peak_before = process_stats(pid)["VmHWM"]
+    started = time.perf_counter()
+    with PUBLISH_LOCK:
+        send_frame(publisher, PUBLISH, topic, b"x" * large_payload)
+    delivered = wait_for_payload(subscribers, large_payload, timeout=60)
+    elapsed = time.perf_counter() - started
+    peak_after = process_stats(pid)["VmHWM"]
+    after = query_stats(host, port)
+    serialized = after["bytes_serialized"] - before["bytes_serialized"]
+    return delivered, elapsed, peak_after - peak_before, serialized
+
+
+def drain(sock):
+    # Keep reading acks so the broker never blocks on a full publisher socket, answering its heartbeats
+    decoder = FrameDecoder()
+    try:
+        while True:
+            frames = recv_frames(sock, decoder)
+            if frames is None:
+                return
+            if any(opcode == HEARTBEAT for opcode, _, _ in frames):
+                with PUBLISH_LOCK:
+                    send_frame(sock, HEARTBEAT)
+    except OSError:
+        pass
+
+
+def count_messages(subscriber, messages, timeout=30):
+    subscriber.settimeout(timeout)
+    received = 0
+    try:
+        while received < messages:
+            frames = read_frames(subscriber, 262144)
+            if frames is None:
+                break
+            received += sum(1 for opcode, _, _ in frames if opcode == MESSAGE)
+    except socket.timeout:
+        pass
+    return received
+
+
+def measure_pipeline(publisher, subscriber, topic, messages, payload_size):
+    # All publishes go out in a single sendall, so the broker sees many frames per recv
+    batch = encode_frame(PUBLISH, topic, b"x" * payload_size) * messages
+    started = time.perf_counter()
+    with PUBLISH_LOCK:
+        publisher.sendall(batch)
+    received = count_messages(subscriber, messages)
+    return received, time.perf_counter() - started
+
+
+def measure_publisher_api(host, port, subscriber, topic, messages, payload_size, max_batch, flush_interval):
+    # Publisher API with a bounded in-flight window and cumulative acks
+    publisher = Publisher(host, port, topic, max_batch=max_batch, flush_interval=flush_interval)
+    payload = b"x" * payload_size
+    started = time.perf_counter()
+    for _ in range(messages):
+        publisher.publish(payload)
+    acked = publisher.wait_for_ack(timeout=30)
+    received = count_messages(subscriber, messages)
+    elapsed = time.perf_counter() - started
+    publisher.close()
+    return received, elapsed, acked
+
+
+def run(kind, host, port, count, topic, settle, messages, payload_size, large_fanout, large_payload,
+        batches, flush_interval):
+    process = start_server(kind, host, port)
+    try:
+        baseline = process_stats(process.pid)
+        started = time.perf_counter()
+        subscribers = connect_subscribers(host, port, count, topic)
+        connect_time = time.perf_counter() - started
+        time.sleep(settle)
+        loaded = process_stats(process.pid)
+
+        publisher = socket.create_connection((host, port))
+        send_frame(publisher, HELLO, topic, "PUBLISHER")
+        threading.Thread(target=drain, args=(publisher,), daemon=True).start()
+        time.sleep(settle)
+        started = time.perf_counter()
+        with PUBLISH_LOCK:
+            send_frame(publisher, PUBLISH, topic, "benchmark")
+        delivered = wait_for_fanout(subscribers, timeout=30)
+        fanout_time = time.perf_counter() - started
+
+        # A smaller audience for the large payload run, then one for the pipelined run
+        for sock in subscribers[large_fanout:]:
+            sock.close()
+        subscribers = subscribers[:large_fanout]
+        time.sleep(settle)
+        large = measure_large_publish(host, port, process.pid, publisher, subscribers, topic, large_payload)
+        for sock in subscribers[1:]:
+            sock.close()
+        time.sleep(settle)
+        received, pipeline_time = measure_pipeline(publisher, subscribers[0], topic, messages, payload_size)
+        batched = [(max_batch, measure_publisher_api(host, port, subscribers[0], topic, messages,
+                                                     payload_size, max_batch, flush_interval))
+                   for max_batch in batches]
+
+        publisher.close()
+        subscribers[0].close()
+    finally:
+        process.kill()
+        process.wait()
+
+    rss_per_conn = (loaded["VmRSS"] - baseline["VmRSS"]) / max(count, 1)
+    print(f"[{kind.upper()}] {count} subscribers connected in {connect_time:.2f}s")
+    print(f"[{kind.upper()}] RSS {baseline['VmRSS']} KiB -> {loaded['VmRSS']} KiB "
+          f"({rss_per_conn:.1f} KiB/connection), threads {loaded['Threads']}")
+    print(f"[{kind.upper()}] fan-out of one publish reached {delivered}/{count} "
+          f"subscribers in {fanout_time * 1000:.1f} ms")
+    large_delivered, large_time, peak_growth, serialized = large
+    print(f"[{kind.upper()}] {large_payload}-byte publish reached {large_delivered}/{len(subscribers)} "
+          f"subscribers in {large_time * 1000:.1f} ms, peak RSS +{peak_growth} KiB, "
+          f"{serialized} bytes serialised by the broker")
+    print(f"[{kind.upper()}] {received}/{messages} pipelined {payload_size}-byte publishes in "
+          f"{pipeline_time:.2f}s ({received / pipeline_time:.0f} msg/s)")
+    for max_batch, (batch_received, batch_time, acked) in batched:
+        print(f"[{kind.upper()}] Publisher API max_batch={max_batch}: {batch_received}/{messages} delivered in "
+              f"{batch_time:.2f}s ({batch_received / batch_time:.0f} msg/s), all acked: {acked}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the threaded and event-loop Task3 brokers")
+    parser.add_argument("--servers", nargs="+", choices=sorted(SERVERS), default=["threaded", "async"])
+    parser.add_argument("--subscribers", type=int, default=1000)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5100)
+    parser.add_argument("--topic", default="bench")
+    parser.add_argument("--messages", type=int, default=20000, help="pipelined publishes for the throughput run")
+    parser.add_argument("--payload-size", type=int, default=64)
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 100],
+                        help="max_batch values for the Publisher API runs")
+    parser.add_argument("--flush-interval", type=float, default=0.005)
+    parser.add_argument("--large-fanout", type=int, default=100, help="subscribers kept for the large payload run")
+    parser.add_argument("--large-payload", type=int, default=1 << 20)
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds to let the server settle")
+    args = parser.parse_args()
+
+    raise_file_limit()
+    for offset, kind in enumerate(args.servers):
+        run(kind, args.host, args.port + offset, args.subscribers, args.topic, args.settle,
+            args.messages, args.payload_size, args.large_fanout, args.large_payload,
+            args.batches, args.flush_interval)
@@ -0,0 +1,618 @@
+import gc
+import os
+import sys
+import time
+import json
+import socket
+import threading
+from protocol import (FORMAT, OPCODES, HELLO, PUBLISH, MESSAGE, ACK, ERROR, TERMINATE, STATS, BATCH,
+                      SUBSCRIBE, UNSUBSCRIBE, REPLAY, REPLAY_FROM, REPLAY_RANGE, STATS_PROMETHEUS, FILTER,
+                      QOS, QOS_OPTIONS, NORMAL, LANES, CONSUME, CONSUME_OPTIONS, DELIVERY_ID,
+                      HEARTBEAT, SESSION, SESSION_NEW, SESSION_RESUMED,
+                      encode_ack, encode_frame, encode_prefix, split_batch, split_hello)
+from topic_index import TopicIndex, is_pattern
+from outbound import OutboundQueue, DROP_OLDEST, POLICIES
+from topic_log import TopicLog
+from compression import negotiate, compress_frame
+from shm_transport import RingWriter, SHM_CODEC
+from filters import FilterIndex, FilterError, parse_document
+from groups import ConsumerGroups, ACK_TIMEOUT
+from timer_wheel import TimerWheel, TICK
+from sessions import SessionStore
+from metrics import Metrics, Stamped, log, enabled, DEBUG, INFO, WARNING, ERROR as LOG_ERROR
+
+# Routing state shared by server.py (a thread per connection) and async_server.py (one event loop).
+# Nothing here touches a socket: the servers read frames, pass them to a Client and send back what
+# it returns, and their writers drain the OutboundQueues filled here. Settings that the entry points
+# change are read as broker.<NAME>, so assign them on this module.
+SUBSCRIBERS = {}  # Dictionary to store subscriber connections {address: (conn, {topic patterns})}
+PUBLISHERS = {}   # Dictionary to store publisher connections {address: (conn, topic)}
+PEERS = {}        # Other cluster nodes linked to this one {address: (node name, {topic patterns})}
+CONNECTIONS_LOCK = threading.Lock()  # Guards SUBSCRIBERS and PUBLISHERS across handler threads
+INDEX = TopicIndex()  # Topic pattern trie, so a publish never scans other topics' subscribers
+PEER_INDEX = TopicIndex()  # Patterns each peer node's subscribers want, so publishes only go where needed
+FILTERS = FilterIndex()  # Content filters of the subscribers that set one, keyed by address
+METRICS = Metrics(('publishes_received', 'deliveries', 'bytes_serialized', 'bytes_delivered', 'connections')
+                  + tuple(f"expired_{lane}" for lane in LANES))
+GROUPS = ConsumerGroups(METRICS)  # Acknowledged, load-balanced consumers (see groups.py)
+WHEEL = TimerWheel()  # When each connection was last heard from, for heartbeats and idle reaping
+HEARTBEAT_FRAME = encode_frame(HEARTBEAT)
+SESSIONS = SessionStore()  # Subscriber sessions; persisted to $PUBSUB_SESSION_DIR when it is set
+SESSION_TOKENS = {}        # {address: token} of the subscribers connected with a session
+HELD = {}                  # {token: OutboundQueue} collecting messages for a detached session
+QUEUE_LIMIT = 1024            # Frames buffered per subscriber before the overflow policy applies
+OVERFLOW_POLICY = DROP_OLDEST  # drop-oldest, drop-newest or disconnect
+LOG = None                    # Optional TopicLog; enabled by passing a log directory
+LOG_RETENTION_BYTES = None    # Per-topic size limit for the log (None keeps everything)
+LOG_RETENTION_SECONDS = None  # Per-topic age limit for the log (None keeps everything)
+LOCAL_SOCKET = None  # Unix socket path for same-host clients; set from $PUBSUB_SHM_SOCKET
+RING = None          # Shared-memory ring the local subscribers read messages from (see shm_transport.py)
+FEDERATION = None  # Federation with other broker nodes (see federation.py), None when running alone
+BUS = None  # WorkerBus linking SO_REUSEPORT worker processes (see workers.py), None when running alone
+
+WILDCARD_PUBLISH = "Publishers need a concrete topic, wildcards are for subscribers"
+
+
+def configure(program):
+    """Apply the command line and environment shared by both servers; returns (port, host)."""
+    global QUEUE_LIMIT, OVERFLOW_POLICY, LOG_RETENTION_BYTES, LOG_RETENTION_SECONDS, LOG, SESSIONS, LOCAL_SOCKET, RING
+    port = (int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
+    host = sys.argv[2] if len(sys.argv) > 2 else None
+    QUEUE_LIMIT = int(sys.argv[3]) if len(sys.argv) > 3 else QUEUE_LIMIT
+    OVERFLOW_POLICY = sys.argv[4] if len(sys.argv) > 4 else OVERFLOW_POLICY
+    if OVERFLOW_POLICY not in POLICIES:
+        print(f"Usage: [PUBSUB_SESSION_DIR=<dir>] [PUBSUB_SHM_SOCKET=<path>] [PUBSUB_LOG_RETENTION_BYTES=<n>] "
+              f"[PUBSUB_LOG_RETENTION_SECONDS=<n>] python {program} <port> <host> <queue_limit> <{'|'.join(POLICIES)}> [log_dir]")
+        sys.exit(1)
+    if os.environ.get('PUBSUB_LOG_RETENTION_BYTES'):
+        LOG_RETENTION_BYTES = int(os.environ['PUBSUB_LOG_RETENTION_BYTES'])
+    if os.environ.get('PUBSUB_LOG_RETENTION_SECONDS'):
+        LOG_RETENTION_SECONDS = float(os.environ['PUBSUB_LOG_RETENTION_SECONDS'])
+    if len(sys.argv) > 5:
+        LOG = TopicLog(sys.argv[5], retention_bytes=LOG_RETENTION_BYTES, retention_seconds=LOG_RETENTION_SECONDS)
+        print(f"[LOG] Durable topic log in {sys.argv[5]}")
+    if os.environ.get('PUBSUB_SESSION_DIR'):
+        SESSIONS = SessionStore(os.environ['PUBSUB_SESSION_DIR'])
+        restore_sessions()
+    if os.environ.get('PUBSUB_SHM_SOCKET'):
+        LOCAL_SOCKET = os.environ['PUBSUB_SHM_SOCKET']
+        RING = RingWriter()
+        RING.close_on_exit()
+    return port, host
+
+
+class Client:
+    """What the broker knows about one connection: its role, its outbound
+    queue and the lane, TTL and sequence number of its publishes.
+
+    The servers own the socket. They pass the HELLO frame to hello(), start a
+    writer for the queue it opens (subscribers and peer nodes), then feed
+    each read's frames to handle() and send back the frames it returns, so
+    the routing is the same whether a thread or the event loop does the I/O."""
+
+    def __init__(self, address):
+        self.address = address
+        self.queue = None
+        self.connected = True
+        self.seq = 0  # Sequence number of the last message routed for this publisher
+        self.lane, self.ttl = NORMAL, 0  # Priority lane and TTL (ms) set by the publisher's last QOS frame
+        self.checked_topics = set()  # Topics this publisher's frames named that are known not to be patterns
+
+    def hello(self, frame, conn, local=False, on_ready=None):
+        """Register the connection under the role its HELLO names. Returns an
+        ERROR frame to send before hanging up, or None."""
+        address = self.address
+        opcode, topic, role = frame
+        if opcode != HELLO:
+            log(LOG_ERROR, f"[ERROR] Expected HELLO from {address}, got {OPCODES[opcode]}")
+            return encode_frame(ERROR, payload="Expected HELLO handshake")
+        try:
+            role, offered, token = split_hello(role)
+        except UnicodeDecodeError:
+            log(LOG_ERROR, f"[ERROR] Undecodable HELLO from {address}")
+            return encode_frame(ERROR, payload="HELLO needs a UTF-8 role")
+        log(INFO, f"[NEW {role} CONNECTION on {topic}] {address} connected.")
+
+        if role == "SUBSCRIBER":
+            # Clients on the Unix socket share this host's memory, so they can read messages from the ring
+            if RING is not None and local and SHM_CODEC in offered.split(","):
+                codec = SHM_CODEC
+            else:
+                codec = negotiate(offered)
+            session = SESSIONS.attach(token) if token and token != SESSION_NEW else None
+            queue = self.queue = HELD.pop(session.token, None) if session else None
+            if queue is None:
+                queue = self.queue = OutboundQueue(conn, QUEUE_LIMIT, OVERFLOW_POLICY, on_ready=on_ready,
+                                                   codec=codec, metrics=METRICS)
+            else:
+                # What was published to the session while it was away goes out first
+                queue.attach(conn, OVERFLOW_POLICY, on_ready=on_ready, codec=codec)
+            if offered:
+                # Answer the codec offer before any message, so the client knows how to read COMPRESSED
+                # (or, for the shared-memory codec, which ring to map)
+                queue.put((encode_frame(HELLO, RING.name if codec == SHM_CODEC else '', codec or ''),))
+            if token:
+                resumed = session is not None
+                session = session or SESSIONS.open()
+                queue.put((encode_frame(SESSION, session.token, SESSION_RESUMED if resumed else SESSION_NEW),))
+            with CONNECTIONS_LOCK:
+                SUBSCRIBERS[address] = (conn, set())
+            if session:
+                SESSION_TOKENS[address] = session.token
+                if resumed:
+                    resume_session(address, queue, session)
+            for pattern in filter(None, topic.split(",")):
+                subscribe(address, queue, pattern)
+        elif role == "PEER" and FEDERATION is not None:
+            # Another broker node; its SUBSCRIBEs advertise what its own subscribers want
+            self.queue = OutboundQueue(conn, QUEUE_LIMIT, OVERFLOW_POLICY, on_ready=on_ready, metrics=METRICS)
+            PEERS[address] = (topic, set())
+        elif role == "PUBLISHER":
+            if is_pattern(topic):
+                log(LOG_ERROR, f"[ERROR] Publisher {address} used wildcard topic '{topic}'")
+                return encode_frame(ERROR, payload=WILDCARD_PUBLISH)
+            with CONNECTIONS_LOCK:
+                PUBLISHERS[address] = (conn, topic)
+        elif role == "MONITOR":
+            pass  # Monitors only query STATS
+        else:
+            log(LOG_ERROR, f"[ERROR] Unknown role: {role}")
+            return encode_frame(ERROR, payload=f"Unknown role: {role}")
+        print_status()
+        return None
+
+    def handle(self, frames):
+        """Route one read's frames. Returns (replies, published): the frames
+        to send back, in order, and how many messages were published.
+        connected is False once the client has said TERMINATE."""
+        address = self.address
+        queue = self.queue
+        replies = []
+        published = deliveries = 0
+        for opcode, pattern_topic, message in frames:
+            if opcode == TERMINATE:
+                if address in SESSION_TOKENS:
+                    SESSIONS.close(SESSION_TOKENS.pop(address))  # A clean goodbye ends the session as well
+                self.connected = False
+                break
+
+            if opcode == HEARTBEAT:
+                continue  # The answer to our ping; reading it already marked the client alive
+
+            if opcode == STATS:
+                report = get_prometheus() if message == STATS_PROMETHEUS else json.dumps(get_stats())
+                replies.append(encode_frame(STATS, payload=report))
+                continue
+
+            # Subscribers can add and drop patterns without reconnecting
+            if address in PEERS and opcode in (SUBSCRIBE, UNSUBSCRIBE):
+                peer_interest(address, queue, pattern_topic, opcode == SUBSCRIBE)
+                continue
+            if queue and opcode == SUBSCRIBE:
+                from_offset = REPLAY_FROM.unpack(message)[0] if len(message) == REPLAY_FROM.size else None
+                subscribe(address, queue, pattern_topic, from_offset)
+                continue
+            if queue and opcode == UNSUBSCRIBE:
+                unsubscribe(address, pattern_topic)
+                if GROUPS.leave(address, pattern_topic):
+                    interest_changed(pattern_topic)
+                continue
+            if address in SUBSCRIBERS and opcode == CONSUME:
+                consume(address, queue, pattern_topic, message)
+                continue
+            if address in SUBSCRIBERS and opcode == ACK:
+                if len(message) % DELIVERY_ID.size:
+                    replies.append(encode_frame(ERROR, pattern_topic, "ACK needs whole 8-byte delivery ids"))
+                    continue
+                GROUPS.ack(address, [delivery_id for (delivery_id,) in DELIVERY_ID.iter_unpack(message)])
+                continue
+            if address in SUBSCRIBERS and opcode == FILTER:
+                set_filter(address, queue, message)
+                continue
+
+            if address in PUBLISHERS and opcode == QOS:
+                if len(message) == QOS_OPTIONS.size and QOS_OPTIONS.unpack(message)[0] < len(LANES):
+                    self.lane, self.ttl = QOS_OPTIONS.unpack(message)
+                else:
+                    replies.append(encode_frame(ERROR, payload="QOS needs a lane (0 high, 1 normal, 2 low) and a TTL"))
+                continue
+
+            # If this is a publisher, distribute the message(s) to subscribers of the same topic
+            if address in PUBLISHERS and opcode in (PUBLISH, BATCH):
+                publisher_topic = PUBLISHERS[address][1]
+                if pattern_topic and pattern_topic != publisher_topic:
+                    # A frame may name another topic, so one connection can publish to many
+                    if pattern_topic not in self.checked_topics:
+                        if is_pattern(pattern_topic):
+                            replies.append(encode_frame(ERROR, pattern_topic, WILDCARD_PUBLISH))
+                            continue
+                        self.checked_topics.add(pattern_topic)
+                    publisher_topic = pattern_topic
+                if not publisher_topic and LOG is not None:
+                    # Without a topic in either the HELLO or the frame there is nothing to log the messages under
+                    replies.append(encode_frame(ERROR, payload="A broker with a log needs a topic on every publish"))
+                    continue
+                messages = split_batch(message) if opcode == BATCH else (message,)
+                if enabled(DEBUG):
+                    log(DEBUG, f"[PUBLISHER {address} - {publisher_topic}]: {len(messages)} message(s)")
+                for message in messages:
+                    deliveries += distribute_messages(message, address, publisher_topic, self.lane, self.ttl)
+                published += len(messages)
+
+            # If this is a subscriber, they shouldn't be sending messages (except terminate)
+            elif address in SUBSCRIBERS:
+                replies.append(encode_frame(ERROR, payload="Subscribers cannot send messages. Only publishers can send messages."))
+
+        # One cumulative ack per read, however many publishes it carried
+        if published:
+            self.seq += published
+            replies.append(encode_frame(ACK, publisher_topic,
+                                        encode_ack(self.seq, f"{published} message(s) queued for {deliveries} deliveries")))
+        return replies, published
+
+    def close(self):
+        # Forget the connection everywhere it was registered; the server closes the socket
+        address = self.address
+        WHEEL.remove(address)
+        remove_subscriber(address)
+        remove_peer(address)
+        if self.queue:
+            self.queue.close()
+        with CONNECTIONS_LOCK:
+            publisher = PUBLISHERS.pop(address, None)
+        if publisher:
+            log(INFO, f"[CLEANUP] Removed publisher {address}")
+        print_status()
+
+
+def subscribe(address, queue, pattern, from_offset=None):
+    with CONNECTIONS_LOCK:
+        if address not in SUBSCRIBERS:
+            return
+        SUBSCRIBERS[address][1].add(pattern)
+    if address in SESSION_TOKENS:
+        SESSIONS.subscribed(SESSION_TOKENS[address], pattern)
+    if from_offset is None:
+        INDEX.add(pattern, address, queue)
+        log(DEBUG, f"[SUBSCRIBE] {address} to '{pattern}'")
+    elif LOG is None or not pattern or is_pattern(pattern):
+        queue.put((encode_frame(ERROR, pattern, "Replay needs a concrete topic and a broker started with a log directory"),))
+        INDEX.add(pattern, address, queue)
+    else:
+        # Publishes to this topic hold the same lock across append + fan-out, so every offset
+        # before `end` is in the replay and every later one is fanned out to this queue
+        with LOG.topic_lock(pattern):
+            first, end, regions = LOG.regions(pattern, from_offset)
+            queue.put((encode_frame(REPLAY, pattern, REPLAY_RANGE.pack(first, end)),))
+            for region in regions:
+                queue.put(region)
+            INDEX.add(pattern, address, queue)
+        log(INFO, f"[SUBSCRIBE] {address} to '{pattern}' replaying offsets {first}-{end}")
+    interest_changed(pattern)
+
+
+def unsubscribe(address, pattern):
+    with CONNECTIONS_LOCK:
+        if address not in SUBSCRIBERS:
+            return
+        SUBSCRIBERS[address][1].discard(pattern)
+    if address in SESSION_TOKENS:
+        SESSIONS.unsubscribed(SESSION_TOKENS[address], pattern)
+    if INDEX.remove(pattern, address):
+        interest_changed(pattern)
+        log(DEBUG, f"[UNSUBSCRIBE] {address} from '{pattern}'")
+
+
+def set_filter(address, queue, expression):
+    # One filter per connection, covering all its patterns; it can be set before the first SUBSCRIBE
+    try:
+        expression = expression.decode(FORMAT)
+        FILTERS.set(address, expression)
+    except (FilterError, UnicodeDecodeError) as e:
+        queue.put((encode_frame(ERROR, payload=f"Invalid filter: {e}"),))
+        return
+    if address in SESSION_TOKENS:
+        SESSIONS.filtered(SESSION_TOKENS[address], expression)
+    log(DEBUG, f"[FILTER] {address} '{expression}'")
+
+
+def consume(address, queue, pattern, options):
+    if len(options) < CONSUME_OPTIONS.size or not CONSUME_OPTIONS.unpack_from(options)[0]:
+        queue.put((encode_frame(ERROR, pattern, "CONSUME needs a window of at least 1 and an ack timeout"),))
+        return
+    window, timeout = CONSUME_OPTIONS.unpack_from(options)
+    group = options[CONSUME_OPTIONS.size:].decode(FORMAT)
+    if group and (BUS is not None or FEDERATION is not None):
+        # Every worker or node would hold its own copy of the group and deliver each message once per copy
+        queue.put((encode_frame(ERROR, pattern, "Named consumer groups need a single broker process; "
+                                                "CONSUME without a group name works here"),))
+        return
+    GROUPS.join(address, queue, pattern, group, window, timeout / 1000 or ACK_TIMEOUT)
+    interest_changed(pattern)
+    if address in SESSION_TOKENS:
+        SESSIONS.joined(SESSION_TOKENS[address], pattern, group, window, timeout)
+    log(DEBUG, f"[CONSUME] {address} on '{pattern}' in group '{group}', window {window}")
+
+
+def resume_session(address, queue, session):
+    # The session's subscriptions were held under its token; re-keying them in place means no
+    # publish in between is lost or delivered twice
+    with CONNECTIONS_LOCK:
+        SUBSCRIBERS[address][1].update(session.patterns)
+    if session.filter:
+        FILTERS.set(address, session.filter)
+    for pattern in session.patterns:
+        if not INDEX.move(pattern, session.token, address, queue):
+            INDEX.add(pattern, address, queue)
+            interest_changed(pattern)
+    FILTERS.remove(session.token)
+    for pattern, (group, window, timeout) in session.groups.items():
+        GROUPS.join(address, queue, pattern, group, window, timeout / 1000 or ACK_TIMEOUT)
+        interest_changed(pattern)
+    log(INFO, f"[SESSION] {address} resumed {session.token[:8]} with {len(session.patterns)} pattern(s)")
+
+
+def hold_session(session, address=None):
+    # A detached session keeps its subscriptions and filter, under its token, with a queue that
+    # collects what is published to them until the subscriber is back or the session expires
+    held = HELD[session.token] = OutboundQueue(None, QUEUE_LIMIT, DROP_OLDEST, metrics=METRICS)
+    if session.filter:
+        FILTERS.set(session.token, session.filter)
+    for pattern in session.patterns:
+        if address is None or not INDEX.move(pattern, address, session.token, held):
+            INDEX.add(pattern, session.token, held)
+            interest_changed(pattern)
+
+
+def drop_session(session):
+    HELD.pop(session.token, None)
+    for pattern in session.patterns:
+        INDEX.remove(pattern, session.token)
+        interest_changed(pattern)
+    FILTERS.remove(session.token)
+    log(INFO, f"[SESSION] {session.token[:8]} expired")
+
+
+def restore_sessions():
+    started = time.perf_counter()
+    # Hundreds of thousands of small objects at once would set off the cyclic collector over and over
+    gc.disable()
+    try:
+        sessions = SESSIONS.load()
+        for session in sessions:
+            hold_session(session)
+    finally:
+        gc.enable()
+    log(INFO, f"[SESSIONS] Restored {len(sessions)} session(s) in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+
+def expire_sessions():
+    for session in SESSIONS.expire():
+        drop_session(session)
+
+
+def advance_liveness():
+    """One tick of the timer wheel: returns (pings, reaps), the connections
+    the server should send a HEARTBEAT and the ones it should hang up, as
+    [(address, entry)] with the entry each server filed in WHEEL."""
+    pings, reaps = WHEEL.advance()
+    for address, _ in reaps:
+        log(INFO, f"[REAPED] {address} silent for {WHEEL.timeout * TICK:g}s")
+    METRICS.add('heartbeats_sent', len(pings))
+    METRICS.add('connections_reaped', len(reaps))
+    return pings, reaps
+
+
+def remove_subscriber(address):
+    with CONNECTIONS_LOCK:
+        subscriber = SUBSCRIBERS.pop(address, None)
+    token = SESSION_TOKENS.pop(address, None)
+    session = SESSIONS.detach(token) if token else None
+    if session and subscriber:
+        hold_session(session, address)  # Moves its subscriptions off this address first
+    FILTERS.remove(address)
+    for pattern in GROUPS.leave(address):
+        interest_changed(pattern)
+    if subscriber:
+        for pattern in subscriber[1]:
+            INDEX.remove(pattern, address)
+            interest_changed(pattern)
+        log(INFO, f"[CLEANUP] Removed subscriber {address}")
+
+
+def interest_changed(pattern):
+    # Peer nodes hear about a pattern when its first local subscriber or consumer group arrives
+    # and its last one leaves
+    if FEDERATION is not None:
+        FEDERATION.interest_changed(pattern, pattern in INDEX.topics or pattern in GROUPS.index.topics)
+
+
+def peer_interest(address, queue, pattern, interested):
+    patterns = PEERS[address][1]
+    if interested:
+        patterns.add(pattern)
+        PEER_INDEX.add(pattern, address, queue)
+    else:
+        patterns.discard(pattern)
+        PEER_INDEX.remove(pattern, address)
+    log(DEBUG, f"[PEER {PEERS[address][0]}] {'wants' if interested else 'dropped'} '{pattern}'")
+
+
+def remove_peer(address):
+    peer = PEERS.pop(address, None)
+    if peer:
+        for pattern in peer[1]:
+            PEER_INDEX.remove(pattern, address)
+        log(INFO, f"[CLEANUP] Removed peer node {peer[0]}")
+
+
+def distribute_messages(message, publisher_address, publisher_topic, lane=NORMAL, ttl=0):
+    # Serialise once per publish: every subscriber queue holds the same prefix and payload
+    # objects, and writers send them with a vectored write, so the payload is never copied here
+    prefix = encode_prefix(MESSAGE, publisher_topic, len(message))
+    parts = Stamped((prefix, message))  # Writers time publish-to-deliver latency from this stamp
+    # Subscriber queues drop the message unsent once it's older than its TTL
+    deadline = parts.received + ttl * 1000000 if ttl else None
+    METRICS.add('publishes_received')
+    METRICS.add('bytes_serialized', len(prefix))
+    relayed = relay_frame(parts, lane, ttl)
+    if BUS is not None:
+        # Subscribers connected to the other workers get the same encoded frame over the bus
+        BUS.forward(relayed)
+    # Consumer groups each take the message once, for one of their members
+    consumers = GROUPS.offer(parts, publisher_topic) if GROUPS else 0
+    forwarded = forward_to_peers(relayed, publisher_topic, lane, deadline)
+    if LOG is None:
+        return consumers + forwarded + fan_out(parts, publisher_topic, lane, deadline)
+    # The log stores the frame exactly as subscribers receive it, so replays can sendfile it
+    with LOG.topic_lock(publisher_topic):
+        LOG.append(publisher_topic, parts)
+        return consumers + forwarded + fan_out(parts, publisher_topic, lane, deadline)
+
+
+def relay_frame(parts, lane, ttl):
+    # Worker bus and peer links carry a non-default lane and TTL as a QOS frame that applies
+    # to the MESSAGE right after it only, so a relayed frame never depends on an earlier one
+    if lane == NORMAL and not ttl:
+        return parts
+    return Stamped((encode_frame(QOS, payload=QOS_OPTIONS.pack(lane, ttl)),) + parts, parts.received)
+
+
+def deliver_relayed(parts, topic, lane=NORMAL, ttl=0):
+    # A publish relayed by another worker or cluster node: local subscribers and acknowledged
+    # consumers get it like a local publish, but it is never forwarded again. Its TTL counts
+    # from when it arrived here.
+    deadline = time.perf_counter_ns() + ttl * 1000000 if ttl else None
+    consumers = GROUPS.offer(parts, topic) if GROUPS else 0
+    return consumers + fan_out(parts, topic, lane, deadline)
+
+
+def forward_to_peers(parts, publisher_topic, lane=NORMAL, deadline=None):
+    # Only nodes that advertised a matching pattern get the frame, and only once each; they
+    # deliver it to their own subscribers and never forward it again
+    if not PEERS:
+        return 0
+    forwarded = 0
+    for peer_address, peer_queue in PEER_INDEX.subscribers(publisher_topic):
+        if peer_queue.put(parts, lane, deadline):
+            forwarded += 1
+        else:
+            log(WARNING, f"[SLOW PEER] Disconnecting peer node {PEERS[peer_address][0]}: outbound queue full")
+            remove_peer(peer_address)
+    return forwarded
+
+
+def fan_out(parts, publisher_topic, lane=NORMAL, deadline=None):
+    # Queue one encoded frame for every local subscriber whose patterns match the topic
+    queued = 0
+    slow_subscribers = []
+    variants = {None: parts}  # {codec: frame}, each compressed variant built once per publish
+    delivered_bytes = 0
+    passed = None  # Subscribers whose filter the payload satisfies, evaluated once on demand
+    filtered = 0
+
+    # Enqueueing never blocks, so one slow subscriber can't stall the publisher or the others
+    for subscriber_address, subscriber_queue in INDEX.subscribers(publisher_topic):
+        if subscriber_address in FILTERS:
+            if passed is None:
+                passed = FILTERS.match(parse_document(parts[1]))
+            if subscriber_address not in passed:
+                filtered += 1
+                continue
+        frame = variants.get(subscriber_queue.codec)
+        if frame is None:
+            if subscriber_queue.codec == SHM_CODEC:
+                frame = variants[SHM_CODEC] = RING.frame(parts, publisher_topic, METRICS)
+            else:
+                frame = variants[subscriber_queue.codec] = compress_frame(parts, publisher_topic,
+                                                                          subscriber_queue.codec, METRICS)
+        if subscriber_queue.put(frame, lane, deadline):
+            queued += 1
+            delivered_bytes += len(frame[0]) + len(frame[1])
+        else:
+            slow_subscribers.append((subscriber_address, subscriber_queue))
+
+    if not queued and not slow_subscribers and enabled(DEBUG):
+        log(DEBUG, f"[INFO] No subscribers for topic '{publisher_topic}' to send message to")
+
+    # Subscribers whose queue overflowed under the disconnect policy. Hanging up at once stops a
+    # writer blocked on the slow socket from sending it the rest of the backlog; the handler then
+    # cleans up as on any disconnect
+    for addr, subscriber_queue in slow_subscribers:
+        log(WARNING, f"[SLOW CONSUMER] Disconnecting subscriber {addr}: outbound queue full")
+        METRICS.add('slow_consumers_disconnected')
+        remove_subscriber(addr)
+        hang_up(subscriber_queue.conn)
+    METRICS.add('deliveries', queued)
+    METRICS.add('bytes_delivered', delivered_bytes)
+    if filtered:
+        METRICS.add('filtered_out', filtered)
+    METRICS.published(publisher_topic, queued)
+    return queued
+
+
+def hang_up(conn):
+    # The threaded broker hands its queues sockets, the event-loop broker StreamWriters
+    if isinstance(conn, socket.socket):
+        try:
+            conn.shutdown(socket.SHUT_RDWR)  # Wakes the handler thread blocked in recv
+        except OSError:
+            pass
+    else:
+        conn.transport.abort()
+
+
+def get_stats():
+    stats = INDEX.snapshot()
+    with CONNECTIONS_LOCK:
+        stats['publishers'] = len(PUBLISHERS)
+    stats['tracked_connections'] = len(WHEEL)
+    # Lock-free counters at the top level; per-topic rates and latency percentiles under 'metrics'
+    metrics = METRICS.snapshot()
+    stats.update(metrics.pop('counters'))
+    stats['metrics'] = metrics
+    # Per-subscriber queue depth and drops, to find the consumers that can't keep up
+    stats['queues'] = {f"{addr[0]}:{addr[1]}" if isinstance(addr, tuple) else f"session:{addr[:8]}":
+                       subscriber_queue.snapshot() for addr, subscriber_queue in INDEX.all_subscribers()}
+    if FILTERS:
+        stats['filters'] = FILTERS.snapshot()
+    if GROUPS:
+        stats['groups'] = GROUPS.snapshot()
+    if SESSIONS:
+        stats['sessions'] = SESSIONS.snapshot()
+    if FEDERATION is not None:
+        stats['federation'] = FEDERATION.snapshot()
+        stats['peer_interest'] = PEER_INDEX.snapshot()['topics']
+    if BUS is not None:
+        # In multi-process mode these numbers cover this worker only
+        stats['bus'] = dict(BUS.stats, worker=BUS.worker_id, workers=BUS.workers)
+    return stats
+
+
+def get_prometheus():
+    with CONNECTIONS_LOCK:
+        gauges = {'publishers': len(PUBLISHERS), 'subscribers': len(SUBSCRIBERS)}
+    gauges['tracked_connections'] = len(WHEEL)
+    gauges['queued_frames'] = sum(subscriber_queue.snapshot()['depth'] for _, subscriber_queue in INDEX.all_subscribers())
+    if FEDERATION is not None:
+        gauges['peers'] = len(PEERS)
+    return METRICS.prometheus(gauges)
+
+
+def print_status():
+    if not enabled(INFO):
+        return
+    with CONNECTIONS_LOCK:
+        publishers = len(PUBLISHERS)
+        subscribers = len(SUBSCRIBERS)
+    log(INFO, f"[STATUS] Publishers: {publishers}, Subscribers: {subscribers}")
+    if not enabled(DEBUG):
+        return
+    # Listing every connection is O(n) per connect, so only at debug level
+    with CONNECTIONS_LOCK:
+        publishers = list(PUBLISHERS.items())
+        subscribers = [(addr, sorted(topics)) for addr, (conn, topics) in SUBSCRIBERS.items()]
+    for addr, (conn, topic) in publishers:
+        log(DEBUG, f"[PUBLISHER] {addr} on topic '{topic}'")
+    for addr, topics in subscribers:
+        log(DEBUG, f"[SUBSCRIBER] {addr} on topics {topics}")
@@ -1,31 +1,87 @@
 import sys
 import socket
 import threading
+from protocol import (FORMAT, HELLO, PUBLISH, MESSAGE, ACK, ERROR, TERMINATE, STATS, SUBSCRIBE, UNSUBSCRIBE,
+                      REPLAY, REPLAY_FROM, REPLAY_RANGE, STATS_PROMETHEUS, COMPRESSED, FILTER,
+                      QOS, QOS_OPTIONS, LANES, CONSUME, CONSUME_OPTIONS, DELIVER, DELIVERY, DELIVERY_ID, HEARTBEAT,
+                      SESSION,
+                      FrameDecoder, decode_ack, recv_frames, send_frame)
+from compression import CODECS, decompress
+
+SEND_LOCK = threading.Lock()  # The listener thread answers heartbeats and deliveries while the prompt sends
+
+def send(client_socket, opcode, topic=b'', payload=b''):
+    # sendall from two threads at once could interleave their bytes mid-frame
+    with SEND_LOCK:
+        send_frame(client_socket, opcode, topic, payload)
 
 def listen_for_messages(client_socket):
+    decoder = FrameDecoder()
+    codec = None  # Set by the broker's HELLO reply to our codec offer
     while True:
         try:
-            data = client_socket.recv(1024).decode()
-            if data:
-                print(f"\n{data}")
-                print(" -> ", end="", flush=True)
+            frames = recv_frames(client_socket, decoder)
+            if frames is None:
+                break
+            for opcode, topic, payload in frames:
+                if opcode == HEARTBEAT:
+                    send(client_socket, HEARTBEAT)  # Still here; the broker reaps connections that go quiet
+                    continue
+                if opcode == HELLO:
+                    codec = payload.decode(FORMAT) or None
+                    print(f"\n[COMPRESSION] {codec or 'none'}")
+                    continue
+                if opcode == COMPRESSED:
+                    opcode, payload = MESSAGE, decompress(codec, payload)
+                if opcode == MESSAGE:
+                    print(f"\n[FROM PUBLISHER on {topic}]: {payload.decode(FORMAT, errors='replace')}")
+                elif opcode == DELIVER:
+                    # Acknowledged delivery: settle it once printed, or the broker hands it out again
+                    delivery_id, attempt = DELIVERY.unpack_from(payload)
+                    message = payload[DELIVERY.size:].decode(FORMAT, errors='replace')
+                    print(f"\n[DELIVERY {delivery_id} on {topic}{f', attempt {attempt}' if attempt > 1 else ''}]: {message}")
+                    send(client_socket, ACK, payload=DELIVERY_ID.pack(delivery_id))
+                elif opcode == REPLAY:
+                    first, end = REPLAY_RANGE.unpack(payload)
+                    print(f"\n[REPLAY {topic}] offsets {first} to {end - 1} follow, live messages start at {end}")
+                elif opcode == SESSION:
+                    print(f"\n[SESSION {payload.decode(FORMAT)}] {topic} (pass it as the session argument to resume)")
+                elif opcode == ACK:
+                    seq, text = decode_ack(payload)
+                    print(f"\nServer response: {topic} #{seq} - {text}")
+                elif opcode == ERROR:
+                    print(f"\nServer error: {payload.decode(FORMAT)}")
+            print(" -> ", end="", flush=True)
         except:
             break
 
-def client_program(host='localhost', port=5000, role='SUBSCRIBER', topic=''):
+def client_program(host='localhost', port=5000, role='SUBSCRIBER', topic='', content_filter='', session=''):
     client_socket = socket.socket()  # Create a socket object
     
     try:
         client_socket.connect((host, port))  # Connect to the server
-        details = role + " " + topic
-        client_socket.send(details.encode())
-        #client_socket.send(topic.encode())
+        # Subscribers offer every codec available here; the broker picks one and says which
+        # With a session ('new', or the token of an earlier one) the broker keeps our subscriptions across
+        # reconnects and broker restarts, and resuming restores them without re-subscribing
+        hello_topic = '' if content_filter else topic
+        hello = f"{role} {','.join(CODECS)} {session}".rstrip() if role == 'SUBSCRIBER' else role
+        send(client_socket, HELLO, hello_topic, hello)
+        if role == 'SUBSCRIBER' and content_filter:
+            # Filter first, then the patterns, so not a single unfiltered message gets through
+            send(client_socket, FILTER, payload=content_filter)
+            for pattern in filter(None, topic.split(",")):
+                send(client_socket, SUBSCRIBE, pattern)
         
         print(f"Connected as {role}")
         
         if role == 'SUBSCRIBER':
             print(f"You are a subscriber on topic: {topic}. You will receive messages from publishers.")
-            print("Type 'terminate' to disconnect.")
+            print("Topics are dot-separated: '*' matches one level and '#' any number of levels (e.g. sports.*, sports.#).")
+            print("Type 'subscribe <pattern>' or 'unsubscribe <pattern>' to change topics, 'terminate' to disconnect.")
+            print("Type 'subscribe <topic> <offset>' to replay a topic from the broker's log before live messages.")
+            print("Type 'consume <pattern> [group] [window]' for acknowledged delivery, shared with the other members of group.")
+            print("Type 'filter <expression>' (e.g. filter region == \"eu\" and priority >= 3) to only get matching JSON "
+                  "messages, 'filter' alone to get everything again.")
             print("Listening for messages...")
             
             # Start listening for messages in a separate thread
@@ -36,30 +92,66 @@ def client_program(host='localhost', port=5000, role='SUBSCRIBER', topic=''):
             # Keep the client alive and allow termination
             while True:
                 message = input(" -> ")
+                command, _, pattern = message.strip().partition(" ")
                 if message.lower().strip() == 'terminate':
-                    client_socket.send(message.encode())
+                    send(client_socket, TERMINATE)
                     break
-                elif message.strip():  # If user types something other than terminate
+                elif command.lower() == 'subscribe' and pattern:
+                    # 'subscribe <topic> <offset>' resumes from the broker's durable log
+                    pattern, _, offset = pattern.strip().partition(" ")
+                    resume = REPLAY_FROM.pack(int(offset)) if offset.strip().isdigit() else b''
+                    send(client_socket, SUBSCRIBE, pattern, resume)
+                elif command.lower() == 'unsubscribe' and pattern:
+                    send(client_socket, UNSUBSCRIBE, pattern.strip())
+                elif command.lower() == 'consume' and pattern:
+                    pattern, group, window = (pattern.split() + ['', '100'])[:3]
+                    send(client_socket, CONSUME, pattern,
+                               CONSUME_OPTIONS.pack(int(window) if window.isdigit() else 100, 0) + group.encode(FORMAT))
+                elif command.lower() == 'filter':
+                    send(client_socket, FILTER, payload=pattern.strip())
+                elif message.strip():  # If user types something other than a command
                     print("Subscribers can only listen to messages. Type 'terminate' to exit.")
                     
         elif role == 'PUBLISHER':
             print(f"You are a publisher on topic: {topic}. Your messages will be sent to subscribers of this topic.")
+            print("Type 'qos <high|normal|low> [ttl_ms]' to set the priority and lifetime of the next messages.")
             print("Type 'terminate' to disconnect.")
             
+            # Acks, errors and heartbeats are read in the background, so sitting at the prompt doesn't look idle
+            listener_thread = threading.Thread(target=listen_for_messages, args=(client_socket,))
+            listener_thread.daemon = True
+            listener_thread.start()
+            
             while True:
                 message = input(" -> ")
+                command, _, options = message.strip().partition(" ")
                 if message.lower().strip() == 'terminate':
-                    client_socket.send(message.encode())
+                    send(client_socket, TERMINATE)
                     break
+                elif command.lower() == 'qos' and (not options.strip() or options.split()[0].lower() in LANES):
+                    # Other lines starting with 'qos' are published like any message
+                    lane, ttl = (options.split() + ['', '0'])[:2]
+                    if lane.lower() not in LANES or not ttl.isdigit() or int(ttl) >= 2 ** 32 or len(options.split()) > 2:
+                        print("Usage: qos <high|normal|low> [ttl_ms]")
+                        continue
+                    # No reply unless it's rejected; it applies to the messages that follow
+                    send(client_socket, QOS, topic, QOS_OPTIONS.pack(LANES.index(lane.lower()), int(ttl)))
                 else:
-                    client_socket.send(message.encode())  # Send the message to the server
-                    try:
-                        data = client_socket.recv(1024).decode()
-                        print(f"Server response: {data}")
-                    except:
-                        break
+                    send(client_socket, PUBLISH, topic, message)  # Send the message to the server
+        elif role == 'MONITOR':
+            # One-shot query of the broker's counters; topic 'prometheus' asks for the text format
+            send(client_socket, STATS, payload=STATS_PROMETHEUS if topic == 'prometheus' else b'')
+            decoder = FrameDecoder()
+            frames = []
+            while not frames:
+                frames = recv_frames(client_socket, decoder)
+                if frames is None:
+                    raise ConnectionError("server closed the connection")
+            for _, _, payload in frames:
+                print(f"Broker stats: {payload.decode(FORMAT)}")
+            send(client_socket, TERMINATE)
         else:
-            print("Invalid role. Use PUBLISHER or SUBSCRIBER")
+            print("Invalid role. Use PUBLISHER, SUBSCRIBER or MONITOR")
             
     except Exception as e:
         print(f"Error: {e}")
@@ -73,9 +165,11 @@ if __name__ == '__main__':
     
     # Validate topic argument
     if len(sys.argv) < 5:
-        print("Usage: python client.py <host> <port> <role> <topic>")
-        print("Example: python client.py localhost 5000 SUBSCRIBER sports")
+        print("Usage: python client.py <host> <port> <role> <topic> [filter] [session: new|<token>]")
+        print("Example: python client.py localhost 5000 SUBSCRIBER sports.*,news.# 'region == \"eu\"'")
         sys.exit(1)
     
     topic = sys.argv[4]
-    client_program(host, port, role, topic)
\ No newline at end of file
+    content_filter = sys.argv[5] if len(sys.argv) > 5 else ''
+    session = sys.argv[6] if len(sys.argv) > 6 else ''
+    client_program(host, port, role, topic, content_filter, session)
\ No newline at end of file
@@ -0,0 +1,121 @@
+import sys
+import socket
+import asyncio
+import broker
+import async_server
+from metrics import log, INFO
+from protocol import HELLO, MESSAGE, SUBSCRIBE, UNSUBSCRIBE, HEARTBEAT, QOS, QOS_OPTIONS, NORMAL, FrameDecoder, encode_frame, encode_prefix
+from outbound import POLICIES
+
+RECONNECT_DELAY = 1.0  # Seconds before redialling a peer node that is down
+
+
+class Federation:
+    """Links one broker node to the other nodes of a cluster.
+
+    The node dials every peer and identifies as a PEER. Over that link it
+    sends SUBSCRIBE/UNSUBSCRIBE for the distinct patterns its local
+    subscribers and consumer groups hold, and the peer sends back only the
+    MESSAGE frames published on it that match them. Messages received from
+    a peer go to local subscribers and groups only, so with a full mesh every publish makes at most
+    one hop and is never broadcast to nodes without interest."""
+
+    def __init__(self, name, peers):
+        self.name = name
+        self.peers = peers          # [(host, port)] of the other nodes
+        self.links = {}             # {(host, port): StreamWriter} for links that are up
+        self.advertised = set()     # Patterns the peers currently know this node wants
+        self.tasks = []
+        self.stats = {'received': 0, 'interest_updates': 0, 'reconnects': 0}
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._link(host, port)) for host, port in self.peers]
+
+    def interest_changed(self, pattern, interested):
+        if interested == (pattern in self.advertised):
+            return
+        if interested:
+            self.advertised.add(pattern)
+        else:
+            self.advertised.discard(pattern)
+        frame = encode_frame(SUBSCRIBE if interested else UNSUBSCRIBE, pattern)
+        for writer in self.links.values():
+            writer.write(frame)
+        self.stats['interest_updates'] += 1
+
+    async def _link(self, host, port):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError:
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            # Handshake and the full interest set go out before the link is visible to
+            # interest_changed, with no await in between, so no update can be missed
+            writer.write(encode_frame(HELLO, self.name, "PEER"))
+            for pattern in self.advertised:
+                writer.write(encode_frame(SUBSCRIBE, pattern))
+            self.links[(host, port)] = writer
+            log(INFO, f"[FEDERATION] Linked to {host}:{port}")
+            try:
+                await self._receive(reader, writer)
+            except ConnectionError:
+                pass
+            finally:
+                self.links.pop((host, port), None)
+                writer.close()
+            log(INFO, f"[FEDERATION] Lost {host}:{port}, reconnecting")
+            self.stats['reconnects'] += 1
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _receive(self, reader, writer):
+        decoder = FrameDecoder()
+        qos = (NORMAL, 0)  # Lane and TTL of the next MESSAGE only
+        while True:
+            data = await reader.read(async_server.READ_SIZE)
+            if not data:
+                return
+            for opcode, topic, payload in decoder.feed(data):
+                if opcode == MESSAGE:
+                    self.stats['received'] += 1
+                    broker.deliver_relayed((encode_prefix(MESSAGE, topic, len(payload)), payload), topic, *qos)
+                    qos = (NORMAL, 0)
+                elif opcode == QOS:
+                    qos = QOS_OPTIONS.unpack(payload)
+                elif opcode == HEARTBEAT:
+                    writer.write(encode_frame(HEARTBEAT))  # The peer reaps links that stay silent
+
+    def snapshot(self):
+        return dict(self.stats, node=self.name, links=[f"{host}:{port}" for host, port in self.links],
+                    advertised=sorted(self.advertised))
+
+
+async def node_program(port, host, peers):
+    federation = Federation(f"{host}:{port}", peers)
+    broker.FEDERATION = federation
+    federation.start()
+    await async_server.server_program(port, host)
+
+
+def parse_peers(text):
+    peers = []
+    for item in filter(None, text.split(",")):
+        peer_host, _, peer_port = item.rpartition(":")
+        peers.append((peer_host or "127.0.0.1", int(peer_port)))
+    return peers
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print(f"Usage: python federation.py <port> <host> <peer_host:port,...> <queue_limit> <{'|'.join(POLICIES)}>")
+        sys.exit(1)
+    port = int(sys.argv[1])
+    host = sys.argv[2] or socket.gethostbyname(socket.gethostname())
+    peers = parse_peers(sys.argv[3])
+    broker.QUEUE_LIMIT = int(sys.argv[4]) if len(sys.argv) > 4 else broker.QUEUE_LIMIT
+    broker.OVERFLOW_POLICY = sys.argv[5] if len(sys.argv) > 5 else broker.OVERFLOW_POLICY
+    print(f"[SERVER STARTING] cluster node on port {port} with {len(peers)} peer(s)")
+    try:
+        asyncio.run(node_program(port, host, peers))
+    except KeyboardInterrupt:
+        print("[SERVER STOPPED]")
@@ -0,0 +1,91 @@
+import time
+import random
+import argparse
+from filters import FilterIndex, parse, _key
+
+REGIONS = ("eu", "us", "apac", "latam", "mea")
+KINDS = ("order", "refund", "quote", "cancel")
+
+
+def random_filter(rng):
+    clauses = [f'region == "{rng.choice(REGIONS)}"']
+    if rng.random() < 0.7:
+        clauses.append(f"priority {rng.choice(('>=', '>', '<', '<='))} {rng.randrange(10)}")
+    if rng.random() < 0.4:
+        clauses.append(f"kind in ({', '.join(repr(kind) for kind in rng.sample(KINDS, 2))})")
+    if rng.random() < 0.3:
+        clauses.append(f"meta.amount > {rng.randrange(1000)}")
+    if rng.random() < 0.2:
+        clauses.append(f'meta.source != "test"')
+    return " and ".join(clauses)
+
+
+def random_document(rng):
+    return {"region": rng.choice(REGIONS), "priority": rng.randrange(10), "kind": rng.choice(KINDS),
+            "meta": {"amount": rng.randrange(1000), "source": rng.choice(("web", "app", "test"))}}
+
+
+def naive_match(conjunctions, document):
+    # What evaluating every subscriber's predicates one by one would cost
+    def holds(field, op, value):
+        current = document
+        for part in field.split('.'):
+            if not isinstance(current, dict) or part not in current:
+                return False
+            current = current[part]
+        current = _key(current)
+        if current is None:
+            return False
+        if op == '==':
+            return current == value
+        if op == '!=':
+            return current != value
+        if current[0] != value[0]:
+            return False
+        return {'<': current[1] < value[1], '<=': current[1] <= value[1],
+                '>': current[1] > value[1], '>=': current[1] >= value[1]}[op]
+
+    return any(all(holds(*predicate) for predicate in conjunction) for conjunction in conjunctions)
+
+
+def run(filters, documents, naive_limit, seed):
+    rng = random.Random(seed)
+    index = FilterIndex()
+    expressions = [random_filter(rng) for _ in range(filters)]
+
+    started = time.perf_counter()
+    for number, expression in enumerate(expressions):
+        index.set(number, expression)
+    build_time = time.perf_counter() - started
+
+    document_list = [random_document(rng) for _ in range(documents)]
+    started = time.perf_counter()
+    matched = sum(len(index.match(document)) for document in document_list)
+    index_time = (time.perf_counter() - started) / documents
+    stats = index.snapshot()
+
+    print(f"[INDEX] {filters} filters ({stats['predicates']} distinct predicates) compiled in {build_time:.2f}s; "
+          f"{index_time * 1e6:.1f} us per publish, {matched / documents:.1f} matches on average")
+
+    if naive_limit:
+        compiled = [parse(expression) for expression in expressions]
+        sample = document_list[:naive_limit]
+        started = time.perf_counter()
+        naive = [{number for number, conjunctions in enumerate(compiled) if naive_match(conjunctions, document)}
+                 for document in sample]
+        naive_time = (time.perf_counter() - started) / len(sample)
+        agree = all(index.match(document) == expected for document, expected in zip(sample, naive))
+        print(f"[SCAN] {naive_time * 1e6:.1f} us per publish over {len(sample)} publishes "
+              f"({naive_time / index_time:.0f}x slower), results agree: {agree}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the compiled content-filter index against evaluating each filter")
+    parser.add_argument("--filters", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--documents", type=int, default=2000, help="published payloads to match")
+    parser.add_argument("--naive-limit", type=int, default=50, help="publishes to time with per-filter evaluation (0 to skip)")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    for filters in args.filters:
+        run(filters, args.documents, args.naive_limit, args.seed)
@@ -0,0 +1,337 @@
+import re
+import ast
+import json
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+
+# A filter is a boolean expression over the fields of a JSON object payload:
+#   region == "eu" and priority >= 3
+#   (kind == "order" or kind == "refund") and meta.source != "test"
+#   region in ("eu", "us")
+# Dotted names reach into nested objects. Comparisons on a missing field are false.
+MAX_CONJUNCTIONS = 64  # Cap on the and-of-ors expansion, so one filter can't blow up the index
+
+EQUALITY = ('==', '!=')
+RANGES = ('<', '<=', '>', '>=')
+TOKEN = re.compile(r'''\s*(?:(?P<number>-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)|(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|'''
+                   r'''(?P<op>==|!=|<=|>=|<|>|\(|\)|,)|(?P<name>[A-Za-z_][\w.]*))''')
+LITERALS = {'true': True, 'false': False, 'null': None}
+
+
+class FilterError(ValueError):
+    pass
+
+
+def _tokens(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if not match:
+            raise FilterError(f"unexpected input at {expression[position:position + 10]!r}")
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'number':
+            tokens.append(('value', float(text) if any(c in text for c in '.eE') else int(text)))
+        elif kind == 'string':
+            tokens.append(('value', ast.literal_eval(text)))
+        elif kind == 'name' and text in LITERALS:
+            tokens.append(('value', LITERALS[text]))
+        elif kind == 'name' and text in ('and', 'or', 'in'):
+            tokens.append(('op', text))
+        else:
+            tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    # Recursive descent straight into disjunctive normal form: a list of
+    # conjunctions, each a frozenset of (field, op, value) predicates
+
+    def __init__(self, expression):
+        self.tokens = _tokens(expression)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, kind=None, text=None):
+        token = self.peek()
+        if token[0] is None or (kind and token[0] != kind) or (text and token[1] != text):
+            raise FilterError(f"expected {text or kind}, got {token[1]!r}")
+        self.position += 1
+        return token[1]
+
+    def parse(self):
+        conjunctions = self.disjunction()
+        if self.position != len(self.tokens):
+            raise FilterError(f"unexpected {self.peek()[1]!r}")
+        return conjunctions
+
+    def disjunction(self):
+        conjunctions = self.conjunction()
+        while self.peek() == ('op', 'or'):
+            self.take()
+            conjunctions = conjunctions + self.conjunction()
+            self.check(conjunctions)
+        return conjunctions
+
+    def conjunction(self):
+        conjunctions = self.term()
+        while self.peek() == ('op', 'and'):
+            self.take()
+            right = self.term()
+            conjunctions = [left | other for left in conjunctions for other in right]
+            self.check(conjunctions)
+        return conjunctions
+
+    def term(self):
+        if self.peek() == ('op', '('):
+            self.take()
+            conjunctions = self.disjunction()
+            self.take('op', ')')
+            return conjunctions
+        field = self.take('name')
+        op = self.take('op')
+        if op == 'in':
+            # field in (a, b) is field == a or field == b
+            self.take('op', '(')
+            values = [self.take('value')]
+            while self.peek() == ('op', ','):
+                self.take()
+                values.append(self.take('value'))
+            self.take('op', ')')
+            return [frozenset({(field, '==', _key(value))}) for value in values]
+        if op not in EQUALITY + RANGES:
+            raise FilterError(f"expected a comparison after {field!r}, got {op!r}")
+        value = self.take('value')
+        if op in RANGES and _key(value)[0] not in ('n', 's'):
+            raise FilterError(f"{op} needs a number or a string, got {value!r}")
+        return [frozenset({(field, op, _key(value))})]
+
+    @staticmethod
+    def check(conjunctions):
+        if len(conjunctions) > MAX_CONJUNCTIONS:
+            raise FilterError(f"filter expands to more than {MAX_CONJUNCTIONS} alternatives")
+
+
+def parse(expression):
+    """The filter as a list of conjunctions (frozensets of (field, op, value)
+    predicates); it matches a document when every predicate of any one holds."""
+    return _Parser(expression).parse()
+
+
+def _key(value):
+    # Values are compared within their JSON type, so true never equals 1 and "3" never equals 3
+    if isinstance(value, bool):
+        return ('b', value)
+    if isinstance(value, (int, float)):
+        return ('n', value)
+    if isinstance(value, str):
+        return ('s', value)
+    if value is None:
+        return ('z', None)
+    return None  # Arrays and objects only ever satisfy nothing
+
+
+def parse_document(payload):
+    """The JSON object a payload carries, or None if it isn't one."""
+    try:
+        document = json.loads(bytes(payload))  # Batched messages arrive as memoryviews
+    except (ValueError, UnicodeDecodeError):
+        return None
+    return document if isinstance(document, dict) else None
+
+
+class _Field:
+    __slots__ = ('name', 'path', 'equal', 'not_equal', 'ranges')
+
+    def __init__(self, name):
+        self.name = name
+        self.path = name.split('.')
+        self.equal = set()      # Values of the == predicates on this field
+        self.not_equal = set()  # Values of the != predicates
+        self.ranges = {}        # {(op, type): sorted thresholds}
+
+    def lookup(self, document):
+        value = document
+        for part in self.path:
+            if not isinstance(value, dict) or part not in value:
+                return None
+            value = value[part]
+        return _key(value)
+
+    def satisfied(self, value, satisfied):
+        # Adds the predicates on this field that hold for value, found by hashing and bisection
+        name = self.name
+        if value in self.equal:
+            satisfied.add((name, '==', value))
+        for other in self.not_equal:
+            if other != value:
+                satisfied.add((name, '!=', other))
+        kind, number = value
+        for (op, threshold_kind), thresholds in self.ranges.items():
+            if threshold_kind != kind:
+                continue
+            if op == '>':
+                matched = thresholds[:bisect_left(thresholds, number)]
+            elif op == '>=':
+                matched = thresholds[:bisect_right(thresholds, number)]
+            elif op == '<':
+                matched = thresholds[bisect_right(thresholds, number):]
+            else:
+                matched = thresholds[bisect_left(thresholds, number):]
+            for threshold in matched:
+                satisfied.add((name, op, (kind, threshold)))
+
+    def add(self, op, value):
+        if op == '==':
+            self.equal.add(value)
+        elif op == '!=':
+            self.not_equal.add(value)
+        else:
+            insort(self.ranges.setdefault((op, value[0]), []), value[1])
+
+    def discard(self, op, value):
+        if op == '==':
+            self.equal.discard(value)
+        elif op == '!=':
+            self.not_equal.discard(value)
+        else:
+            thresholds = self.ranges[(op, value[0])]
+            thresholds.remove(value[1])
+            if not thresholds:
+                del self.ranges[(op, value[0])]
+
+    def empty(self):
+        return not (self.equal or self.not_equal or self.ranges)
+
+
+class FilterIndex:
+    """Content filters of many subscribers compiled into one shared index.
+
+    Every filter is expanded to conjunctions of predicates. Each distinct
+    predicate is indexed once per field, however many filters use it:
+    equality by a hash lookup on the value, ranges by bisecting a sorted
+    threshold list. Identical conjunctions are stored once with all the
+    filters that contain them, and every conjunction hangs off one anchor
+    predicate (an equality where it has one, as those are the most
+    selective). Matching a document computes the set of predicates it
+    satisfies, then only tests the conjunctions anchored on those, so the
+    cost follows what the document satisfies rather than the number of
+    filters.
+
+    Filters are keyed by subscriber (any hashable). All access goes through
+    one lock, as with TopicIndex."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.filters = {}       # {key: (expression, [conjunctions])}
+        self.conjunctions = {}  # {conjunction: {keys}}
+        self.anchored = defaultdict(set)  # {anchor predicate: {conjunctions}}
+        self.predicates = defaultdict(int)  # {predicate: conjunctions using it}
+        self.fields = {}        # {field name: _Field}
+        self.stats = {'documents': 0, 'predicates_satisfied': 0, 'conjunctions_tested': 0, 'matches': 0}
+
+    def __contains__(self, key):
+        return key in self.filters
+
+    def __len__(self):
+        return len(self.filters)
+
+    def set(self, key, expression):
+        """Install (or replace) the filter of key; a blank expression removes it.
+        Raises FilterError, leaving the old filter in place, if it doesn't parse."""
+        if not isinstance(expression, str):
+            # JSON callers can send any type here; that is a bad filter, not a crash
+            raise FilterError(f"a filter is a string expression, not {type(expression).__name__}")
+        conjunctions = parse(expression) if expression.strip() else None
+        with self.lock:
+            self._remove(key)
+            if conjunctions is None:
+                return
+            for conjunction in conjunctions:
+                keys = self.conjunctions.get(conjunction)
+                if keys is None:
+                    keys = self.conjunctions[conjunction] = set()
+                    self._index(conjunction)
+                keys.add(key)
+            self.filters[key] = (expression, conjunctions)
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _index(self, conjunction):
+        for predicate in conjunction:
+            if not self.predicates[predicate]:
+                name, op, value = predicate
+                field = self.fields.get(name)
+                if field is None:
+                    field = self.fields[name] = _Field(name)
+                field.add(op, value)
+            self.predicates[predicate] += 1
+        self.anchored[self._anchor(conjunction)].add(conjunction)
+
+    @staticmethod
+    def _anchor(conjunction):
+        # Deterministic, so removal finds the same anchor
+        return min(conjunction, key=lambda predicate: (predicate[1] != '==', repr(predicate)))
+
+    def _remove(self, key):
+        entry = self.filters.pop(key, None)
+        if entry is None:
+            return
+        for conjunction in entry[1]:
+            keys = self.conjunctions[conjunction]
+            keys.discard(key)
+            if keys:
+                continue
+            del self.conjunctions[conjunction]
+            anchor = self._anchor(conjunction)
+            self.anchored[anchor].discard(conjunction)
+            if not self.anchored[anchor]:
+                del self.anchored[anchor]
+            for predicate in conjunction:
+                self.predicates[predicate] -= 1
+                if not self.predicates[predicate]:
+                    del self.predicates[predicate]
+                    name, op, value = predicate
+                    field = self.fields[name]
+                    field.discard(op, value)
+                    if field.empty():
+                        del self.fields[name]
+
+    def match(self, document):
+        """Keys of the filters the document (a dict, or None) satisfies."""
+        matched = set()
+        if document is None:
+            return matched
+        with self.lock:
+            satisfied = set()
+            for field in self.fields.values():
+                value = field.lookup(document)
+                if value is not None:
+                    field.satisfied(value, satisfied)
+            tested = 0
+            for predicate in satisfied:
+                conjunctions = self.anchored.get(predicate)
+                if conjunctions is None:
+                    continue
+                tested += len(conjunctions)
+                for conjunction in conjunctions:
+                    if conjunction <= satisfied:
+                        matched |= self.conjunctions[conjunction]
+            self.stats['documents'] += 1
+            self.stats['predicates_satisfied'] += len(satisfied)
+            self.stats['conjunctions_tested'] += tested
+            self.stats['matches'] += len(matched)
+        return matched
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, filters=len(self.filters), conjunctions=len(self.conjunctions),
+                        predicates=len(self.predicates), fields=len(self.fields))
@@ -0,0 +1,205 @@
+import time
+import threading
+from collections import deque
+from protocol import DELIVER, DELIVERY, NORMAL, encode_prefix
+from topic_index import TopicIndex
+from metrics import Stamped
+
+ACK_TIMEOUT = 30.0      # Seconds a delivery may stay unacknowledged before it is handed out again
+SWEEP_INTERVAL = 1.0    # Seconds between checks for deliveries that timed out
+GROUP_BACKLOG = 100000  # Messages a group holds while every member's window is full
+
+
+class _Member:
+    __slots__ = ('queue', 'window', 'timeout', 'inflight', 'in_order')
+
+    def __init__(self, queue, window, timeout):
+        self.queue = queue
+        self.window = window
+        self.timeout = timeout
+        self.inflight = {}  # {delivery id: (parts, topic, attempt, redeliver at)}, in delivery order
+        self.in_order = True  # Delivery order is also redeliver-at order, until a re-join shortens the timeout
+
+
+class ConsumerGroup:
+    __slots__ = ('pattern', 'name', 'members', 'backlog', 'turn', 'stats')
+
+    def __init__(self, pattern, name):
+        self.pattern = pattern
+        self.name = name        # '' for the private group of a single acknowledged subscriber
+        self.members = {}       # {address: _Member}
+        self.backlog = deque()  # [(parts, topic, attempt)] waiting for window space
+        self.turn = 0           # Round-robin position among the members
+        self.stats = {'offered': 0, 'delivered': 0, 'acked': 0, 'redelivered': 0, 'dropped': 0}
+
+    def next_free(self):
+        # The next member, round-robin, with room in its window
+        addresses = list(self.members)
+        for step in range(len(addresses)):
+            address = addresses[(self.turn + step) % len(addresses)]
+            member = self.members[address]
+            if len(member.inflight) < member.window:
+                self.turn = (self.turn + step + 1) % len(addresses)
+                return address, member
+        return None, None
+
+
+class ConsumerGroups:
+    """Acknowledged, load-balanced delivery.
+
+    A consumer joins a group on a topic pattern with an in-flight window.
+    Each publish matching the pattern goes to one member of every such
+    group, round-robin among the members with window space, as a DELIVER
+    frame carrying a delivery id; it stays in that member's in-flight set
+    until the member ACKs the id. Deliveries not acked within the member's
+    timeout, and everything in flight on a member that leaves, go back to
+    the front of the group's backlog and are handed out again under a new
+    id with a higher attempt number: at-least-once, so consumers should
+    tolerate duplicates. While every window is full, messages wait in the
+    group's bounded backlog.
+
+    An unnamed group belongs to one connection and goes away with it; a
+    named group keeps its backlog while members come and go. All access
+    goes through one lock, so threaded handlers can share it."""
+
+    def __init__(self, metrics=None, backlog=GROUP_BACKLOG):
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        self.backlog_limit = backlog
+        self.index = TopicIndex()  # {pattern: {group key: ConsumerGroup}}
+        self.groups = {}           # {(pattern, name): ConsumerGroup}
+        self.memberships = {}      # {address: {group keys}}
+        self.owners = {}           # {delivery id: (group, address)}
+        self.next_id = 0
+
+    def __bool__(self):
+        return bool(self.groups)
+
+    def join(self, address, queue, pattern, name='', window=100, timeout=ACK_TIMEOUT):
+        key = (pattern, name or f"{address[0]}:{address[1]}")
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = ConsumerGroup(pattern, name)
+                self.index.add(pattern, key, group)
+            member = group.members.get(address)
+            if member is None:
+                group.members[address] = _Member(queue, window, timeout)
+            else:
+                # Joining again only changes the settings; what is in flight stays owed by this member
+                if timeout < member.timeout and member.inflight:
+                    member.in_order = False  # New deliveries can now come due before older ones
+                member.queue, member.window, member.timeout = queue, window, timeout
+            self.memberships.setdefault(address, set()).add(key)
+            self._pump(group)
+
+    def leave(self, address, pattern=None):
+        """Drop address from its groups (only those on pattern, if given); its
+        unacknowledged deliveries go to the remaining members. Returns the
+        patterns of the groups it left."""
+        with self.lock:
+            keys = self.memberships.get(address, set())
+            left = [key for key in keys if pattern is None or key[0] == pattern]
+            for key in left:
+                keys.discard(key)
+                group = self.groups[key]
+                member = group.members.pop(address)
+                self._requeue(group, member, list(member.inflight))
+                if not group.members and not group.name:
+                    del self.groups[key]
+                    self.index.remove(group.pattern, key)
+                else:
+                    self._pump(group)
+            if not keys:
+                self.memberships.pop(address, None)
+            return {key[0] for key in left}
+
+    def offer(self, parts, topic):
+        """Hand one published (prefix, payload) to every group whose pattern
+        matches topic. Returns the number of groups that took it."""
+        with self.lock:
+            groups = self.index.subscribers(topic)
+            for _, group in groups:
+                group.stats['offered'] += 1
+                if len(group.backlog) >= self.backlog_limit:
+                    group.backlog.popleft()
+                    group.stats['dropped'] += 1
+                    self._count('group_backlog_dropped')
+                group.backlog.append((parts, topic, 1))
+                self._pump(group)
+            return len(groups)
+
+    def ack(self, address, delivery_ids):
+        with self.lock:
+            touched = set()
+            acked = 0
+            for delivery_id in delivery_ids:
+                owner = self.owners.get(delivery_id)
+                if owner is None or owner[1] != address:
+                    continue  # Already redelivered elsewhere, or not this consumer's
+                group, _ = owner
+                del self.owners[delivery_id]
+                member = group.members.get(address)
+                if member is None or member.inflight.pop(delivery_id, None) is None:
+                    continue  # Stale bookkeeping; never worth failing the consumer's connection over
+                group.stats['acked'] += 1
+                acked += 1
+                touched.add(group)
+            for group in touched:
+                self._pump(group)
+            self._count('deliveries_acked', acked)
+
+    def sweep(self, now=None):
+        """Hand out again every delivery whose ack timeout has passed."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            for group in self.groups.values():
+                for member in group.members.values():
+                    expired = []
+                    for delivery_id, (_, _, _, redeliver_at) in member.inflight.items():
+                        if redeliver_at <= now:
+                            expired.append(delivery_id)
+                        elif member.in_order:
+                            break  # Deliveries are due in the order they went out, so the rest are later
+                    if expired:
+                        self._requeue(group, member, expired)
+                    if not member.inflight:
+                        member.in_order = True
+                self._pump(group)
+
+    def _requeue(self, group, member, delivery_ids):
+        # Back to the front of the backlog, in their original order, with the attempt bumped
+        for delivery_id in reversed(delivery_ids):
+            parts, topic, attempt, _ = member.inflight.pop(delivery_id)
+            self.owners.pop(delivery_id, None)
+            group.backlog.appendleft((parts, topic, attempt + 1))
+        group.stats['redelivered'] += len(delivery_ids)
+        self._count('redeliveries', len(delivery_ids))
+
+    def _pump(self, group):
+        while group.backlog:
+            address, member = group.next_free()
+            if member is None:
+                return
+            parts, topic, attempt = group.backlog.popleft()
+            self.next_id += 1
+            delivery_id = self.next_id
+            payload = parts[1]
+            # The payload object is shared as in fan-out; only the header and delivery id are per member
+            prefix = encode_prefix(DELIVER, topic, DELIVERY.size + len(payload)) + DELIVERY.pack(delivery_id, attempt)
+            frame = Stamped((prefix, payload), getattr(parts, 'received', None))
+            member.inflight[delivery_id] = (parts, topic, attempt, time.monotonic() + member.timeout)
+            self.owners[delivery_id] = (group, address)
+            member.queue.put(frame, NORMAL)
+            group.stats['delivered'] += 1
+
+    def _count(self, name, amount=1):
+        if self.metrics is not None and amount:
+            self.metrics.add(name, amount)
+
+    def snapshot(self):
+        with self.lock:
+            return {f"{group.name or 'private'}@{group.pattern}" + ('' if group.name else f"#{number}"):
+                    dict(group.stats, members=len(group.members), backlog=len(group.backlog),
+                         inflight=sum(len(member.inflight) for member in group.members.values()))
+                    for number, group in enumerate(self.groups.values())}
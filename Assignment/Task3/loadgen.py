@@ -0,0 +1,530 @@
+import os
+import re
+import sys
+import json
+import time
+import socket
+import argparse
+import selectors
+import threading
+import subprocess
+import http.client
+from itertools import cycle
+from collections import Counter
+from protocol import (HELLO, MESSAGE, COMPRESSED, CONSUME, CONSUME_OPTIONS, DELIVER, DELIVERY, ACK, HEARTBEAT,
+                      FrameDecoder, encode_frame, send_frame)
+from publisher import Publisher
+from metrics import Histogram
+from compression import CODECS, decompress
+from benchmark import raise_file_limit, query_stats
+
+try:
+    import orjson  # Same codec the Demo server picks, so the client side isn't what we measure
+    json_dumps, json_loads = orjson.dumps, orjson.loads
+except ImportError:
+    json_dumps, json_loads = json.dumps, json.loads
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(os.path.dirname(HERE))
+SERVERS = {
+    'task2': [os.path.join(ROOT, 'Assignment', 'Task2', 'server.py')],
+    'threaded': [os.path.join(HERE, 'server.py')],
+    'async': [os.path.join(HERE, 'async_server.py')],
+    'demo': [os.path.join(ROOT, 'Demo', 'server.py')],
+}
+
+# Every payload starts with its send time, so any subscriber can compute end-to-end latency.
+# Task2 has no framing, so its subscribers find stamps by pattern in the byte stream.
+STAMP = b"LG%019d;"
+STAMP_SIZE = len(STAMP % 0)
+STAMP_PATTERN = re.compile(rb"LG(\d{19});")
+TASK2_MAX_PAYLOAD = 1000  # Task2 reads with recv(1024) and treats each read as one message
+
+
+def payload_bodies(kind, size):
+    # What follows the stamp: 'filler' is plain 'x' (it can never look like a stamp), 'json'
+    # is the kind of repetitive JSON our topics carry, for realistic compression numbers
+    size = max(size - STAMP_SIZE, 0)
+    if kind == 'filler':
+        return cycle([b"x" * size])
+    bodies = []
+    for variant in range(16):
+        records = []
+        while len(json.dumps(records)) < size:
+            number = len(records) + variant
+            records.append({"id": number, "region": ("eu", "us", "apac")[number % 3], "priority": number % 5,
+                            "sensor": f"temp-{number * 7 % 100:03d}", "value": round(20 + number * 0.37 % 5, 2)})
+        bodies.append(json.dumps(records).encode()[:size])
+    return cycle(bodies)
+
+
+def make_payload(bodies):
+    return STAMP % time.time_ns() + next(bodies)
+
+
+class Results:
+    """Shared tallies of one run. Latencies go into a lock-free Histogram in microseconds."""
+
+    def __init__(self, warmup_until):
+        self.warmup_until = warmup_until  # ns timestamp; messages sent before it aren't timed
+        self.latency = Histogram()
+        self.lock = threading.Lock()
+        self.published = Counter()        # {topic: publishes}
+        self.delivered = 0
+        self.bytes_received = 0   # Wire bytes read by Task2/Task3 subscribers
+        self.reader_cpu = 0.0     # CPU seconds spent in subscriber reader threads
+        self.errors = []
+
+    def received(self, stamp, now):
+        if stamp >= self.warmup_until:
+            self.latency.record((now - stamp) // 1000)
+        with self.lock:
+            self.delivered += 1
+
+    def add_reader(self, received, cpu):
+        with self.lock:
+            self.bytes_received += received
+            self.reader_cpu += cpu
+
+    def add_published(self, topic, count):
+        with self.lock:
+            self.published[topic] += count
+
+    def failed(self, error):
+        with self.lock:
+            self.errors.append(str(error))
+
+
+def paced(rate, duration, stop):
+    # Yields once per message at `rate` per second (unthrottled if 0) until duration is up
+    started = time.monotonic()
+    deadline = started + duration
+    sent = 0
+    while not stop.is_set():
+        now = time.monotonic()
+        if now >= deadline:
+            return
+        if rate:
+            due = started + sent / rate
+            if due > now:
+                time.sleep(due - now)
+        yield
+        sent += 1
+
+
+# Task2: role handshake as raw text, broadcast to every subscriber, a text reply per publish
+
+def task2_subscribe(args, topic):
+    sock = socket.create_connection((args.host, args.port))
+    sock.sendall(b"SUBSCRIBER")
+    time.sleep(0.05)  # Task2 reads the role with a bare recv, so keep it out of the next read
+    return sock
+
+
+def task2_publish(args, topic, results, stop):
+    sock = socket.create_connection((args.host, args.port))
+    sock.sendall(b"PUBLISHER")
+    time.sleep(0.05)
+    threading.Thread(target=drain_socket, args=(sock,), daemon=True).start()
+    bodies = payload_bodies(args.payload_kind, min(args.payload_size, TASK2_MAX_PAYLOAD))
+    count = 0
+    try:
+        for _ in paced(args.rate, args.duration, stop):
+            sock.sendall(make_payload(bodies))
+            count += 1
+            if not args.rate:
+                time.sleep(0)  # Let the ack reader run; Task2 answers every publish
+    finally:
+        results.add_published(topic, count)
+        sock.close()
+
+
+def drain_socket(sock):
+    try:
+        while sock.recv(65536):
+            pass
+    except OSError:
+        pass
+
+
+def task2_reader(sockets, results, stop):
+    selector = selectors.DefaultSelector()
+    tails = {}
+    for sock in sockets:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+        tails[sock] = b""
+    cpu = time.thread_time()
+    received = 0
+    while not stop.is_set():
+        for key, _ in selector.select(timeout=0.2):
+            try:
+                data = key.fileobj.recv(1 << 18)
+            except BlockingIOError:
+                continue
+            if not data:
+                selector.unregister(key.fileobj)
+                continue
+            now = time.time_ns()
+            received += len(data)
+            buffer = tails[key.fileobj] + data
+            end = 0
+            for match in STAMP_PATTERN.finditer(buffer):
+                results.received(int(match.group(1)), now)
+                end = match.end()
+            # Keep just enough unmatched bytes for a stamp split across reads
+            tails[key.fileobj] = buffer[max(end, len(buffer) - STAMP_SIZE):]
+    results.add_reader(received, time.thread_time() - cpu)
+
+
+# Task3: framed protocol with topics; publishers use the pipelined Publisher API
+
+def task3_subscribe(args, topic):
+    sock = socket.create_connection((args.host, args.port))
+    role = f"SUBSCRIBER {args.codec}" if args.codec else "SUBSCRIBER"
+    if args.window:
+        # The subscribers of a topic share one consumer group and ack every delivery
+        send_frame(sock, HELLO, "", role)
+        send_frame(sock, CONSUME, topic, CONSUME_OPTIONS.pack(args.window, 0) + b"loadgen")
+    else:
+        send_frame(sock, HELLO, topic, role)
+    return sock
+
+
+def task3_publish(args, topic, results, stop):
+    publisher = Publisher(args.host, args.port, topic, max_batch=args.batch,
+                          flush_interval=args.flush_interval if args.batch > 1 else 0)
+    bodies = payload_bodies(args.payload_kind, args.payload_size)
+    count = 0
+    try:
+        for _ in paced(args.rate, args.duration, stop):
+            publisher.publish(make_payload(bodies))
+            count += 1
+        publisher.wait_for_ack(timeout=30)
+    finally:
+        results.add_published(topic, count)
+        publisher.close()
+
+
+def task3_reader(sockets, results, stop):
+    selector = selectors.DefaultSelector()
+    codecs = {}  # {socket: codec the broker picked}
+    for sock in sockets:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, FrameDecoder())
+    cpu = time.thread_time()
+    received = 0
+    while not stop.is_set():
+        for key, _ in selector.select(timeout=0.2):
+            try:
+                data = key.fileobj.recv(1 << 18)
+            except BlockingIOError:
+                continue
+            if not data:
+                selector.unregister(key.fileobj)
+                continue
+            now = time.time_ns()
+            received += len(data)
+            settled = []
+            answers = b""
+            for opcode, _, payload in key.data.feed(data):
+                if opcode == HEARTBEAT:
+                    answers += encode_frame(HEARTBEAT)  # Long runs would otherwise get reaped as idle
+                    continue
+                if opcode == DELIVER:
+                    settled.append(payload[:8])  # The delivery id, acked below in one frame per read
+                    opcode, payload = MESSAGE, payload[DELIVERY.size:]
+                if opcode == HELLO:
+                    codecs[key.fileobj] = payload.decode() or None
+                    continue
+                if opcode == COMPRESSED:
+                    opcode, payload = MESSAGE, decompress(codecs[key.fileobj], payload)
+                if opcode == MESSAGE and payload[:2] == b"LG":
+                    results.received(int(payload[2:STAMP_SIZE - 1]), now)
+            if settled or answers:
+                key.fileobj.setblocking(True)
+                key.fileobj.sendall((encode_frame(ACK, payload=b"".join(settled)) if settled else b"") + answers)
+                key.fileobj.setblocking(False)
+    results.add_reader(received, time.thread_time() - cpu)
+
+
+# Demo: JSON over HTTP; subscribers long-poll /receive/<name> or hold an SSE stream
+
+def demo_request(connection, method, path, body=None):
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    connection.request(method, path, body=None if body is None else json_dumps(body), headers=headers)
+    response = connection.getresponse()
+    data = response.read()
+    if response.status != 200:
+        raise RuntimeError(f"{method} {path}: HTTP {response.status}")
+    return json_loads(data) if data else None
+
+
+def demo_publish(args, topic, results, stop):
+    connection = http.client.HTTPConnection(args.host, args.port, timeout=30)
+    bodies = payload_bodies(args.payload_kind, args.payload_size)
+    count = 0
+    batch = []
+    try:
+        for _ in paced(args.rate, args.duration, stop):
+            message = make_payload(bodies).decode()
+            if args.demo_batch == 1:
+                demo_request(connection, 'POST', '/publish', {'topic': topic, 'message': message})
+                count += 1
+                continue
+            batch.append(message)
+            if len(batch) == args.demo_batch:
+                demo_request(connection, 'POST', '/publish/batch', {'topic': topic, 'messages': batch})
+                count += len(batch)
+                batch = []
+        if batch:
+            demo_request(connection, 'POST', '/publish/batch', {'topic': topic, 'messages': batch})
+            count += len(batch)
+    finally:
+        results.add_published(topic, count)
+        connection.close()
+
+
+def demo_subscriber(args, name, topic, results, stop, subscribed):
+    try:
+        connection = http.client.HTTPConnection(args.host, args.port, timeout=None)
+        demo_request(connection, 'POST', '/subscribe', {'name': name, 'topic': topic})
+        if args.demo_mode == 'stream':
+            demo_stream(args, name, results, stop, subscribed)
+            return
+        subscribed.set()
+        while not stop.is_set():
+            # /receive waits for something to arrive, then returns up to max pending messages
+            reply = demo_request(connection, 'GET', f'/receive/{name}?max={max(100, args.demo_batch)}&timeout=1')
+            now = time.time_ns()
+            for message in reply.get('messages', [reply.get('message')]):
+                match = STAMP_PATTERN.match((message or "").encode())
+                if match:
+                    results.received(int(match.group(1)), now)
+    except Exception as e:
+        subscribed.set()
+        if not stop.is_set():
+            results.failed(e)
+
+
+def demo_stream(args, name, results, stop, subscribed):
+    connection = http.client.HTTPConnection(args.host, args.stream_port, timeout=None)
+    connection.request('GET', f'/stream/{name}')
+    response = connection.getresponse()
+    subscribed.set()
+    while not stop.is_set():
+        line = response.fp.readline()
+        if not line:
+            return
+        if line.startswith(b"data: "):
+            now = time.time_ns()
+            match = STAMP_PATTERN.match(json.loads(line[6:])['message'].encode())
+            if match:
+                results.received(int(match.group(1)), now)
+
+
+TARGETS = {
+    'task2': (task2_subscribe, task2_publish, task2_reader),
+    'task3': (task3_subscribe, task3_publish, task3_reader),
+    'demo': (None, demo_publish, None),
+}
+
+
+def spawn_broker(args):
+    # Starts the target broker with its logs discarded, then waits for its port
+    kind = args.spawn
+    command = [sys.executable] + SERVERS[kind]
+    cwd = None
+    if kind == 'task2':
+        command.append(str(args.port))
+        args.host = socket.gethostbyname(socket.gethostname())  # Task2 binds the hostname's address
+    elif kind == 'demo':
+        cwd = os.path.dirname(SERVERS['demo'][0])  # Flask serves on 5000 and streams on 5001
+    else:
+        command += [str(args.port), args.host, str(1 << 20)]
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               env=dict(os.environ, PUBSUB_LOG_LEVEL='warning'))
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            socket.create_connection((args.host, args.port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{kind} broker did not start on {args.host}:{args.port}")
+
+
+def broker_usage(pid):
+    # CPU seconds (user + system) and memory from procfs; Linux only
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    memory = {}
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM", "Threads"):
+                memory[key] = int(value.split()[0])
+    return cpu, memory
+
+
+def run(args):
+    stop = threading.Event()
+    results = Results(time.time_ns() + int(args.warmup * 1e9))
+    topics = [f"{args.topic_prefix}.{number}" for number in range(args.topics)]
+    subscribe, publish, reader = TARGETS[args.target]
+
+    # Subscriber i listens on topic i % K, publisher j sends on topic j % K
+    audience = Counter(topics[number % len(topics)] for number in range(args.subscribers))
+    readers = []
+    if args.target == 'demo':
+        for number in range(args.subscribers):
+            subscribed = threading.Event()
+            thread = threading.Thread(target=demo_subscriber, daemon=True,
+                                      args=(args, f"loadgen-{number}", topics[number % len(topics)],
+                                            results, stop, subscribed))
+            thread.start()
+            subscribed.wait(10)
+            readers.append(thread)
+    else:
+        sockets = [subscribe(args, topics[number % len(topics)]) for number in range(args.subscribers)]
+        shards = [sockets[offset::args.reader_threads] for offset in range(args.reader_threads)]
+        for shard in filter(None, shards):
+            thread = threading.Thread(target=reader, args=(shard, results, stop), daemon=True)
+            thread.start()
+            readers.append(thread)
+    time.sleep(args.settle)
+
+    before = broker_usage(args.broker_pid) if args.broker_pid else None
+    started = time.monotonic()
+    publishers = [threading.Thread(target=publish, args=(args, topics[number % len(topics)], results, stop))
+                  for number in range(args.publishers)]
+    for thread in publishers:
+        thread.start()
+    for thread in publishers:
+        thread.join()
+    publish_time = time.monotonic() - started
+
+    # Task2 ignores topics and broadcasts every publish to every subscriber
+    if args.target == 'task2':
+        expected = sum(results.published.values()) * args.subscribers
+    elif args.target == 'task3' and args.window:
+        expected = sum(count for topic, count in results.published.items() if audience[topic])  # One per group
+    else:
+        expected = sum(count * audience[topic] for topic, count in results.published.items())
+    deadline = time.monotonic() + args.drain
+    while results.delivered < expected and time.monotonic() < deadline:
+        time.sleep(0.05)
+    elapsed = time.monotonic() - started
+    after = broker_usage(args.broker_pid) if args.broker_pid else None
+    stop.set()
+    for thread in readers:
+        if args.target != 'demo':
+            thread.join(1)  # Reader threads report bytes and CPU on the way out
+    broker_stats = query_stats(args.host, args.port) if args.target == 'task3' else None
+
+    published = sum(results.published.values())
+    latency = results.latency.summary()
+    report = {
+        'target': args.target,
+        'publishers': args.publishers, 'subscribers': args.subscribers, 'topics': args.topics,
+        'payload_size': args.payload_size, 'payload_kind': args.payload_kind, 'rate': args.rate,
+        'window': args.window, 'demo_batch': args.demo_batch,
+        'published': published, 'publish_rate': round(published / publish_time, 1),
+        'delivered': results.delivered, 'expected': expected,
+        'delivery_rate': round(results.delivered / elapsed, 1),
+        'latency_ms': {key: round(latency[key] / 1000, 3) for key in ('p50', 'p99', 'p99.9', 'max', 'mean')
+                       if key in latency},
+        'errors': results.errors[:5],
+    }
+    if args.target != 'demo':
+        report['subscriber_bytes'] = results.bytes_received
+        report['subscriber_cpu_seconds'] = round(results.reader_cpu, 3)
+    if broker_stats:
+        report['codec'] = args.codec
+        before_compression = broker_stats.get('bytes_before_compression', 0)
+        report['compression'] = {
+            'ratio': round(broker_stats.get('bytes_after_compression', 0) / before_compression, 3)
+            if before_compression else None,
+            'broker_cpu_seconds': round(broker_stats.get('compress_ns', 0) / 1e9, 3),
+        }
+    if before and after:
+        report['broker'] = {'cpu_percent': round((after[0] - before[0]) / elapsed * 100, 1),
+                            'rss_kib': after[1]['VmRSS'], 'peak_rss_kib': after[1]['VmHWM'],
+                            'threads': after[1]['Threads']}
+    return report
+
+
+def print_report(report):
+    tag = f"[{report['target'].upper()}]"
+    print(f"{tag} {report['publishers']} publishers -> {report['subscribers']} subscribers over "
+          f"{report['topics']} topics, {report['payload_size']}-byte payloads")
+    print(f"{tag} published {report['published']} ({report['publish_rate']:.0f} msg/s), delivered "
+          f"{report['delivered']}/{report['expected']} ({report['delivery_rate']:.0f} msg/s)")
+    latency = report['latency_ms']
+    print(f"{tag} end-to-end latency p50 {latency.get('p50', 0)} ms, p99 {latency.get('p99', 0)} ms, "
+          f"p99.9 {latency.get('p99.9', 0)} ms, max {latency.get('max', 0)} ms")
+    if 'subscriber_bytes' in report:
+        print(f"{tag} subscribers read {report['subscriber_bytes'] / 1e6:.1f} MB using "
+              f"{report['subscriber_cpu_seconds']}s CPU")
+    if report.get('codec'):
+        compression = report['compression']
+        print(f"{tag} {report['codec']}: compressed to {compression['ratio']} of the original size, "
+              f"{compression['broker_cpu_seconds']}s broker CPU compressing")
+    if 'broker' in report:
+        broker = report['broker']
+        print(f"{tag} broker CPU {broker['cpu_percent']}%, RSS {broker['rss_kib']} KiB "
+              f"(peak {broker['peak_rss_kib']} KiB), {broker['threads']} threads")
+    for error in report['errors']:
+        print(f"{tag} error: {error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless load generator for the Task2, Task3 and Demo brokers")
+    parser.add_argument("--target", choices=sorted(TARGETS), default="task3")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--publishers", type=int, default=4)
+    parser.add_argument("--subscribers", type=int, default=16)
+    parser.add_argument("--topics", type=int, default=4)
+    parser.add_argument("--topic-prefix", default="load")
+    parser.add_argument("--payload-size", type=int, default=64)
+    parser.add_argument("--payload-kind", choices=["filler", "json"], default="filler",
+                        help="'json' sends repetitive JSON records, for compression runs")
+    parser.add_argument("--codec", choices=sorted(CODECS), help="Task3 subscribers offer this payload codec")
+    parser.add_argument("--window", type=int, default=0,
+                        help="Task3 subscribers consume in one acked consumer group per topic with this in-flight window")
+    parser.add_argument("--rate", type=float, default=1000, help="messages per second per publisher (0 = as fast as possible)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of publishing")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds at the start left out of the latency histogram")
+    parser.add_argument("--drain", type=float, default=5, help="seconds to wait for deliveries after publishing stops")
+    parser.add_argument("--settle", type=float, default=0.5, help="seconds between subscribing and publishing")
+    parser.add_argument("--batch", type=int, default=1, help="Task3 Publisher max_batch")
+    parser.add_argument("--flush-interval", type=float, default=0.005)
+    parser.add_argument("--reader-threads", type=int, default=2, help="threads reading Task2/Task3 subscriber sockets")
+    parser.add_argument("--demo-batch", type=int, default=1,
+                        help="Demo messages per /publish/batch request (1 = one /publish per message)")
+    parser.add_argument("--demo-mode", choices=["poll", "stream"], default="poll",
+                        help="Demo subscribers long-poll /receive or hold a Server-Sent Events stream")
+    parser.add_argument("--stream-port", type=int, default=5001)
+    parser.add_argument("--broker-pid", type=int, help="PID of a running broker, for CPU and RSS")
+    parser.add_argument("--spawn", choices=sorted(SERVERS), help="start this broker for the run (Task3: threaded or async)")
+    parser.add_argument("--json", action="store_true", help="print the report as one JSON line for regression tracking")
+    args = parser.parse_args()
+
+    raise_file_limit()
+    process = None
+    if args.spawn:
+        process = spawn_broker(args)
+        args.broker_pid = process.pid
+    try:
+        report = run(args)
+    finally:
+        if process:
+            process.kill()
+            process.wait()
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print_report(report)
@@ -0,0 +1,80 @@
+import time
+import random
+import argparse
+from topic_index import TopicIndex, SEPARATOR, ONE_LEVEL, ANY_LEVELS
+
+
+def random_topic(rng, depth, fanout):
+    return SEPARATOR.join(f"l{level}n{rng.randrange(fanout)}" for level in range(depth))
+
+
+def random_pattern(rng, depth, fanout, wildcard_ratio):
+    levels = random_topic(rng, depth, fanout).split(SEPARATOR)
+    if rng.random() < wildcard_ratio:
+        position = rng.randrange(depth)
+        if rng.random() < 0.5:
+            levels[position] = ONE_LEVEL
+        else:
+            levels = levels[:position] + [ANY_LEVELS]
+    return SEPARATOR.join(levels)
+
+
+def naive_match(pattern, topic):
+    # The per-pattern test a linear scan would have to run for every publish
+    pattern_levels = pattern.split(SEPARATOR)
+    topic_levels = topic.split(SEPARATOR)
+
+    def match(p, t):
+        if p == len(pattern_levels):
+            return t == len(topic_levels)
+        if pattern_levels[p] == ANY_LEVELS:
+            return any(match(p + 1, rest) for rest in range(t, len(topic_levels) + 1))
+        if t == len(topic_levels):
+            return False
+        return pattern_levels[p] in (ONE_LEVEL, topic_levels[t]) and match(p + 1, t + 1)
+
+    return match(0, 0)
+
+
+def run(patterns, topics, depth, fanout, wildcard_ratio, naive_limit, seed):
+    rng = random.Random(seed)
+    index = TopicIndex()
+    pattern_list = [random_pattern(rng, depth, fanout, wildcard_ratio) for _ in range(patterns)]
+
+    started = time.perf_counter()
+    for number, pattern in enumerate(pattern_list):
+        index.add(pattern, ('subscriber', number), None)
+    build_time = time.perf_counter() - started
+
+    topic_list = [random_topic(rng, depth, fanout) for _ in range(topics)]
+    started = time.perf_counter()
+    matched = sum(len(index.subscribers(topic)) for topic in topic_list)
+    trie_time = (time.perf_counter() - started) / topics
+
+    print(f"[TRIE] {patterns} patterns indexed in {build_time:.2f}s; "
+          f"{trie_time * 1e6:.1f} us per publish, {matched / topics:.1f} matches and "
+          f"{index.stats['nodes_visited'] / topics:.1f} trie nodes visited on average")
+
+    if naive_limit:
+        sample = topic_list[:naive_limit]
+        started = time.perf_counter()
+        naive_matched = sum(sum(1 for pattern in pattern_list if naive_match(pattern, topic)) for topic in sample)
+        naive_time = (time.perf_counter() - started) / len(sample)
+        trie_sample = sum(len(index.subscribers(topic)) for topic in sample)
+        print(f"[SCAN] {naive_time * 1e6:.1f} us per publish over {len(sample)} publishes "
+              f"({naive_time / trie_time:.0f}x slower), results agree: {naive_matched == trie_sample}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark wildcard topic matching against a linear scan")
+    parser.add_argument("--patterns", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--topics", type=int, default=10000, help="published topics to match")
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--fanout", type=int, default=20, help="distinct names per topic level")
+    parser.add_argument("--wildcard-ratio", type=float, default=0.3)
+    parser.add_argument("--naive-limit", type=int, default=20, help="publishes to time with the linear scan (0 to skip)")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    for patterns in args.patterns:
+        run(patterns, args.topics, args.depth, args.fanout, args.wildcard_ratio, args.naive_limit, args.seed)
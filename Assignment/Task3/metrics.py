@@ -0,0 +1,207 @@
+import os
+import time
+import threading
+from collections import defaultdict
+from protocol import LANES as LANE_NAMES
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+# Per-message lines ([PUBLISHER], [SUBSCRIBE], ...) are DEBUG, so the default keeps stdout off the hot path
+LOG_LEVEL = LEVELS.get(os.environ.get('PUBSUB_LOG_LEVEL', 'info').lower(), INFO)
+
+SUB_BUCKET_BITS = 6  # Histogram buckets keep 6 significant bits: values within ~3% share a bucket
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def enabled(level):
+    # Check before building an expensive message: log(DEBUG, f"...") still formats the f-string
+    return level >= LOG_LEVEL
+
+
+def log(level, message):
+    if level >= LOG_LEVEL:
+        print(message)
+
+
+def set_level(name):
+    global LOG_LEVEL
+    LOG_LEVEL = LEVELS[name.lower()]
+
+
+class Counters:
+    """Named counters that are bumped without taking a lock.
+
+    Each thread increments its own dict and snapshot() adds the shards up,
+    so handler threads never contend on a shared counter. Shards of threads
+    that have exited are folded into a retired total on the next snapshot."""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()   # Only taken when a thread registers its shard, and by snapshot
+        self.shards = []               # [(thread, shard)]
+        self.retired = defaultdict(int)
+
+    def _shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = defaultdict(int)
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    def add(self, name, amount=1):
+        self._shard()[name] += amount
+
+    def snapshot(self):
+        with self.lock:
+            live = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    for name, value in list(shard.items()):
+                        self.retired[name] += value
+            self.shards = live
+            totals = defaultdict(int, self.retired)
+        for _, shard in live:
+            for name, value in list(shard.items()):
+                totals[name] += value
+        return dict(totals)
+
+
+class Histogram(Counters):
+    """HDR-style latency histogram over integer microseconds.
+
+    Values below 2**SUB_BUCKET_BITS get a bucket each; above that every
+    power of two is split into 2**(SUB_BUCKET_BITS - 1) equal buckets, so
+    the relative error stays bounded from microseconds to minutes with a
+    few hundred buckets. Recording is one lock-free counter bump."""
+
+    def record(self, value):
+        value = max(int(value), 0)
+        exponent = max(value.bit_length() - SUB_BUCKET_BITS, 0)
+        shard = self._shard()
+        shard[(exponent << (SUB_BUCKET_BITS - 1)) + (value >> exponent)] += 1
+        shard['sum'] += value
+
+    @staticmethod
+    def bucket_bounds(bucket):
+        half = 1 << (SUB_BUCKET_BITS - 1)
+        if bucket < 2 * half:
+            return bucket, bucket + 1
+        exponent = bucket // half - 1
+        mantissa = bucket - exponent * half
+        return mantissa << exponent, (mantissa + 1) << exponent
+
+    def summary(self):
+        counts = self.snapshot()
+        total = counts.pop('sum', 0)
+        buckets = sorted(counts.items())
+        count = sum(counts.values())
+        summary = {'count': count, 'mean': total / count if count else 0}
+        seen = 0
+        pending = list(QUANTILES)
+        for bucket, bucket_count in buckets:
+            seen += bucket_count
+            while pending and seen >= pending[0] * count:
+                # Report the bucket's upper bound, so percentiles never understate latency
+                summary[f"p{pending.pop(0) * 100:g}"] = self.bucket_bounds(bucket)[1]
+        summary['max'] = self.bucket_bounds(buckets[-1][0])[1] if buckets else 0
+        return summary
+
+
+class Stamped(tuple):
+    """The buffers of one encoded frame, tagged with the time the broker received the publish.
+
+    Subscriber writers iterate it like any other queued frame and record
+    publish-to-deliver latency once the buffers have been handed to the socket."""
+
+    def __new__(cls, parts, received=None):
+        stamped = super().__new__(cls, parts)
+        stamped.received = time.perf_counter_ns() if received is None else received
+        return stamped
+
+
+class Metrics:
+    """Broker instrumentation: counters, per-topic publish/delivery counts and
+    publish-to-deliver latency, exposed as a dict for STATS or as Prometheus text."""
+
+    def __init__(self, names=()):
+        self.names = names  # Counters reported as 0 before their first increment
+        self.counters = Counters()
+        self.topic_publishes = Counters()
+        self.topic_deliveries = Counters()
+        self.latency = Histogram()
+        self.queue_delay = {}  # {lane: Histogram} of time from publish to leaving a subscriber queue
+        self.started = time.monotonic()
+        self.rate_lock = threading.Lock()
+        self.last_rates = (self.started, {})  # Totals at the previous snapshot, for per-topic rates
+
+    def add(self, name, amount=1):
+        self.counters.add(name, amount)
+
+    def published(self, topic, deliveries):
+        self.topic_publishes.add(topic)
+        self.topic_deliveries.add(topic, deliveries)
+
+    def delivered(self, items):
+        # Called by subscriber writers after a send, with the queue items it carried
+        now = time.perf_counter_ns()
+        for item in items:
+            if type(item) is Stamped:
+                self.latency.record((now - item.received) // 1000)
+
+    def queued(self, lane, delay_ns):
+        histogram = self.queue_delay.get(lane)
+        if histogram is None:
+            histogram = self.queue_delay.setdefault(lane, Histogram())
+        histogram.record(delay_ns // 1000)
+
+    def snapshot(self):
+        now = time.monotonic()
+        publishes = self.topic_publishes.snapshot()
+        deliveries = self.topic_deliveries.snapshot()
+        with self.rate_lock:
+            last_time, last_publishes = self.last_rates
+            self.last_rates = (now, publishes)
+        interval = max(now - last_time, 1e-9)
+        topics = {topic: {'publishes': count,
+                          'deliveries': deliveries.get(topic, 0),
+                          'publishes_per_second': round((count - last_publishes.get(topic, 0)) / interval, 1)}
+                  for topic, count in publishes.items()}
+        counters = dict.fromkeys(self.names, 0)
+        counters.update(self.counters.snapshot())
+        return {'uptime': round(now - self.started, 1), 'counters': counters,
+                'topics': topics, 'latency_us': self.latency.summary(),
+                'queue_delay_us': {LANE_NAMES[lane]: histogram.summary()
+                                   for lane, histogram in sorted(self.queue_delay.items())}}
+
+    def prometheus(self, extra=None):
+        """Prometheus text exposition of snapshot() plus any extra {name: value} gauges."""
+        snapshot = self.snapshot()
+        lines = [f"pubsub_uptime_seconds {snapshot['uptime']}"]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"pubsub_{name}_total {value}")
+        for name, value in sorted((extra or {}).items()):
+            lines.append(f"pubsub_{name} {value}")
+        for topic, counts in sorted(snapshot['topics'].items()):
+            label = topic.replace('\\', '\\\\').replace('"', '\\"')
+            lines.append(f'pubsub_topic_publishes_total{{topic="{label}"}} {counts["publishes"]}')
+            lines.append(f'pubsub_topic_deliveries_total{{topic="{label}"}} {counts["deliveries"]}')
+        lines.append("# TYPE pubsub_deliver_latency_seconds summary")
+        lines.extend(self._summary_lines('pubsub_deliver_latency_seconds', '', snapshot['latency_us']))
+        lines.append("# TYPE pubsub_queue_delay_seconds summary")
+        for lane, delay in snapshot['queue_delay_us'].items():
+            lines.extend(self._summary_lines('pubsub_queue_delay_seconds', f'lane="{lane}",', delay))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _summary_lines(name, labels, summary):
+        for quantile in QUANTILES:
+            value = summary.get(f"p{quantile * 100:g}", 0)
+            yield f'{name}{{{labels}quantile="{quantile:g}"}} {value / 1e6:.6f}'
+        suffix = f"{{{labels.rstrip(',')}}}" if labels else ""
+        yield f"{name}_sum{suffix} {summary['mean'] * summary['count'] / 1e6:.6f}"
+        yield f"{name}_count{suffix} {summary['count']}"
+
@@ -0,0 +1,128 @@
+import time
+import threading
+from collections import deque
+from protocol import HIGH, LANES
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+DRAIN_BATCH = 256  # Frames per take(), so an urgent frame never waits behind a whole backlog
+
+
+class OutboundQueue:
+    """Bounded per-subscriber queue of encoded frames, drained by that
+    subscriber's own writer so a slow consumer only ever delays itself.
+
+    Frames wait in one FIFO lane per priority (HIGH, NORMAL, LOW); control
+    frames and log replays default to HIGH. take() drains the lanes in
+    priority order, at most DRAIN_BATCH frames at a time, and discards
+    frames whose deadline (perf_counter_ns) has passed before they cost
+    any bandwidth. With metrics, take() records the queueing delay of each
+    stamped frame and counts expirations per lane.
+
+    When the queue is full the overflow policy decides what happens:
+    drop-oldest evicts the head of the lowest-priority lane (or the
+    incoming frame, if everything queued is more urgent), drop-newest
+    discards the incoming frame, and disconnect makes put() return False
+    so the broker can close the slow consumer. Threaded writers block in
+    take(); event-loop writers pass on_ready and call take(timeout=0) when
+    it fires, until the queue is empty. codec is the payload codec the
+    subscriber negotiated, which picks the frame variant the broker queues
+    for it."""
+
+    def __init__(self, conn, limit=1024, policy=DROP_OLDEST, on_ready=None, codec=None, metrics=None):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown overflow policy '{policy}', expected one of {POLICIES}")
+        self.conn = conn
+        self.limit = limit
+        self.policy = policy
+        self.on_ready = on_ready
+        self.codec = codec
+        self.metrics = metrics
+        self.lanes = [deque() for _ in LANES]  # [(item, deadline or None)] per priority
+        self.depth = 0
+        self.closed = False
+        self.ready = threading.Condition()
+        self.stats = {'enqueued': 0, 'dequeued': 0, 'dropped': 0, 'expired': 0, 'high_water': 0}
+
+    def put(self, item, lane=HIGH, deadline=None):
+        with self.ready:
+            if self.closed:
+                return False
+            if self.depth >= self.limit:
+                self.stats['dropped'] += 1
+                if self.policy == DROP_NEWEST:
+                    return True
+                if self.policy == DISCONNECT:
+                    self.closed = True
+                    self.ready.notify()
+                    return False
+                victim = max(number for number, queued in enumerate(self.lanes) if queued)
+                if victim < lane:
+                    return True  # Everything queued is more urgent than the incoming frame
+                self.lanes[victim].popleft()
+                self.depth -= 1
+            self.lanes[lane].append((item, deadline))
+            self.depth += 1
+            self.stats['enqueued'] += 1
+            if self.depth > self.stats['high_water']:
+                self.stats['high_water'] = self.depth
+            self.ready.notify()
+        if self.on_ready:
+            self.on_ready()
+        return True
+
+    def take(self, timeout=None, limit=DRAIN_BATCH):
+        """Pop up to limit unexpired frames, most urgent lane first, so the
+        writer can send them in one go. Returns None once the queue is
+        closed and empty."""
+        with self.ready:
+            if not self.depth and not self.closed and timeout != 0:
+                self.ready.wait(timeout)
+            if not self.depth:
+                return None if self.closed else []
+            now = time.perf_counter_ns()
+            items = []
+            for lane, queued in enumerate(self.lanes):
+                expired = 0
+                while queued and len(items) < limit:
+                    item, deadline = queued.popleft()
+                    self.depth -= 1
+                    if deadline is not None and deadline < now:
+                        expired += 1
+                        continue
+                    items.append(item)
+                    if self.metrics is not None and hasattr(item, 'received'):
+                        self.metrics.queued(lane, now - item.received)
+                if expired:
+                    self.stats['expired'] += expired
+                    if self.metrics is not None:
+                        self.metrics.add(f"expired_{LANES[lane]}", expired)
+            self.stats['dequeued'] += len(items)
+            return items
+
+    def attach(self, conn, policy, on_ready=None, codec=None):
+        # A queue that held a detached session's messages becomes a live connection's queue
+        with self.ready:
+            self.conn = conn
+            self.policy = policy
+            self.on_ready = on_ready
+            self.codec = codec
+            pending = self.depth
+        if pending and on_ready:
+            on_ready()
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        if self.on_ready:
+            self.on_ready()
+
+    def snapshot(self):
+        with self.ready:
+            stats = dict(self.stats)
+            stats['depth'] = self.depth
+            stats['lanes'] = {name: len(queued) for name, queued in zip(LANES, self.lanes)}
+        return stats
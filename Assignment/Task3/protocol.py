@@ -0,0 +1,252 @@
+import os
+import struct
+
+FORMAT = 'utf-8'
+
+# Every frame is HEADER followed by the topic bytes and then the payload bytes:
+#   payload length (4 bytes) | opcode (1 byte) | topic length (2 bytes)
+HEADER = struct.Struct('!IBH')
+MAX_PAYLOAD = 16 * 1024 * 1024  # Frames larger than this are treated as a protocol error
+RECV_BUFFER = 16 * 1024   # Initial per-connection receive buffer; grows while reads keep filling it
+MAX_RECV_BUFFER = 256 * 1024  # Largest buffer kept between frames (bigger frames grow it temporarily)
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024  # Buffers per sendmsg call
+
+# Opcodes
+HELLO = 1      # client -> broker, topic = published topic or comma-separated patterns,
+               # payload = role, optionally followed by a space and the codecs it accepts ("SUBSCRIBER zlib,lz4"),
+               # and by a space and a session token to resume, or SESSION_NEW ("SUBSCRIBER zlib <token>");
+               # broker -> client in reply to an offer, payload = chosen codec ('' for none)
+PUBLISH = 2    # publisher -> broker
+MESSAGE = 3    # broker -> subscriber
+ACK = 4        # broker -> publisher; consumer -> broker, payload = DELIVERY_IDs being settled
+ERROR = 5      # broker -> client
+TERMINATE = 6  # client -> broker
+STATS = 7      # client -> broker request, broker -> client JSON reply (payload STATS_PROMETHEUS: text dump)
+BATCH = 8      # publisher -> broker, payload = several length-prefixed messages
+SUBSCRIBE = 9     # subscriber -> broker, topic = extra topic pattern, optional payload = REPLAY_FROM
+UNSUBSCRIBE = 10  # subscriber -> broker, topic = pattern to drop
+REPLAY = 11       # broker -> subscriber, payload = REPLAY_RANGE, sent before the replayed messages
+COMPRESSED = 12   # broker -> subscriber, a MESSAGE whose payload uses the codec agreed at HELLO
+FILTER = 13       # subscriber -> broker, payload = content filter over JSON payload fields ('' removes it)
+QOS = 14          # publisher -> broker, payload = QOS_OPTIONS for the messages that follow on this connection
+                  # (between workers and cluster nodes: for the next MESSAGE only)
+CONSUME = 15      # subscriber -> broker, topic = pattern, payload = CONSUME_OPTIONS + group name ('' for none)
+DELIVER = 16      # broker -> consumer, payload = DELIVERY + message; the consumer ACKs the delivery id
+HEARTBEAT = 17    # broker -> idle client, which answers with a HEARTBEAT; silent clients are disconnected
+SESSION = 18      # broker -> subscriber that asked for a session, topic = token, payload = SESSION_RESUMED or SESSION_NEW
+NOTIFY = 19       # broker -> local subscriber, payload = one or more RING_OFFSETs of messages in the shared-memory ring
+
+OPCODES = {HELLO: 'HELLO', PUBLISH: 'PUBLISH', MESSAGE: 'MESSAGE',
+           ACK: 'ACK', ERROR: 'ERROR', TERMINATE: 'TERMINATE', STATS: 'STATS', BATCH: 'BATCH',
+           SUBSCRIBE: 'SUBSCRIBE', UNSUBSCRIBE: 'UNSUBSCRIBE', REPLAY: 'REPLAY', COMPRESSED: 'COMPRESSED',
+           FILTER: 'FILTER', QOS: 'QOS', CONSUME: 'CONSUME', DELIVER: 'DELIVER',
+           HEARTBEAT: 'HEARTBEAT', SESSION: 'SESSION', NOTIFY: 'NOTIFY'}
+
+# A subscriber asks for a session with SESSION_NEW in HELLO and resumes it later by presenting the
+# token: the broker answers SESSION_RESUMED and restores its patterns, filter and consumer groups
+# (plus whatever was published to them meanwhile), or SESSION_NEW with a fresh token if it has expired
+SESSION_NEW = 'new'
+SESSION_RESUMED = 'resumed'
+
+STATS_PROMETHEUS = b'prometheus'  # STATS request payload asking for Prometheus text instead of JSON
+
+# Every published message gets the next sequence number on its connection (a BATCH of n
+# messages uses n of them). ACK payloads start with the cumulative sequence number: every
+# message up to and including it has been routed.
+ACK_SEQ = struct.Struct('!Q')
+BATCH_ITEM = struct.Struct('!I')
+
+# With a durable log, SUBSCRIBE can resume a concrete topic from an offset. The broker answers
+# with REPLAY (first offset it still has, offset of the first live message), then the logged
+# messages in that range, then live messages: each offset is delivered exactly once.
+REPLAY_FROM = struct.Struct('!Q')
+REPLAY_RANGE = struct.Struct('!QQ')
+
+# Publishers tag messages with a priority lane and a time to live. Subscriber queues drain
+# HIGH before NORMAL before LOW and discard messages that expired while queued.
+QOS_OPTIONS = struct.Struct('!BI')  # lane, TTL in milliseconds (0: never expires)
+HIGH, NORMAL, LOW = 0, 1, 2
+LANES = ('high', 'normal', 'low')
+
+# Acknowledged delivery: CONSUME joins a consumer group with an in-flight window and an ack
+# timeout; each message goes to one member as DELIVER and is redelivered until it is ACKed.
+CONSUME_OPTIONS = struct.Struct('!II')  # window, ack timeout in milliseconds (0: broker default)
+DELIVERY = struct.Struct('!QH')         # delivery id, attempt (1 for the first delivery)
+DELIVERY_ID = struct.Struct('!Q')
+
+# Subscribers on the broker's Unix socket can offer the 'shm' codec: the broker answers HELLO with
+# the name of a shared-memory ring as topic, writes each message there once per publish, and sends
+# those subscribers NOTIFY frames instead of the message (see shm_transport.py).
+RING_OFFSET = struct.Struct('!Q')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def _to_bytes(value):
+    if isinstance(value, str):
+        return value.encode(FORMAT)
+    return bytes(value)
+
+
+def encode_frame(opcode, topic=b'', payload=b''):
+    topic = _to_bytes(topic)
+    payload = _to_bytes(payload)
+    return HEADER.pack(len(payload), opcode, len(topic)) + topic + payload
+
+
+def encode_prefix(opcode, topic, payload_length):
+    # Header and topic only, so a large payload can be sent without concatenating it
+    topic = _to_bytes(topic)
+    return HEADER.pack(payload_length, opcode, len(topic)) + topic
+
+
+def encode_batch(messages):
+    return b''.join(BATCH_ITEM.pack(len(message)) + message
+                    for message in (_to_bytes(message) for message in messages))
+
+
+def split_batch(payload):
+    # Messages come back as memoryview slices of the (immutable) payload, so splitting a
+    # batch copies nothing; queues, the log and sendmsg all take buffers as they are
+    messages = []
+    offset = 0
+    view = memoryview(payload)
+    while offset < len(view):
+        if len(view) - offset < BATCH_ITEM.size:
+            raise ProtocolError("truncated batch item header")
+        (length,) = BATCH_ITEM.unpack_from(view, offset)
+        offset += BATCH_ITEM.size
+        if offset + length > len(view):
+            raise ProtocolError("truncated batch item")
+        messages.append(view[offset:offset + length])
+        offset += length
+    return messages
+
+
+def split_hello(payload):
+    # (role, comma-separated codec offer or '', session token, SESSION_NEW or '')
+    role, codecs, session = (bytes(payload).decode(FORMAT).split(" ", 2) + ['', ''])[:3]
+    return role, codecs, session
+
+
+def encode_ack(seq, text=''):
+    return ACK_SEQ.pack(seq) + _to_bytes(text)
+
+
+def decode_ack(payload):
+    (seq,) = ACK_SEQ.unpack_from(payload)
+    return seq, payload[ACK_SEQ.size:].decode(FORMAT)
+
+
+def send_frame(sock, opcode, topic=b'', payload=b''):
+    sock.sendall(encode_frame(opcode, topic, payload))
+
+
+def send_parts(sock, parts):
+    """Vectored write of already-encoded buffers (e.g. a shared prefix and
+    payload) with sendmsg, resending whatever a partial write left over."""
+    if not hasattr(sock, 'sendmsg'):
+        for part in parts:
+            sock.sendall(part)
+        return
+    views = [memoryview(part) for part in parts if len(part)]
+    while views:
+        sent = sock.sendmsg(views[:IOV_MAX])
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
+
+
+class FrameDecoder:
+    """Streaming decoder over one preallocated receive buffer per connection.
+
+    recv_into() has the socket write straight into the buffer's free tail
+    (feed() copies in data that arrived as bytes, e.g. from asyncio), and
+    every complete frame comes back as (opcode, topic, payload) parsed from
+    memoryview slices. A partial frame stays buffered until the rest
+    arrives. The buffer is only compacted when its tail runs out, and grows
+    while reads keep filling it, up to MAX_RECV_BUFFER."""
+
+    def __init__(self, capacity=RECV_BUFFER):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.start = 0  # First byte not yet parsed
+        self.end = 0    # End of the received data
+        self.topic_bytes = b''  # Last topic seen, so a publisher's repeated topic is decoded once
+        self.topic = ''
+
+    def feed(self, data):
+        self._reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        return self._frames()
+
+    def recv_into(self, sock, size=None):
+        """Read once from sock into the buffer and return the frames completed.
+        Returns None when the peer has closed the connection."""
+        self._reserve(size or self.capacity)
+        with memoryview(self.buffer)[self.end:] as tail:
+            received = sock.recv_into(tail)
+            filled = received == len(tail)
+        if not received:
+            return None
+        self.end += received
+        if filled and self.capacity < MAX_RECV_BUFFER:
+            self.capacity *= 2  # A busy publisher filled the whole tail: read more per call next time
+        return self._frames()
+
+    def _reserve(self, size):
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if self.start:
+            # Move the partial frame to the front instead of allocating
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        if len(self.buffer) - self.end < size:
+            self.buffer.extend(bytes(max(pending + size, self.capacity) - len(self.buffer)))
+
+    def _frames(self):
+        frames = []
+        with memoryview(self.buffer) as view:
+            self.start = self._parse(view, self.start, self.end, frames)
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > max(self.capacity, MAX_RECV_BUFFER):
+                # Give back the room a very large frame needed
+                self.buffer = bytearray(self.capacity)
+        return frames
+
+    def _parse(self, view, offset, end, frames):
+        while end - offset >= HEADER.size:
+            payload_length, opcode, topic_length = HEADER.unpack_from(view, offset)
+            if payload_length > MAX_PAYLOAD:
+                raise ProtocolError(f"frame of {payload_length} bytes exceeds {MAX_PAYLOAD}")
+            if opcode not in OPCODES:
+                raise ProtocolError(f"unknown opcode {opcode}")
+            frame_end = offset + HEADER.size + topic_length + payload_length
+            if frame_end > end:
+                break
+            topic_start = offset + HEADER.size
+            payload_start = topic_start + topic_length
+            topic_view = view[topic_start:payload_start]
+            if topic_view != self.topic_bytes:
+                self.topic_bytes = topic_view.tobytes()
+                self.topic = str(self.topic_bytes, FORMAT)
+            topic_view.release()
+            # The buffer is reused by the next read, so the payload is copied once, into
+            # the bytes object every subscriber queue then shares; it is never decoded
+            payload = view[payload_start:frame_end].tobytes()
+            frames.append((opcode, self.topic, payload))
+            offset = frame_end
+        return offset
+
+
+def recv_frames(sock, decoder, size=None):
+    """Read once from the socket, straight into the decoder's buffer, and return
+    the frames it completed. Returns None when the peer has closed the connection."""
+    return decoder.recv_into(sock, size)
@@ -0,0 +1,147 @@
+import socket
+import threading
+import time
+from protocol import (HELLO, PUBLISH, ACK, ERROR, TERMINATE, BATCH, QOS, QOS_OPTIONS, NORMAL, HEARTBEAT, FORMAT,
+                      FrameDecoder, decode_ack, encode_batch, encode_frame, recv_frames)
+
+
+class Publisher:
+    """Pipelined publisher for the Task3 broker.
+
+    publish() never waits for the broker: messages are numbered, buffered and
+    written as one BATCH frame once max_batch messages are pending or
+    flush_interval seconds have passed. A reader thread consumes the broker's
+    cumulative acks, and at most max_in_flight messages may be unacked before
+    publish() blocks. max_batch=1 with flush_interval=0 sends every message
+    as its own PUBLISH frame straight away (lowest latency).
+
+    Each message can carry a priority lane (HIGH, NORMAL, LOW) and a TTL in
+    milliseconds; a change of either closes the current batch and sends a
+    QOS frame, so runs of messages with the same settings still batch."""
+
+    def __init__(self, host, port, topic, max_batch=100, flush_interval=0.005, max_in_flight=10000):
+        self.topic = topic
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_in_flight = max_in_flight
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(encode_frame(HELLO, topic, "PUBLISHER"))
+
+        self.lock = threading.Condition()
+        self.pending = []       # Messages not yet written to the socket
+        self.next_seq = 0       # Sequence number of the last message handed to publish()
+        self.acked_seq = 0      # Cumulative ack from the broker
+        self.qos = (NORMAL, 0)  # (lane, TTL ms) the broker applies to the next messages
+        self.error = None
+        self.closed = False
+
+        self.reader = threading.Thread(target=self._read_acks, daemon=True)
+        self.reader.start()
+        self.flusher = None
+        if flush_interval > 0:
+            self.flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+            self.flusher.start()
+
+    def publish(self, message, lane=NORMAL, ttl=0):
+        """Queue one message and return its sequence number."""
+        if isinstance(message, str):
+            message = message.encode(FORMAT)
+        with self.lock:
+            if self.next_seq - self.acked_seq >= self.max_in_flight:
+                # The window may be full of messages still sitting in pending, which no ack can cover
+                self._flush_locked()
+            while self.next_seq - self.acked_seq >= self.max_in_flight and not self.error:
+                self.lock.wait()
+            self._raise_if_failed()
+            if (lane, ttl) != self.qos:
+                self._flush_locked()
+                self._send(encode_frame(QOS, self.topic, QOS_OPTIONS.pack(lane, ttl)))
+                self.qos = (lane, ttl)
+            self.next_seq += 1
+            self.pending.append(message)
+            if len(self.pending) >= self.max_batch:
+                self._flush_locked()
+            return self.next_seq
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def wait_for_ack(self, seq=None, timeout=None):
+        """Block until every message up to seq (default: all published) is acked."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            self._flush_locked()
+            seq = self.next_seq if seq is None else seq
+            while self.acked_seq < seq and not self.error:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+            self._raise_if_failed()
+            return True
+
+    def close(self):
+        with self.lock:
+            self._flush_locked()
+            self.closed = True
+        try:
+            self.sock.sendall(encode_frame(TERMINATE))
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _flush_locked(self):
+        if not self.pending:
+            return
+        if len(self.pending) == 1:
+            frame = encode_frame(PUBLISH, self.topic, self.pending[0])
+        else:
+            frame = encode_frame(BATCH, self.topic, encode_batch(self.pending))
+        self.pending = []
+        self._send(frame)
+
+    def _send(self, frame):
+        try:
+            self.sock.sendall(frame)
+        except OSError as e:
+            self.error = e
+            raise
+
+    def _flush_periodically(self):
+        while not self.closed:
+            time.sleep(self.flush_interval)
+            with self.lock:
+                if self.closed or self.error:
+                    break
+                try:
+                    self._flush_locked()
+                except OSError:
+                    break
+
+    def _read_acks(self):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                frames = recv_frames(self.sock, decoder)
+                if frames is None:
+                    raise ConnectionError("broker closed the connection")
+                for opcode, _, payload in frames:
+                    with self.lock:
+                        if opcode == ACK:
+                            self.acked_seq = max(self.acked_seq, decode_ack(payload)[0])
+                        elif opcode == ERROR:
+                            self.error = ConnectionError(payload.decode(FORMAT))
+                        elif opcode == HEARTBEAT:
+                            self._send(encode_frame(HEARTBEAT))  # Under the lock, so never inside a batch
+                        self.lock.notify_all()
+        except Exception as e:
+            with self.lock:
+                if not self.closed and not self.error:
+                    self.error = e
+                self.lock.notify_all()
+
+    def _raise_if_failed(self):
+        if self.error:
+            raise self.error
@@ -0,0 +1,491 @@
+import abc
+import socket
+import random
+import asyncio
+import threading
+from collections import deque
+from protocol import (FORMAT, OPCODES, HELLO, PUBLISH, MESSAGE, ACK, ERROR, TERMINATE, BATCH, SUBSCRIBE, UNSUBSCRIBE,
+                      COMPRESSED, QOS, QOS_OPTIONS, NORMAL, HEARTBEAT, SESSION, SESSION_NEW, SESSION_RESUMED,
+                      NOTIFY, RING_OFFSET,
+                      FrameDecoder, ProtocolError, decode_ack, encode_batch, encode_frame)
+from topic_index import TopicIndex, is_pattern
+from compression import CODECS, decompress
+from shm_transport import RingReader, SHM_CODEC
+from metrics import log, DEBUG, INFO, WARNING, ERROR as LOG_ERROR
+
+SUBSCRIBER_CONNECTIONS = 2   # Broker connections the subscriptions are spread over
+PUBLISHER_CONNECTIONS = 1    # Broker connections the published topics are spread over
+RECONNECT_DELAY = 0.1        # First wait before reconnecting; doubles per failed attempt
+MAX_RECONNECT_DELAY = 5.0
+RESUME_RETRIES = 3           # Reconnects that try the old session token again before accepting a new session
+SUBSCRIPTION_BUFFER = 10000  # Messages an iterated subscription holds before dropping the oldest
+READ_SIZE = 65536
+HEARTBEAT_FRAME = encode_frame(HEARTBEAT)
+
+
+class Subscription:
+    """One subscribe() call. Messages on topics matching pattern go to
+    callback(topic, payload) if one was given, otherwise they are buffered
+    for `async for topic, payload in subscription`."""
+
+    def __init__(self, pattern, callback=None, limit=SUBSCRIPTION_BUFFER):
+        self.pattern = pattern
+        self.callback = callback
+        self.messages = deque(maxlen=limit)
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.closed = False
+
+    def _deliver(self, topic, payload):
+        if self.callback is not None:
+            self.callback(topic, payload)
+            return
+        if len(self.messages) == self.messages.maxlen:
+            self.dropped += 1
+        self.messages.append((topic, payload))
+        self.ready.set()
+
+    def _close(self):
+        self.closed = True
+        self.ready.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.messages:
+            if self.closed:
+                raise StopAsyncIteration
+            self.ready.clear()
+            await self.ready.wait()
+        return self.messages.popleft()
+
+
+class _Connection(abc.ABC):
+    # One broker connection, kept up by its own task: on any failure it reconnects with
+    # exponential backoff and replays its state (HELLO, subscriptions or unacked messages)
+
+    def __init__(self, client, number):
+        self.client = client
+        self.number = number
+        self.writer = None
+        self.connected = asyncio.Event()
+        self.task = None
+        self.delay = RECONNECT_DELAY  # Wait before the next reconnect; reset once a broker accepts the HELLO
+        self.accepted = False         # Whether the broker has answered the current connection's HELLO
+        self.retry_delay = 0  # Set by a subclass that drops the connection on purpose and wants a pause first
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def send(self, frame):
+        # Frames written while disconnected are dropped; _resume() replays what matters
+        if self.writer is not None:
+            self.writer.write(frame)
+
+    async def _run(self):
+        while not self.client.closed:
+            try:
+                reader, writer = await self.client._open()
+            except OSError as e:
+                # Warn once per outage; the retries that follow are only worth a debug line
+                log(WARNING if self.delay == RECONNECT_DELAY else DEBUG,
+                    f"[CLIENT] {self.name} connect failed: {e}; retrying in {self.delay:.1f}s")
+                await self._back_off()
+                continue
+            self.writer = writer
+            self.accepted = False
+            try:
+                self._resume()
+                self.connected.set()
+                decoder = FrameDecoder()
+                while True:
+                    data = await reader.read(READ_SIZE)
+                    if not data:
+                        raise ConnectionError("broker closed the connection")
+                    for opcode, topic, payload in decoder.feed(data):
+                        if opcode != ERROR and not self.accepted:
+                            # A broker that refuses the HELLO answers with an ERROR and hangs up; anything
+                            # else means it took us, and the next outage starts the backoff afresh
+                            self.accepted = True
+                            self.delay = RECONNECT_DELAY
+                        if opcode == HEARTBEAT:
+                            writer.write(HEARTBEAT_FRAME)
+                            continue
+                        try:
+                            self._frame(opcode, topic, payload)
+                        except ConnectionError:
+                            raise
+                        except Exception as e:
+                            # A frame we can't decode (bad UTF-8, a corrupt compressed payload) leaves us
+                            # unsure of the stream, so start over on a new connection
+                            raise ProtocolError(f"undecodable {OPCODES.get(opcode, opcode)} frame: {e!r}") from e
+            except (OSError, ConnectionError, ProtocolError) as e:
+                if not self.client.closed:
+                    log(INFO, f"[CLIENT] {self.name} lost its connection: {e}")
+                    self.client.stats['reconnects'] += 1
+            finally:
+                self.connected.clear()
+                self.writer = None
+                self._lost()
+                writer.close()
+            if self.retry_delay:
+                await asyncio.sleep(self.retry_delay)
+                self.retry_delay = 0
+            elif not self.accepted and not self.client.closed:
+                # Refused, or dropped before the broker answered: back off as after a failed connect
+                await self._back_off()
+
+    async def _back_off(self):
+        await asyncio.sleep(self.delay * random.uniform(0.5, 1.0))  # Jitter, so a pool doesn't reconnect in lockstep
+        self.delay = min(self.delay * 2, MAX_RECONNECT_DELAY)
+
+    @abc.abstractmethod
+    def _resume(self):
+        """Send HELLO and whatever the broker needs to carry on where the last connection stopped."""
+
+    @abc.abstractmethod
+    def _frame(self, opcode, topic, payload):
+        """Handle one frame from the broker (heartbeats are answered before this)."""
+
+    def _lost(self):
+        pass
+
+
+class _SubscriberConnection(_Connection):
+    # Carries the subscriptions whose pattern hashes to it. Each pattern is subscribed at the
+    # broker once, however many Subscriptions share it; the broker sends a message once per
+    # connection, and the local topic index hands it to every Subscription it matches.
+
+    def __init__(self, client, number):
+        super().__init__(client, number)
+        self.name = f"subscriber connection {number}"
+        self.index = TopicIndex()  # {pattern: {Subscription: None}}
+        self.session = SESSION_NEW  # Token once the broker has issued one
+        self.subscribed = set()     # Patterns the broker's session holds; self.index.topics is what it should hold
+        self.synced = False         # Whether the broker has answered this connection's HELLO with its session
+        self.resume_attempts = 0
+        self.codec = None
+        self.ring = None  # RingReader once the broker has agreed to the shared-memory codec
+
+    def _resume(self):
+        # With a session the broker remembers our patterns, so a reconnect is one frame, not one per pattern
+        codecs = ((SHM_CODEC,) if self.client.path else ()) + tuple(self.client.codecs)
+        self.writer.write(encode_frame(HELLO, '', f"SUBSCRIBER {','.join(codecs)} {self.session}"))
+
+    def add(self, subscription):
+        new = subscription.pattern not in self.index.topics
+        self.index.add(subscription.pattern, subscription, subscription)
+        if new and self.synced:
+            self.writer.write(encode_frame(SUBSCRIBE, subscription.pattern))
+            self.subscribed.add(subscription.pattern)
+
+    def remove(self, subscription):
+        self.index.remove(subscription.pattern, subscription)
+        if subscription.pattern not in self.index.topics and self.synced:
+            self.writer.write(encode_frame(UNSUBSCRIBE, subscription.pattern))
+            self.subscribed.discard(subscription.pattern)
+
+    def _sync(self):
+        # Changes made while disconnected were only made locally; send the broker the difference
+        wanted = set(self.index.topics)
+        frames = [encode_frame(SUBSCRIBE, pattern) for pattern in wanted - self.subscribed]
+        frames += [encode_frame(UNSUBSCRIBE, pattern) for pattern in self.subscribed - wanted]
+        if frames:
+            self.writer.write(b''.join(frames))
+        self.subscribed = wanted
+        self.synced = True
+
+    def _lost(self):
+        self.synced = False
+
+    def _frame(self, opcode, topic, payload):
+        if opcode == COMPRESSED:
+            opcode, payload = MESSAGE, decompress(self.codec, payload)
+        elif opcode == NOTIFY:
+            # The messages themselves are in the broker's ring; the frame only says where
+            for (offset,) in RING_OFFSET.iter_unpack(payload):
+                record = self.ring.read(offset)
+                if record is None:
+                    self.client.stats['overrun'] += 1  # Overwritten before this subscriber got to it
+                else:
+                    self._frame(MESSAGE, *record)
+            return
+        if opcode == MESSAGE:
+            self.client.stats['received'] += 1
+            for subscription, _ in self.index.subscribers(topic):
+                try:
+                    subscription._deliver(topic, payload)
+                except Exception as e:
+                    # A failing callback loses its own message, not the connection or the other subscriptions
+                    log(LOG_ERROR, f"[CLIENT] callback for '{subscription.pattern}' failed on {topic}: {e!r}")
+        elif opcode == HELLO:
+            self.codec = payload.decode(FORMAT) or None
+            if self.codec == SHM_CODEC and (self.ring is None or self.ring.name != topic):
+                # The topic names the ring; a restarted broker has a new one
+                self.close_ring()
+                self.ring = RingReader(topic)
+        elif opcode == SESSION:
+            resumed = payload.decode(FORMAT) == SESSION_RESUMED
+            if not resumed and self.session != SESSION_NEW and self.resume_attempts < RESUME_RETRIES:
+                # A quick reconnect can beat the broker noticing the old connection is gone, while our
+                # session is still attached to it. End the session it just opened and try ours again.
+                self.resume_attempts += 1
+                self.retry_delay = RECONNECT_DELAY * 2 ** self.resume_attempts
+                self.writer.write(encode_frame(TERMINATE))
+                raise ConnectionError(f"session {self.session} is still attached to the previous connection")
+            self.resume_attempts = 0
+            if not resumed:
+                # A new session (first connect, or the broker lost ours): subscribe everything again
+                self.subscribed = set()
+                self.client.stats['resubscribed'] += len(self.index.topics)
+            self.session = topic
+            self._sync()
+        elif opcode == ERROR:
+            log(WARNING, f"[CLIENT] {self.name}: {payload.decode(FORMAT, errors='replace')}")
+
+    def close_ring(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+
+class _PublisherConnection(_Connection):
+    # Publishes for the topics that hash to it, batched per topic. Every message stays in
+    # `unacked` until the broker's cumulative ack covers it, and is sent again after a
+    # reconnect: at-least-once, like the broker's consumer groups.
+
+    def __init__(self, client, number):
+        super().__init__(client, number)
+        self.name = f"publisher connection {number}"
+        self.pending = []        # [(topic, message, lane, ttl)] not yet written
+        self.unacked = deque()   # [(topic, message, lane, ttl)] written, awaiting an ack
+        self.sent = 0            # Messages written on the current connection
+        self.acked = 0           # Of those, how many the broker has acked
+        self.qos = (NORMAL, 0)
+        self.space = asyncio.Condition()
+
+    def _resume(self):
+        self.writer.write(encode_frame(HELLO, '', "PUBLISHER"))
+        self.sent = self.acked = 0
+        self.qos = (NORMAL, 0)
+        resend = list(self.unacked)
+        self.unacked.clear()
+        if resend:
+            self.client.stats['resent'] += len(resend)
+            self._write(resend)
+
+    def _lost(self):
+        asyncio.create_task(self._wake())
+
+    async def _wake(self):
+        async with self.space:
+            self.space.notify_all()
+
+    def flush(self):
+        if self.pending and self.writer is not None:
+            pending, self.pending = self.pending, []
+            self._write(pending)
+
+    def _write(self, messages):
+        # Consecutive messages with the same topic and QOS go out as one BATCH frame
+        frames = []
+        run = []
+        for entry in messages:
+            if run and (entry[0] != run[0][0] or entry[2:] != run[0][2:]):
+                frames.append(self._encode(run))
+                run = []
+            run.append(entry)
+        if run:
+            frames.append(self._encode(run))
+        self.writer.write(b''.join(frames))
+        self.unacked.extend(messages)
+        self.sent += len(messages)
+
+    def _encode(self, run):
+        topic, _, lane, ttl = run[0]
+        qos = b''
+        if (lane, ttl) != self.qos:
+            qos = encode_frame(QOS, topic, QOS_OPTIONS.pack(lane, ttl))
+            self.qos = (lane, ttl)
+        if len(run) == 1:
+            return qos + encode_frame(PUBLISH, topic, run[0][1])
+        return qos + encode_frame(BATCH, topic, encode_batch([entry[1] for entry in run]))
+
+    def _frame(self, opcode, topic, payload):
+        if opcode == ACK:
+            seq = decode_ack(payload)[0]
+            for _ in range(seq - self.acked):
+                self.unacked.popleft()
+            self.client.stats['acked'] += seq - self.acked
+            self.acked = seq
+            asyncio.create_task(self._wake())
+        elif opcode == ERROR:
+            log(WARNING, f"[CLIENT] {self.name}: {payload.decode(FORMAT, errors='replace')}")
+
+
+class AsyncClient:
+    """asyncio client for the Task3 broker that multiplexes any number of
+    topics over a small pool of connections.
+
+    Subscriptions are spread over subscriber_connections by pattern and
+    publishes over publisher_connections by topic, so per-topic order holds.
+    Every connection reconnects on its own with exponential backoff; a
+    subscriber connection resumes its broker session (or resubscribes if
+    the broker has forgotten it) and a publisher connection resends what
+    the broker hadn't acked. publish() only buffers: messages go out in
+    per-topic batches every flush_interval seconds or max_batch messages,
+    and publish() waits while max_in_flight are unacked on a connection.
+
+    With path, the client connects to the broker's Unix socket instead
+    (a broker started with PUBSUB_SHM_SOCKET=path) and its subscriber
+    connections read messages straight from the broker's shared-memory
+    ring, receiving only their offsets over the socket.
+
+        async with AsyncClient('localhost', 5000) as client:
+            sports = await client.subscribe('sports.#')
+            await client.publish('sports.tennis', b'15-0')
+            async for topic, payload in sports:
+                ..."""
+
+    def __init__(self, host, port, subscriber_connections=SUBSCRIBER_CONNECTIONS,
+                 publisher_connections=PUBLISHER_CONNECTIONS, codecs=tuple(CODECS), max_batch=100,
+                 flush_interval=0.005, max_in_flight=10000, path=None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.codecs = codecs
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_in_flight = max_in_flight
+        self.subscribers = [_SubscriberConnection(self, number) for number in range(subscriber_connections)]
+        self.publishers = [_PublisherConnection(self, number) for number in range(publisher_connections)]
+        self.closed = False
+        self.flusher = None
+        self.stats = {'received': 0, 'acked': 0, 'reconnects': 0, 'resubscribed': 0, 'resent': 0,
+                      'overrun': 0}
+
+    async def _open(self):
+        if self.path:
+            return await asyncio.open_unix_connection(self.path)
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return reader, writer
+
+    async def connect(self, timeout=10):
+        for connection in self.subscribers + self.publishers:
+            connection.start()
+        self.flusher = asyncio.create_task(self._flush_periodically())
+        await asyncio.wait_for(asyncio.gather(*(connection.connected.wait()
+                                                for connection in self.subscribers + self.publishers)), timeout)
+        return self
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def subscribe(self, pattern, callback=None):
+        subscription = Subscription(pattern, callback)
+        self.subscribers[hash(pattern) % len(self.subscribers)].add(subscription)
+        return subscription
+
+    async def unsubscribe(self, subscription):
+        self.subscribers[hash(subscription.pattern) % len(self.subscribers)].remove(subscription)
+        subscription._close()
+
+    async def publish(self, topic, message, lane=NORMAL, ttl=0):
+        if is_pattern(topic):
+            raise ValueError(f"publishers need a concrete topic, got '{topic}'")
+        if isinstance(message, str):
+            message = message.encode(FORMAT)
+        connection = self.publishers[hash(topic) % len(self.publishers)]
+        if len(connection.unacked) + len(connection.pending) >= self.max_in_flight:
+            connection.flush()
+            async with connection.space:
+                await connection.space.wait_for(
+                    lambda: len(connection.unacked) + len(connection.pending) < self.max_in_flight or self.closed)
+        connection.pending.append((topic, message, lane, ttl))
+        if len(connection.pending) >= self.max_batch or not self.flush_interval:
+            connection.flush()
+
+    async def flush(self, timeout=None):
+        """Send everything buffered and wait until the broker has acked it."""
+        for connection in self.publishers:
+            connection.flush()
+
+        async def acked(connection):
+            async with connection.space:
+                await connection.space.wait_for(lambda: not connection.unacked and not connection.pending)
+
+        await asyncio.wait_for(asyncio.gather(*(acked(connection) for connection in self.publishers)), timeout)
+
+    async def _flush_periodically(self):
+        while not self.closed:
+            await asyncio.sleep(self.flush_interval or 0.05)
+            for connection in self.publishers:
+                connection.flush()
+
+    async def close(self):
+        for connection in self.publishers:
+            connection.flush()
+        self.closed = True
+        for connection in self.subscribers + self.publishers:
+            connection.send(encode_frame(TERMINATE))
+            if connection.writer is not None:
+                try:
+                    await connection.writer.drain()
+                except (OSError, ConnectionError):
+                    pass
+            if connection.task is not None:
+                connection.task.cancel()
+        if self.flusher is not None:
+            self.flusher.cancel()
+        for connection in self.subscribers:
+            for subscription, _ in connection.index.all_subscribers():
+                subscription._close()
+            connection.close_ring()
+
+
+class Client:
+    """Blocking wrapper around AsyncClient for threaded code: the client runs
+    on its own event loop thread, and callbacks are called on that thread.
+
+        client = Client('localhost', 5000)
+        client.subscribe('sports.#', lambda topic, payload: print(topic, payload))
+        client.publish('sports.tennis', '15-0')
+        client.close()"""
+
+    def __init__(self, host, port, **options):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.client = self._call(self._create(host, port, options))
+
+    async def _create(self, host, port, options):
+        return await AsyncClient(host, port, **options).connect()
+
+    def _call(self, coroutine, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def subscribe(self, pattern, callback):
+        return self._call(self.client.subscribe(pattern, callback))
+
+    def unsubscribe(self, subscription):
+        self._call(self.client.unsubscribe(subscription))
+
+    def publish(self, topic, message, lane=NORMAL, ttl=0):
+        self._call(self.client.publish(topic, message, lane, ttl))
+
+    def flush(self, timeout=None):
+        self._call(self.client.flush(timeout))
+
+    @property
+    def stats(self):
+        return dict(self.client.stats)
+
+    def close(self):
+        self._call(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(1)
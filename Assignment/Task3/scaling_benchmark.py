@@ -0,0 +1,149 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+import multiprocessing
+from protocol import HELLO, PUBLISH, MESSAGE, HEARTBEAT, FrameDecoder, encode_frame, send_frame
+from benchmark import raise_file_limit, drain, QUEUE_LIMIT
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def wait_for_port(process, host, port):
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"broker did not start on {host}:{port}")
+
+
+def start_workers(host, port, workers):
+    # One port shared by every worker process
+    process = subprocess.Popen([sys.executable, os.path.join(HERE, 'workers.py'), str(port), host,
+                                str(QUEUE_LIMIT), 'drop-oldest', str(workers)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(process, host, port)
+    return [process], [(host, port)]
+
+
+def start_cluster(host, port, nodes):
+    # One port per node, each node linked to all the others
+    addresses = [(host, port + node) for node in range(nodes)]
+    processes = []
+    for address in addresses:
+        peers = ",".join(f"{peer_host}:{peer_port}" for peer_host, peer_port in addresses
+                         if (peer_host, peer_port) != address)
+        processes.append(subprocess.Popen([sys.executable, os.path.join(HERE, 'federation.py'), str(address[1]),
+                                           host, peers, str(QUEUE_LIMIT), 'drop-oldest'],
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    for process, (node_host, node_port) in zip(processes, addresses):
+        wait_for_port(process, node_host, node_port)
+    return processes, addresses
+
+
+def reader(addresses, first, topic, count, messages, ready, results):
+    # One client process per slice of subscribers, so the readers don't become the bottleneck
+    raise_file_limit()
+    subscribers = []
+    for number in range(first, first + count):
+        sock = socket.create_connection(addresses[number % len(addresses)])
+        send_frame(sock, HELLO, topic, "SUBSCRIBER")
+        subscribers.append((sock, FrameDecoder()))
+    ready.wait()
+    received = 0
+    for sock, decoder in subscribers:
+        sock.settimeout(60)
+        remaining = messages
+        try:
+            while remaining > 0:
+                data = sock.recv(1 << 18)
+                if not data:
+                    break
+                for opcode, _, _ in decoder.feed(data):
+                    if opcode == MESSAGE:
+                        remaining -= 1
+                    elif opcode == HEARTBEAT:
+                        send_frame(sock, HEARTBEAT)  # Long runs would otherwise get reaped as idle
+        except socket.timeout:
+            pass
+        received += messages - max(remaining, 0)
+        sock.close()
+    results.put((received, time.perf_counter()))
+
+
+def run(mode, host, port, workers, subscribers, readers, publishers, messages, payload_size, topic, settle):
+    start = start_cluster if mode == 'cluster' else start_workers
+    processes, addresses = start(host, port, workers)
+    try:
+        ready = multiprocessing.Barrier(readers + 1)
+        results = multiprocessing.Queue()
+        per_reader = subscribers // readers
+        clients = [multiprocessing.Process(target=reader, args=(addresses, number * per_reader, topic, per_reader,
+                                                                messages, ready, results))
+                   for number in range(readers)]
+        for client in clients:
+            client.start()
+
+        # Several publisher connections, so the kernel spreads them over the workers too
+        frame = encode_frame(PUBLISH, topic, b"x" * payload_size)
+        connections = []
+        for number in range(publishers):
+            sock = socket.create_connection(addresses[number % len(addresses)])
+            send_frame(sock, HELLO, topic, "PUBLISHER")
+            multiprocessing.Process(target=drain, args=(sock,), daemon=True).start()
+            connections.append(sock)
+        time.sleep(settle)
+        ready.wait()
+
+        started = time.perf_counter()
+        shares = [messages // publishers + (1 if n < messages % publishers else 0) for n in range(publishers)]
+        for sock, share in zip(connections, shares):
+            sock.sendall(frame * share)
+        outcomes = [results.get(timeout=120) for _ in clients]
+        elapsed = max(finished for _, finished in outcomes) - started
+        delivered = sum(received for received, _ in outcomes)
+        for client in clients:
+            client.join()
+        for sock in connections:
+            sock.close()
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    expected = per_reader * readers * messages
+    print(f"[{mode.upper()}={workers}] {delivered}/{expected} deliveries of {messages} publishes to "
+          f"{per_reader * readers} subscribers in {elapsed:.2f}s ({delivered / elapsed:.0f} deliveries/s)")
+    return delivered / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fan-out throughput by worker processes or cluster nodes")
+    parser.add_argument("--mode", choices=["workers", "cluster"], default="workers",
+                        help="SO_REUSEPORT workers on one port, or federated nodes on consecutive ports")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="worker or node counts")
+    parser.add_argument("--subscribers", type=int, default=200)
+    parser.add_argument("--readers", type=int, default=4, help="client processes reading the subscribers")
+    parser.add_argument("--publishers", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--payload-size", type=int, default=64)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5200)
+    parser.add_argument("--topic", default="bench")
+    parser.add_argument("--settle", type=float, default=1.0)
+    args = parser.parse_args()
+
+    raise_file_limit()
+    print(f"[CPU] {os.cpu_count()} core(s) available")
+    baseline = None
+    for offset, workers in enumerate(args.workers):
+        rate = run(args.mode, args.host, args.port + offset * 10, workers, args.subscribers, args.readers,
+                   args.publishers, args.messages, args.payload_size, args.topic, args.settle)
+        baseline = baseline or rate
+        print(f"[{args.mode.upper()}={workers}] {rate / baseline:.2f}x the rate with {args.workers[0]}")
@@ -1,122 +1,195 @@
-import sys
+import os
+import time
 import socket
+import select
+import itertools
 import threading
+import broker
+from broker import METRICS, GROUPS, WHEEL, HEARTBEAT_FRAME, Client, advance_liveness, expire_sessions, hang_up
+from protocol import FrameDecoder, recv_frames, send_parts
+from topic_log import FileRegion
+from shm_transport import SHM_CODEC
+from groups import SWEEP_INTERVAL
+from timer_wheel import TICK
+from sessions import SESSION_SWEEP, SNAPSHOT_INTERVAL
+from metrics import log, enabled, DEBUG, INFO, ERROR as LOG_ERROR
 
-HEADER = 1
-FORMAT = 'utf-8'
-SUBSCRIBERS = {}  # Dictionary to store subscriber connections {address: (conn, topic)}
-PUBLISHERS = {}   # Dictionary to store publisher connections {address: (conn, topic)}
+BACKLOG = 4096  # Pending connection queue, sized for large subscriber bursts
 
-def server_program(port=5000):
-    host = socket.gethostbyname(socket.gethostname())
+# Routing, groups, sessions and the shared state live in broker.py; this module is the
+# thread-per-connection I/O around them.
+
+def server_program(port=5000, host=None):
+    host = host or socket.gethostbyname(socket.gethostname())
     server_socket = socket.socket()  # Create a socket object
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # A restarted broker rebinds while old connections linger in TIME_WAIT
     server_socket.bind((host, port))  # Bind the socket to the host and port
-    server_socket.listen(5)  # Listen for incoming connections
+    server_socket.listen(BACKLOG)  # Listen for incoming connections
     print(f"[SERVER LISTENING] on {host}:{port}\n")
     print("------------------------------------")
+    threading.Thread(target=redeliver_periodically, daemon=True).start()
+    threading.Thread(target=check_liveness, daemon=True).start()
+    threading.Thread(target=maintain_sessions, daemon=True).start()
+    if broker.LOCAL_SOCKET:
+        threading.Thread(target=serve_local, args=(broker.LOCAL_SOCKET,), daemon=True).start()
 
     while True:
-        conn, addr = server_socket.accept()        
+        conn, addr = server_socket.accept()
         thread = threading.Thread(target=handle_client, args=(conn, addr))
         thread.start()
-        print(f"[ACTIVE CONNECTIONS : {str(threading.active_count() - 1)}]")
+        METRICS.add('connections')
+        if enabled(DEBUG):
+            log(DEBUG, f"[ACTIVE CONNECTIONS : {str(threading.active_count() - 1)}]")
+
+
+def serve_local(path):
+    # Same-host clients connect here; subscribers among them can take messages from the ring
+    if os.path.exists(path):
+        os.unlink(path)  # Left behind by a broker that didn't exit cleanly
+    server_socket = socket.socket(socket.AF_UNIX)
+    server_socket.bind(path)
+    server_socket.listen(BACKLOG)
+    print(f"[LOCAL LISTENING] on {path}, shared-memory ring {broker.RING.name}")
+    ids = itertools.count(1)
+    while True:
+        conn, _ = server_socket.accept()
+        # Unix socket peers have no address, so each gets a number in its place
+        threading.Thread(target=handle_client, args=(conn, ('local', next(ids)))).start()
+        METRICS.add('connections')
 
 
 def handle_client(conn, address):
+    decoder = FrameDecoder()
+    client = Client(address)
+    send_lock = threading.Lock()  # Held for every send on conn that doesn't go through a subscriber's queue
+    WHEEL.add(address, (conn, None, send_lock))  # Even a client that never says HELLO gets reaped
     try:
-        details = conn.recv(1024).decode(FORMAT)
-        details = details.split(" ")
-        role = details[0]
-        topic = details[1]
-        print(f"[NEW {role} CONNECTION on {topic}] {address} connected.")
-        
-        if role == "SUBSCRIBER":
-            SUBSCRIBERS[address] = (conn, topic)
-            print_status()
-        elif role == "PUBLISHER":
-            PUBLISHERS[address] = (conn, topic)
-            print_status()
-        else:
-            print(f"[ERROR] Unknown role: {role}")
-            conn.close()
+        # The handshake is a HELLO frame; anything already pipelined behind it stays in the decoder
+        frames = []
+        while not frames:
+            frames = recv_frames(conn, decoder)
+            if frames is None:
+                return
+            WHEEL.touch(address)
+        refused = client.hello(frames.pop(0), conn, local=conn.family == socket.AF_UNIX)
+        if refused:
+            send_locked(conn, send_lock, refused)
             return
-              
-        connected = True
+        if client.queue:
+            # From here on only the subscriber's writer thread sends on conn
+            threading.Thread(target=subscriber_writer, args=(address, client.queue), daemon=True).start()
+        WHEEL.add(address, (conn, client.queue, send_lock))
 
-        while connected:
+        while client.connected:
             try:
-                message = conn.recv(1024).decode(FORMAT)
-                if not message or message.lower() == 'terminate':
-                    connected = False
-                    print(f"[DISCONNECT] {address} disconnected.")
-                    break
-
-                # If this is a publisher, distribute the message to subscribers of the same topic
-                if address in PUBLISHERS and message:
-                    publisher_topic = PUBLISHERS[address][1]
-                    print(f"[PUBLISHER {address} - {publisher_topic}]: {message}")
-                    distribute_messages(message, address, publisher_topic)
-                    # Count subscribers for this specific topic
-                    topic_subscribers = sum(1 for addr, (conn, topic) in SUBSCRIBERS.items() if topic == publisher_topic)
-                    conn.send(f"{publisher_topic} - Message '{message}' sent to {topic_subscribers} subscribers".encode(FORMAT))
-                
-                # If this is a subscriber, they shouldn't be sending messages (except terminate)
-                elif address in SUBSCRIBERS and message:
-                    conn.send("Subscribers cannot send messages. Only publishers can send messages.".encode(FORMAT))
-                    
+                replies, _ = client.handle(frames)
+                for frame in replies:
+                    reply(conn, client.queue, send_lock, frame)
+
+                if client.connected:
+                    frames = recv_frames(conn, decoder)
+                    if frames is None:
+                        break
+                    WHEEL.touch(address)  # Any frame, HEARTBEAT answers included, proves the client alive
+
             except Exception as e:
-                print(f"[ERROR] Error receiving message from {address}: {e}")
-                connected = False
+                log(LOG_ERROR, f"[ERROR] Error receiving message from {address}: {e}")
+                return
+        log(INFO, f"[DISCONNECT] {address} disconnected.")
 
     except Exception as e:
-        print(f"[ERROR] Error handling client {address}: {e}")
+        log(LOG_ERROR, f"[ERROR] Error handling client {address}: {e}")
     finally:
         # Clean up when client disconnects
-        if address in SUBSCRIBERS:
-            del SUBSCRIBERS[address]
-            print(f"[CLEANUP] Removed subscriber {address}")
-        if address in PUBLISHERS:
-            del PUBLISHERS[address]
-            print(f"[CLEANUP] Removed publisher {address}")
-        print_status()
+        client.close()
         conn.close()
 
-def distribute_messages(message, publisher_address, publisher_topic):
-    # Filter subscribers by topic
-    topic_subscribers = {addr: (conn, topic) for addr, (conn, topic) in SUBSCRIBERS.items() if topic == publisher_topic}
-    
-    if not topic_subscribers:
-        print(f"[INFO] No subscribers for topic '{publisher_topic}' to send message to")
-        return
-    
-    disconnected_subscribers = []
-    
-    for subscriber_address, (subscriber_conn, _) in topic_subscribers.items():
-        try:
-            formatted_message = f"[FROM PUBLISHER {publisher_address} on {publisher_topic}]: {message}"
-            subscriber_conn.send(formatted_message.encode(FORMAT))
-            print(f"[MESSAGE SENT] to subscriber {subscriber_address} on topic {publisher_topic}")
-        except Exception as e:
-            print(f"[ERROR] Failed to send message to subscriber {subscriber_address}: {e}")
-            disconnected_subscribers.append(subscriber_address)
-    
-    # Remove disconnected subscribers
-    for addr in disconnected_subscribers:
-        if addr in SUBSCRIBERS:
-            del SUBSCRIBERS[addr]
-            print(f"[CLEANUP] Removed disconnected subscriber {addr}")
-
-def print_status():
-    print(f"[STATUS] Publishers: {len(PUBLISHERS)}, Subscribers: {len(SUBSCRIBERS)}")
-    if PUBLISHERS:
-        for addr, (conn, topic) in PUBLISHERS.items():
-            print(f"[PUBLISHER] {addr} on topic '{topic}'")
-    if SUBSCRIBERS:
-        for addr, (conn, topic) in SUBSCRIBERS.items():
-            print(f"[SUBSCRIBER] {addr} on topic '{topic}'")
+def reply(conn, queue, send_lock, frame):
+    # Subscriber sockets belong to their writer thread, so replies go through the queue
+    if queue:
+        queue.put((frame,))
+    else:
+        send_locked(conn, send_lock, frame)
+
+def send_locked(conn, send_lock, frame):
+    # The liveness thread also writes heartbeats to connections without a queue; the lock keeps
+    # them from landing in the middle of a frame
+    with send_lock:
+        conn.sendall(frame)
+
+def subscriber_writer(address, queue):
+    try:
+        while True:
+            items = queue.take()
+            if items is None:
+                break
+            # Everything queued since the last wake-up goes out in one vectored write,
+            # except log replays, which go from the file to the socket with sendfile
+            parts = []
+            # Local subscribers get one NOTIFY for each run of messages in the ring
+            for item in broker.RING.coalesce(items) if queue.codec == SHM_CODEC else items:
+                if isinstance(item, FileRegion):
+                    send_parts(queue.conn, parts)
+                    parts = []
+                    send_region(queue.conn, item)
+                else:
+                    parts.extend(item)
+            send_parts(queue.conn, parts)
+            METRICS.delivered(items)
+    except Exception as e:
+        if not queue.closed:  # Errors after the handler closed the queue are just the socket going away
+            log(LOG_ERROR, f"[ERROR] Failed to send message to subscriber {address}: {e}")
+    finally:
+        queue.close()
+        hang_up(queue.conn)
+
+def send_region(conn, region):
+    with region.file as segment:
+        conn.sendfile(segment, region.position, region.count)
+
+def maintain_sessions():
+    compacted = time.monotonic()
+    while True:
+        time.sleep(SESSION_SWEEP)
+        expire_sessions()
+        if time.monotonic() - compacted >= SNAPSHOT_INTERVAL:
+            broker.SESSIONS.compact()
+            compacted = time.monotonic()
+
+def redeliver_periodically():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        GROUPS.sweep()
+
+def check_liveness():
+    # One thread drives the timer wheel for every connection
+    while True:
+        time.sleep(TICK)
+        pings, reaps = advance_liveness()
+        for address, (conn, queue, send_lock) in pings:
+            if queue:
+                queue.put((HEARTBEAT_FRAME,))
+                continue
+            # A handler busy sending needs no ping, and neither does a publisher that isn't reading its
+            # ACKs (no room in its socket); otherwise a writable socket has room for the whole tiny frame,
+            # so the non-blocking send can't stop partway and leave the stream misframed
+            if not send_lock.acquire(blocking=False):
+                continue
+            try:
+                writable = select.poll()  # poll, unlike select, takes descriptors past 1024
+                writable.register(conn, select.POLLOUT)
+                if writable.poll(0):
+                    conn.send(HEARTBEAT_FRAME, socket.MSG_DONTWAIT)
+            except OSError:
+                pass
+            finally:
+                send_lock.release()
+        for address, (conn, queue, _) in reaps:
+            # Shutting the socket down wakes the handler thread, which cleans up as on any disconnect
+            hang_up(conn)
 
 
 if __name__ == "__main__":
-    port = (int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
-    server_program(port)
+    port, host = broker.configure("server.py")
+    server_program(port, host)
     print(f"[SERVER STARTED] on port {port}")
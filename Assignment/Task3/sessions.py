@@ -0,0 +1,286 @@
+import os
+import time
+import struct
+import marshal
+import secrets
+import threading
+
+SESSION_TTL = 300.0        # Seconds a disconnected subscriber's session (and held messages) is kept
+SNAPSHOT_INTERVAL = 60.0   # Seconds between snapshots, each of which empties the changelog
+SESSION_SWEEP = 5.0        # Seconds between checks for expired sessions
+
+# Changelog records: kind, field count, then each field as a 2-byte length and UTF-8
+# text. A snapshot is one marshalled object behind SNAPSHOT_MAGIC, which loads in a
+# single C call however many entries it has.
+RECORD = struct.Struct('!BB')
+FIELD = struct.Struct('!H')
+SNAPSHOT_MAGIC = b'PSS1'
+OPEN, CLOSE, SUBSCRIBE, UNSUBSCRIBE, FILTER, JOIN, LEAVE = range(1, 8)
+
+
+class StateLog:
+    """Snapshot file plus append-only changelog for small keyed state.
+
+    append() writes one record to the changelog and flushes it to the OS,
+    so the state survives the process dying; compact() writes the current
+    state as a fresh snapshot (fsynced, then renamed into place) and empties
+    the changelog. load() returns the snapshot's state and the changelog
+    records made since, dropping a record torn by a crash mid-write.
+
+    compact() is rotate() followed by write_snapshot(). Only rotate() has to
+    be serialised with append(); the slow part, writing and fsyncing the
+    snapshot, can run outside the caller's lock while appends go to the new
+    changelog. Records set aside by rotate() are replayed by load() until a
+    snapshot covers them, so they may be applied on top of the state that
+    already includes them: every record must set its key's value, so that
+    applying it twice changes nothing."""
+
+    def __init__(self, directory, name):
+        os.makedirs(directory, exist_ok=True)
+        self.snapshot_path = os.path.join(directory, f"{name}.snapshot")
+        self.changelog_path = os.path.join(directory, f"{name}.changelog")
+        self.aside_path = self.changelog_path + '.old'  # Rotated records not yet covered by a snapshot
+        self.changelog = None
+
+    @staticmethod
+    def encode(kind, fields):
+        encoded = [field.encode('utf-8') for field in fields]
+        return RECORD.pack(kind, len(encoded)) + b''.join(FIELD.pack(len(field)) + field for field in encoded)
+
+    @staticmethod
+    def _decode(data):
+        # Returns ([(kind, fields)], bytes consumed by the complete records)
+        records = []
+        position = good = 0
+        try:
+            while position < len(data):
+                kind, count = RECORD.unpack_from(data, position)
+                position += RECORD.size
+                fields = []
+                for _ in range(count):
+                    (length,) = FIELD.unpack_from(data, position)
+                    position += FIELD.size
+                    if position + length > len(data):
+                        raise struct.error("field runs past the end")
+                    fields.append(data[position:position + length].decode('utf-8'))
+                    position += length
+                records.append((kind, fields))
+                good = position
+        except struct.error:
+            pass  # Torn last record
+        return records, good
+
+    def load(self):
+        state = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as snapshot:
+                data = snapshot.read()
+            if data.startswith(SNAPSHOT_MAGIC):
+                state = marshal.loads(data[len(SNAPSHOT_MAGIC):])
+        records = []
+        if os.path.exists(self.aside_path):
+            # A compaction didn't finish: its set-aside records go first, and back into the changelog
+            with open(self.aside_path, 'rb') as aside:
+                records, good = self._decode(aside.read())
+            with open(self.aside_path, 'ab') as aside:
+                aside.truncate(good)
+            self._merge_aside()
+        good = 0
+        if os.path.exists(self.changelog_path):
+            with open(self.changelog_path, 'rb') as changelog:
+                more, good = self._decode(changelog.read())
+            records += more
+        self.changelog = open(self.changelog_path, 'ab')
+        self.changelog.truncate(good)
+        return state, records
+
+    def append(self, kind, fields):
+        self.changelog.write(self.encode(kind, fields))
+        self.changelog.flush()
+
+    def compact(self, state):
+        self.rotate()
+        self.write_snapshot(state)
+
+    def rotate(self):
+        """Start an empty changelog; the records so far wait aside until the
+        next write_snapshot() covers them. Cheap: a rename and an open."""
+        self.changelog.close()
+        if os.path.exists(self.aside_path):
+            self._merge_aside()  # The last snapshot failed; keep its records rather than replace them
+        os.replace(self.changelog_path, self.aside_path)
+        self.changelog = open(self.changelog_path, 'ab')
+
+    def write_snapshot(self, state):
+        """Write state, which must include every record rotate() set aside."""
+        temporary = self.snapshot_path + '.tmp'
+        with open(temporary, 'wb') as snapshot:
+            snapshot.write(SNAPSHOT_MAGIC + marshal.dumps(state))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, self.snapshot_path)
+        os.remove(self.aside_path)
+
+    def _merge_aside(self):
+        # Put the changelog's records after the set-aside ones and make the result the changelog
+        if os.path.exists(self.changelog_path):
+            with open(self.changelog_path, 'rb') as changelog, open(self.aside_path, 'ab') as aside:
+                aside.write(changelog.read())
+        os.replace(self.aside_path, self.changelog_path)
+
+
+class Session:
+    __slots__ = ('token', 'patterns', 'filter', 'groups', 'detached_at')
+
+    def __init__(self, token):
+        self.token = token
+        self.patterns = set()
+        self.filter = ''
+        self.groups = {}  # {pattern: (group name, window, ack timeout ms)}
+        self.detached_at = None
+
+    def state(self):
+        return self.token, tuple(self.patterns), self.filter, tuple((pattern,) + group for pattern, group in self.groups.items())
+
+    @classmethod
+    def from_state(cls, state):
+        token, patterns, expression, groups = state
+        session = cls(token)
+        session.patterns.update(patterns)
+        session.filter = expression
+        session.groups = {group[0]: group[1:] for group in groups}
+        return session
+
+
+class SessionStore:
+    """Subscriber sessions that outlive connections and broker restarts.
+
+    A subscriber that asks for a session gets a token; its patterns, filter
+    and consumer groups are recorded against it. When it reconnects and
+    presents the token, the broker restores all of that in one step instead
+    of a SUBSCRIBE per pattern. A session is kept for ttl seconds after its
+    connection goes away. With a directory, every change is appended to a
+    changelog and the whole table is periodically compacted into a
+    snapshot, so a restarted broker has every session back (detached,
+    waiting for its subscriber) as soon as it has read two small files."""
+
+    def __init__(self, directory=None, ttl=SESSION_TTL):
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        self.sessions = {}  # {token: Session}
+        self.log = StateLog(directory, 'sessions') if directory else None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def load(self):
+        """Rebuild the table from disk; every session comes back detached."""
+        if self.log is None:
+            return []
+        with self.lock:
+            state, records = self.log.load()
+            for entry in state or ():
+                session = Session.from_state(entry)
+                self.sessions[session.token] = session
+            for kind, fields in records:
+                self._apply(kind, fields)
+            now = time.monotonic()
+            for session in self.sessions.values():
+                session.detached_at = now
+            return list(self.sessions.values())
+
+    def _apply(self, kind, fields):
+        if kind == OPEN:
+            # setdefault: a replayed OPEN must not reset a session the snapshot already has
+            self.sessions.setdefault(fields[0], Session(fields[0]))
+            return
+        session = self.sessions.get(fields[0])
+        if session is None:
+            return
+        if kind == CLOSE:
+            del self.sessions[fields[0]]
+        elif kind == SUBSCRIBE:
+            session.patterns.add(fields[1])
+        elif kind == UNSUBSCRIBE:
+            session.patterns.discard(fields[1])
+        elif kind == FILTER:
+            session.filter = fields[1]
+        elif kind == JOIN:
+            session.groups[fields[1]] = (fields[2], int(fields[3]), int(fields[4]))
+        elif kind == LEAVE:
+            session.groups.pop(fields[1], None)
+
+    def _record(self, kind, *fields):
+        with self.lock:
+            self._record_locked(kind, fields)
+
+    def _record_locked(self, kind, fields):
+        if kind != OPEN and fields[0] not in self.sessions:
+            return
+        self._apply(kind, fields)
+        if self.log is not None:
+            self.log.append(kind, fields)
+
+    def open(self):
+        token = secrets.token_hex(16)
+        self._record(OPEN, token)
+        return self.sessions[token]
+
+    def attach(self, token):
+        """The detached session for token, now attached, or None if it is
+        unknown, expired or already in use by another connection."""
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is None or session.detached_at is None:
+                return None
+            session.detached_at = None
+            return session
+
+    def detach(self, token):
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is not None:
+                session.detached_at = time.monotonic()
+            return session
+
+    def close(self, token):
+        self._record(CLOSE, token)
+
+    def subscribed(self, token, pattern):
+        self._record(SUBSCRIBE, token, pattern)
+
+    def unsubscribed(self, token, pattern):
+        self._record(UNSUBSCRIBE, token, pattern)
+        self._record(LEAVE, token, pattern)
+
+    def filtered(self, token, expression):
+        self._record(FILTER, token, expression)
+
+    def joined(self, token, pattern, name, window, timeout_ms):
+        self._record(JOIN, token, pattern, name, str(window), str(timeout_ms))
+
+    def expire(self, now=None):
+        """Drop the sessions detached for longer than ttl and return them."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            expired = [session for session in self.sessions.values()
+                       if session.detached_at is not None and now - session.detached_at > self.ttl]
+            for session in expired:
+                self._record_locked(CLOSE, (session.token,))
+        return expired
+
+    def compact(self):
+        if self.log is None:
+            return
+        # Only the copy and the changelog rotation hold the lock; attach/detach and the changelog
+        # appends of the event loop never wait for the snapshot's fsync
+        with self.lock:
+            state = [session.state() for session in self.sessions.values()]
+            self.log.rotate()
+        self.log.write_snapshot(state)
+
+    def snapshot(self):
+        with self.lock:
+            detached = sum(1 for session in self.sessions.values() if session.detached_at is not None)
+            return {'sessions': len(self.sessions), 'detached': detached,
+                    'subscriptions': sum(len(session.patterns) for session in self.sessions.values())}
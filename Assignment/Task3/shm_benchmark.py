@@ -0,0 +1,112 @@
+import os
+import time
+import struct
+import asyncio
+import argparse
+from pubsub_client import AsyncClient
+
+STAMP = struct.Struct('!Q')  # Publish time in perf_counter_ns, same clock for every process on the host
+
+
+def broker_cpu(pid):
+    # User + system CPU seconds of the broker process so far (Linux /proc)
+    if not pid:
+        return 0.0
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+async def fan_out(label, options, subscribers, messages, size, pid):
+    # One publisher, every subscriber on the same topic; each message carries its publish time
+    clients = [await AsyncClient(subscriber_connections=1, publisher_connections=1, **options).connect()
+               for _ in range(subscribers)]
+    latencies = []
+    received = 0
+    done = asyncio.Event()
+
+    def on_message(topic, payload):
+        nonlocal received
+        latencies.append(time.perf_counter_ns() - STAMP.unpack_from(payload)[0])
+        received += 1
+        if received == subscribers * messages:
+            done.set()
+
+    for client in clients:
+        await client.subscribe("bench.fanout", on_message)
+    publisher = await AsyncClient(**options).connect()
+    await asyncio.sleep(0.5)
+    padding = b'x' * max(0, size - STAMP.size)
+    cpu = broker_cpu(pid)
+    started = time.perf_counter()
+    for _ in range(messages):
+        await publisher.publish("bench.fanout", STAMP.pack(time.perf_counter_ns()) + padding)
+    await publisher.flush(60)
+    try:
+        await asyncio.wait_for(done.wait(), 10)
+    except asyncio.TimeoutError:
+        pass  # Some were dropped by the overflow policy or overrun in the ring; report what arrived
+    elapsed = time.perf_counter() - started
+    cpu = broker_cpu(pid) - cpu
+    latencies.sort()
+    overrun = sum(client.stats['overrun'] for client in clients)
+    line = (f"[{label}] {subscribers} subscribers, {size}B: {received:,}/{subscribers * messages:,} delivered, "
+            f"{received / elapsed:,.0f} deliveries/s")
+    if latencies:
+        line += (f", latency p50 {latencies[len(latencies) // 2] / 1000:,.0f} us"
+                 f" p99 {latencies[int(len(latencies) * 0.99)] / 1000:,.0f} us")
+    if pid:
+        line += f", broker CPU {cpu / max(received, 1) * 1e6:.2f} us/delivery"
+    if overrun:
+        line += f", {overrun} overrun"
+    print(line)
+    for client in clients + [publisher]:
+        await client.close()
+
+
+async def ping(label, options, messages, size):
+    # One message in flight at a time, so the figure is the transport's latency rather than queueing
+    subscriber = await AsyncClient(subscriber_connections=1, **options).connect()
+    publisher = await AsyncClient(flush_interval=0, **options).connect()
+    arrived = asyncio.Event()
+    latencies = []
+
+    def on_message(topic, payload):
+        latencies.append(time.perf_counter_ns() - STAMP.unpack_from(payload)[0])
+        arrived.set()
+
+    await subscriber.subscribe("bench.ping", on_message)
+    await asyncio.sleep(0.5)
+    padding = b'x' * max(0, size - STAMP.size)
+    for _ in range(messages):
+        arrived.clear()
+        await publisher.publish("bench.ping", STAMP.pack(time.perf_counter_ns()) + padding)
+        await asyncio.wait_for(arrived.wait(), 5)
+    latencies.sort()
+    print(f"[{label}] one at a time, {size}B: latency p50 {latencies[len(latencies) // 2] / 1000:,.0f} us"
+          f" p99 {latencies[int(len(latencies) * 0.99)] / 1000:,.0f} us")
+    await subscriber.close()
+    await publisher.close()
+
+
+async def main(args):
+    tcp = {'host': args.host, 'port': args.port}
+    local = {'host': None, 'port': None, 'path': args.path}
+    await ping("TCP", tcp, args.messages // 10, args.size)
+    await ping("SHM", local, args.messages // 10, args.size)
+    for subscribers in args.subscribers:
+        await fan_out("TCP", tcp, subscribers, args.messages, args.size, args.broker_pid)
+        await fan_out("SHM", local, subscribers, args.messages, args.size, args.broker_pid)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Loopback TCP against the shared-memory transport for local fan-out. "
+                                                 "Start the broker with PUBSUB_SHM_SOCKET=<path> first.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--path", default="/tmp/pubsub.sock", help="the broker's PUBSUB_SHM_SOCKET")
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--size", type=int, default=1024, help="payload bytes")
+    parser.add_argument("--broker-pid", type=int, help="report the broker's CPU per delivery (Linux)")
+    asyncio.run(main(parser.parse_args()))
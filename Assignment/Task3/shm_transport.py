@@ -0,0 +1,163 @@
+import os
+import atexit
+import signal
+import struct
+import threading
+from multiprocessing import shared_memory, resource_tracker
+from protocol import FORMAT, NOTIFY, RING_OFFSET, encode_prefix
+from metrics import Stamped
+
+SHM_CODEC = 'shm'              # Codec name local subscribers offer in HELLO
+RING_BYTES = 64 * 1024 * 1024  # Ring capacity; a message stays readable until this much has been written after it
+
+# Segment layout: RING_HEADER, then the ring. Records are RECORD, topic, payload, never split across
+# the end of the ring (the writer skips to the start instead). Offsets are absolute byte positions,
+# so a reader can tell whether the writer has come round since a message was written. The segment
+# only ever lives on one host, so native byte order is used.
+RING_HEADER = struct.Struct('=QQ')  # capacity, reserved (end of the record being written, updated before its bytes)
+RECORD = struct.Struct('=HI')       # topic length, payload length
+NOTIFY_PREFIX = encode_prefix(NOTIFY, '', RING_OFFSET.size)
+
+
+class RingWriter:
+    """The broker's side of the shared-memory transport: one ring per broker,
+    shared by every local subscriber.
+
+    A publish is written to the ring once, whatever the number of local
+    subscribers, and each of them is sent an 8-byte offset over its Unix
+    socket instead of the message. Nothing waits for readers: a subscriber
+    that falls more than the ring's capacity behind finds its messages
+    overwritten and counts them as lost, the same trade the drop-oldest
+    queue policy makes. write() may be called from several threads."""
+
+    def __init__(self, size=RING_BYTES, name=None):
+        self.segment = shared_memory.SharedMemory(name, create=True, size=RING_HEADER.size + size)
+        self.capacity = size
+        self.end = 0  # Absolute offset just past the newest record
+        self.lock = threading.Lock()
+        RING_HEADER.pack_into(self.segment.buf, 0, size, 0)
+
+    @property
+    def name(self):
+        return self.segment.name
+
+    def write(self, topic, payload):
+        """Append one message; returns its offset, or None if it can't fit in the ring."""
+        topic = topic.encode(FORMAT)
+        length = RECORD.size + len(topic) + len(payload)
+        if length > self.capacity:
+            return None
+        buf = self.segment.buf
+        with self.lock:
+            offset = self.end
+            start = offset % self.capacity
+            if start + length > self.capacity:
+                offset += self.capacity - start  # Skip the tail rather than split the record
+                start = 0
+            # Readers check reserved after copying a record, so claim the space before overwriting it.
+            # Python has no memory fences; this relies on stores staying in order, as they do on x86-64.
+            struct.pack_into('=Q', buf, 8, offset + length)
+            position = RING_HEADER.size + start
+            RECORD.pack_into(buf, position, len(topic), len(payload))
+            position += RECORD.size
+            buf[position:position + len(topic)] = topic
+            position += len(topic)
+            buf[position:position + len(payload)] = payload
+            self.end = offset + length
+        return offset
+
+    def frame(self, parts, topic, metrics):
+        """The NOTIFY variant of an encoded MESSAGE (prefix, payload), or the
+        original parts when the payload is too large for the ring. Like
+        compress_frame(), brokers call this once per publish and share the
+        result between all local subscribers."""
+        offset = self.write(topic, parts[1])
+        if offset is None:
+            return parts
+        metrics.add('bytes_shared', len(parts[1]))
+        return Stamped((NOTIFY_PREFIX, RING_OFFSET.pack(offset)), getattr(parts, 'received', None))
+
+    @staticmethod
+    def coalesce(items):
+        """A writer's batch with each run of NOTIFY frames merged into one
+        NOTIFY carrying all their offsets. Decoding the frame, not reading the
+        ring, is most of what a notification costs the subscriber, so it pays
+        that once per batch instead of once per message."""
+        merged = []
+        offsets = []
+        for item in items:
+            if item[0] is NOTIFY_PREFIX:
+                offsets.append(item[1])
+                continue
+            if offsets:
+                merged.append(_notify(offsets))
+                offsets = []
+            merged.append(item)
+        if offsets:
+            merged.append(_notify(offsets))
+        return merged
+
+    def close_on_exit(self):
+        """Unlink the ring when the broker exits, on SIGTERM as well, which
+        skips atexit and would leave the segment in /dev/shm for good."""
+        atexit.register(self.close)
+
+        def terminate(signum, frame):
+            self.close()
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)  # Die of the signal as before, so supervisors see the same exit
+
+        signal.signal(signal.SIGTERM, terminate)
+
+    def close(self):
+        if self.segment is None:
+            return
+        self.segment.close()
+        self.segment.unlink()
+        self.segment = None
+
+
+def _notify(offsets):
+    if len(offsets) == 1:
+        return NOTIFY_PREFIX, offsets[0]
+    return encode_prefix(NOTIFY, '', RING_OFFSET.size * len(offsets)), b''.join(offsets)
+
+
+class RingReader:
+    """A local subscriber's read-only view of the broker's ring."""
+
+    def __init__(self, name):
+        self.name = name
+        self.segment = _attach(name)
+        self.capacity = RING_HEADER.unpack_from(self.segment.buf, 0)[0]
+
+    def read(self, offset):
+        """(topic, payload) of the message at offset, or None if the writer has
+        overwritten it since."""
+        buf = self.segment.buf
+        start = RING_HEADER.size + offset % self.capacity
+        topic_length, payload_length = RECORD.unpack_from(buf, start)
+        position = start + RECORD.size
+        end = position + topic_length + payload_length
+        if end > RING_HEADER.size + self.capacity:
+            return None  # The lengths themselves were overwritten
+        topic = str(buf[position:position + topic_length], FORMAT)
+        payload = bytes(buf[position + topic_length:end])
+        # Only valid if the writer hadn't started overwriting the record while it was copied
+        if struct.unpack_from('=Q', buf, 8)[0] - offset > self.capacity:
+            return None
+        return topic, payload
+
+    def close(self):
+        self.segment.close()
+
+
+def _attach(name):
+    # Before Python 3.13 attaching registers the segment with this process's resource tracker,
+    # which would unlink it on exit; only the broker that created it should
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        segment = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
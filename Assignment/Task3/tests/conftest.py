@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+import socket
+import subprocess
+import pytest
+
+TASK3 = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The broker modules import each other by bare name, as they do when run from Task3/
+sys.path.insert(0, TASK3)
+
+from protocol import HELLO, HEARTBEAT, FrameDecoder, encode_frame  # noqa: E402
+
+STARTUP_TIMEOUT = 10.0
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+class Wire:
+    """A raw protocol connection to a broker: send frames, wait for the ones that come back."""
+
+    def __init__(self, port=None, path=None):
+        if path:
+            self.sock = socket.socket(socket.AF_UNIX)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.settimeout(5)
+        self.decoder = FrameDecoder()
+        self.pending = []
+
+    def send(self, opcode, topic='', payload=b''):
+        self.sock.sendall(encode_frame(opcode, topic, payload))
+
+    def hello(self, role, topic=''):
+        self.send(HELLO, topic, role)
+
+    def frames(self, count=1, opcode=None, timeout=5.0):
+        """The next count frames (only those with opcode, if given); heartbeats are answered and skipped."""
+        deadline = time.monotonic() + timeout
+        found = []
+        while len(found) < count:
+            while self.pending and len(found) < count:
+                frame = self.pending.pop(0)
+                if frame[0] == HEARTBEAT:
+                    self.send(HEARTBEAT)
+                elif opcode is None or frame[0] == opcode:
+                    found.append(frame)
+            if len(found) == count:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"got {len(found)} of {count} frames")
+            self.sock.settimeout(remaining)
+            frames = self.decoder.recv_into(self.sock)
+            if frames is None:
+                raise ConnectionError("broker closed the connection")
+            self.pending.extend(frames)
+        return found
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def start_broker(tmp_path):
+    """start_broker(program='async_server.py', *arguments, env=None) runs a broker on a free
+    port and returns the port; positional arguments follow <port> <host> on its command line."""
+    processes = []
+
+    def start(program='async_server.py', *arguments, env=None, port=None):
+        port = port or free_port()
+        environment = dict(os.environ, **(env or {}))
+        command = [sys.executable, program, str(port), '127.0.0.1'] + [str(argument) for argument in arguments]
+        process = subprocess.Popen(command, cwd=TASK3, env=environment,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes.append(process)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return port
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"{program} didn't start")
+                time.sleep(0.05)
+
+    start.processes = processes
+    yield start
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+@pytest.fixture
+def wires():
+    """connect(port) opens a Wire that is closed after the test."""
+    opened = []
+
+    def connect(port=None, path=None):
+        wire = Wire(port, path)
+        opened.append(wire)
+        return wire
+
+    yield connect
+    for wire in opened:
+        wire.close()
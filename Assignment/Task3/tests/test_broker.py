@@ -0,0 +1,76 @@
+import socket
+import pytest
+import broker
+from protocol import HELLO, PUBLISH, BATCH, MESSAGE, ACK, ERROR, SUBSCRIBE, UNSUBSCRIBE, FrameDecoder, decode_ack, encode_batch, encode_frame
+
+
+@pytest.fixture
+def connect():
+    """connect(role, topic='') says HELLO for a new in-process broker.Client and returns it."""
+    clients = []
+
+    def hello(role, topic=''):
+        client = broker.Client(('test', len(clients)))
+        clients.append(client)
+        refused = client.hello((HELLO, topic, role.encode()), conn=socket.socket())
+        assert refused is None
+        return client
+
+    yield hello
+    for client in clients:
+        client.close()
+        if client.queue:
+            client.queue.conn.close()
+
+
+def test_publish_is_encoded_once_for_every_subscriber(connect):
+    subscribers = [connect('SUBSCRIBER', 'shared') for _ in range(3)]
+    publisher = connect('PUBLISHER', 'shared')
+    payload = b'one copy'
+    publisher.handle([(PUBLISH, 'shared', payload)])
+    frames = [subscriber.queue.take(timeout=0) for subscriber in subscribers]
+    first = frames[0][0]
+    assert b''.join(first) == encode_frame(MESSAGE, 'shared', payload)
+    assert first[1] is payload  # The publisher's payload itself, not a copy
+    for (frame,) in frames[1:]:
+        assert frame[0] is first[0] and frame[1] is first[1]
+
+
+def test_one_cumulative_ack_per_read(connect):
+    publisher = connect('PUBLISHER', 'counted')
+    replies, published = publisher.handle([(PUBLISH, 'counted', b'1'),
+                                           (BATCH, 'counted', encode_batch([b'2', b'3', b'4']))])
+    assert published == 4
+    (opcode, _, ack), = FrameDecoder().feed(b''.join(replies))
+    assert opcode == ACK and decode_ack(ack)[0] == 4
+    replies, _ = publisher.handle([(PUBLISH, 'counted', b'5')])
+    (_, _, ack), = FrameDecoder().feed(b''.join(replies))
+    assert decode_ack(ack)[0] == 5
+
+
+def topics_received(subscriber):
+    return [FrameDecoder().feed(b''.join(frame))[0][1] for frame in subscriber.queue.take(timeout=0)]
+
+
+def test_wildcard_and_multi_pattern_subscriptions(connect):
+    subscriber = connect('SUBSCRIBER', 'sports.*,news.#')
+    publisher = connect('PUBLISHER', 'sports.tennis')
+    for topic in ('sports.tennis', 'news.local.weather', 'sports.tennis.uk', 'weather'):
+        publisher.handle([(PUBLISH, topic, b'x')])
+    assert topics_received(subscriber) == ['sports.tennis', 'news.local.weather']
+
+
+def test_subscribe_and_unsubscribe_frames(connect):
+    subscriber = connect('SUBSCRIBER', 'a')
+    publisher = connect('PUBLISHER', 'a')
+    subscriber.handle([(SUBSCRIBE, 'b.#', b''), (UNSUBSCRIBE, 'a', b'')])
+    publisher.handle([(PUBLISH, 'a', b'x'), (PUBLISH, 'b.c', b'y')])
+    assert topics_received(subscriber) == ['b.c']
+
+
+def test_publishing_to_a_wildcard_is_refused(connect):
+    assert broker.Client(('test', 'wild')).hello((HELLO, 'sports.*', b'PUBLISHER'), conn=None) is not None
+    publisher = connect('PUBLISHER', 'sports.tennis')
+    replies, published = publisher.handle([(PUBLISH, 'sports.#', b'x')])
+    assert published == 0
+    assert FrameDecoder().feed(b''.join(replies))[0][0] == ERROR
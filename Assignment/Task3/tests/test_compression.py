@@ -0,0 +1,70 @@
+import os
+import socket
+import zlib
+import pytest
+import broker
+from compression import COMPRESS_MIN, compress, compress_frame, decompress, negotiate
+from metrics import Metrics
+from protocol import HELLO, PUBLISH, MESSAGE, COMPRESSED, FrameDecoder, encode_prefix
+
+DOCUMENT = b'{"sensor": "temp-001", "region": "eu", "value": 21.5}' * 40
+
+
+@pytest.mark.parametrize('offered, expected', [
+    ('zlib', 'zlib'),
+    ('brotli, zlib', 'zlib'),  # Unknown codecs are skipped, spaces ignored
+    ('brotli', None),
+    ('', None),
+])
+def test_negotiate_picks_the_first_supported_codec(offered, expected):
+    assert negotiate(offered) == expected
+
+
+def test_compress_round_trip():
+    compressed = compress('zlib', DOCUMENT)
+    assert len(compressed) < len(DOCUMENT)
+    assert decompress('zlib', compressed) == DOCUMENT
+
+
+@pytest.mark.parametrize('payload', [b'x' * (COMPRESS_MIN - 1), os.urandom(4096)])
+def test_compression_is_skipped_when_it_does_not_pay(payload):
+    assert compress('zlib', payload) is None
+
+
+def test_compress_frame_counts_bytes_and_falls_back_to_the_original():
+    metrics = Metrics()
+    parts = (encode_prefix(MESSAGE, 'readings', len(DOCUMENT)), DOCUMENT)
+    prefix, payload = compress_frame(parts, 'readings', 'zlib', metrics)
+    (opcode, topic, _), = FrameDecoder().feed(prefix + payload)
+    assert (opcode, topic, zlib.decompress(payload)) == (COMPRESSED, 'readings', DOCUMENT)
+    small = (encode_prefix(MESSAGE, 'readings', 2), b'{}')
+    assert compress_frame(small, 'readings', 'zlib', metrics) is small
+    counters = metrics.counters.snapshot()
+    assert counters['bytes_before_compression'] == len(DOCUMENT)
+    assert counters['bytes_after_compression'] == len(payload)
+
+
+def decode(items):
+    return FrameDecoder().feed(b''.join(b''.join(item) for item in items))
+
+
+def test_broker_compresses_once_per_codec():
+    clients = []
+    for number, role in enumerate((b'SUBSCRIBER zlib', b'SUBSCRIBER zlib', b'SUBSCRIBER', b'PUBLISHER')):
+        client = broker.Client(('compression', number))
+        assert client.hello((HELLO, 'readings', role), conn=socket.socket()) is None
+        clients.append(client)
+    first, second, plain, publisher = clients
+    publisher.handle([(PUBLISH, 'readings', DOCUMENT), (PUBLISH, 'readings', b'short')])
+
+    first_items, second_items = first.queue.take(timeout=0), second.queue.take(timeout=0)
+    assert first_items[1] is second_items[1]  # Compressed once, shared by both zlib subscribers
+    hello, large, small = decode(first_items)
+    assert hello == (HELLO, '', b'zlib')  # The codec answer comes before any message
+    assert large[0] == COMPRESSED and zlib.decompress(large[2]) == DOCUMENT
+    assert small == (MESSAGE, 'readings', b'short')
+    assert decode(plain.queue.take(timeout=0)) == [(MESSAGE, 'readings', DOCUMENT), (MESSAGE, 'readings', b'short')]
+    for client in clients:
+        client.close()
+        if client.queue:
+            client.queue.conn.close()
@@ -0,0 +1,62 @@
+import json
+import time
+import pytest
+from conftest import free_port
+from protocol import HELLO, PUBLISH, MESSAGE, STATS
+
+
+def stats(wires, port):
+    monitor = wires(port)
+    monitor.hello('MONITOR')
+    monitor.send(STATS)
+    (_, _, report), = monitor.frames(1, STATS)
+    return json.loads(report)
+
+
+def wait_for_interest(wires, port, pattern):
+    deadline = time.monotonic() + 10
+    while pattern not in stats(wires, port).get('peer_interest', {}):
+        if time.monotonic() > deadline:
+            pytest.fail(f"node on {port} never heard about '{pattern}'")
+        time.sleep(0.1)
+
+
+@pytest.fixture
+def nodes(start_broker):
+    first, second = free_port(), free_port()
+    start_broker('federation.py', f'127.0.0.1:{second}', port=first)
+    start_broker('federation.py', f'127.0.0.1:{first}', port=second)
+    return first, second
+
+
+def test_publish_crosses_to_the_node_with_interest_once(nodes, wires):
+    first, second = nodes
+    local = wires(first)
+    local.hello('SUBSCRIBER zlib', 'news.#')
+    local.frames(1, HELLO)
+    remote = wires(second)
+    remote.hello('SUBSCRIBER zlib', 'news.#')
+    remote.frames(1, HELLO)
+    wait_for_interest(wires, first, 'news.#')
+    wait_for_interest(wires, second, 'news.#')
+    publisher = wires(first)
+    publisher.hello('PUBLISHER', 'news.uk')
+    publisher.send(PUBLISH, 'news.uk', b'one')
+    publisher.send(PUBLISH, 'news.uk', b'two')
+    for subscriber in (local, remote):
+        assert [payload for _, _, payload in subscriber.frames(2, MESSAGE)] == [b'one', b'two']
+        with pytest.raises(TimeoutError):
+            subscriber.frames(1, MESSAGE, timeout=0.3)  # Never echoed back between the nodes
+
+
+def test_topics_nobody_wants_stay_local(nodes, wires):
+    first, second = nodes
+    remote = wires(second)
+    remote.hello('SUBSCRIBER zlib', 'sports.#')
+    remote.frames(1, HELLO)
+    wait_for_interest(wires, first, 'sports.#')
+    publisher = wires(first)
+    publisher.hello('PUBLISHER', 'weather')
+    publisher.send(PUBLISH, 'weather', b'rain')
+    publisher.send(PUBLISH, 'sports.tennis', b'15-0')
+    assert remote.frames(1, MESSAGE) == [(MESSAGE, 'sports.tennis', b'15-0')]
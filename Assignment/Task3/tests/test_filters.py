@@ -0,0 +1,106 @@
+import json
+import socket
+import pytest
+import broker
+from filters import MAX_CONJUNCTIONS, FilterError, FilterIndex, parse, parse_document
+from protocol import HELLO, PUBLISH, MESSAGE, ERROR, FILTER, FrameDecoder
+
+
+@pytest.mark.parametrize('expression, document, expected', [
+    ('region == "eu"', {'region': 'eu'}, True),
+    ('region == "eu"', {'region': 'us'}, False),
+    ('region != "eu"', {'region': 'us'}, True),
+    ('region != "eu"', {}, False),  # Comparisons on a missing field are false
+    ('priority >= 3', {'priority': 3}, True),
+    ('priority > 3', {'priority': 3}, False),
+    ('priority < 2.5', {'priority': 2}, True),
+    ('priority <= -1e3', {'priority': -1000}, True),
+    ('name > "m"', {'name': 'n'}, True),
+    ('region in ("eu", "us")', {'region': 'us'}, True),
+    ('region in ("eu", "us")', {'region': 'apac'}, False),
+    ('meta.source != "test"', {'meta': {'source': 'prod'}}, True),
+    ('meta.source == "test"', {'meta': 'flat'}, False),
+    ('(kind == "order" or kind == "refund") and priority >= 3', {'kind': 'refund', 'priority': 4}, True),
+    ('(kind == "order" or kind == "refund") and priority >= 3', {'kind': 'refund', 'priority': 1}, False),
+    ('flag == true', {'flag': 1}, False),  # Values only compare within their JSON type
+    ('count == 3', {'count': '3'}, False),
+    ('gone == null', {'gone': None}, True),
+    ('tags == "a"', {'tags': ['a']}, False),
+])
+def test_match(expression, document, expected):
+    index = FilterIndex()
+    index.set('subscriber', expression)
+    assert index.match(document) == ({'subscriber'} if expected else set())
+
+
+@pytest.mark.parametrize('expression', [
+    'region ==', 'region = "eu"', '(region == "eu"', 'region == "eu")', 'priority > true',
+    'region in "eu"', '== 3', 'region == "eu" and', 'region == @',
+])
+def test_invalid_filters_are_rejected(expression):
+    with pytest.raises(FilterError):
+        parse(expression)
+
+
+def test_expansion_is_capped():
+    clause = ' and '.join(f'(f{n} == 1 or f{n} == 2)' for n in range(7))  # 2**7 alternatives
+    with pytest.raises(FilterError, match=str(MAX_CONJUNCTIONS)):
+        parse(clause)
+
+
+def test_identical_conjunctions_are_shared_and_cleaned_up():
+    index = FilterIndex()
+    index.set('a', 'region == "eu" and priority >= 3')
+    index.set('b', 'priority >= 3 and region == "eu"')
+    index.set('c', 'region == "us"')
+    assert index.snapshot()['conjunctions'] == 2
+    assert index.match({'region': 'eu', 'priority': 5}) == {'a', 'b'}
+    index.set('a', '  ')  # Blank removes
+    index.remove('b')
+    index.remove('c')
+    snapshot = index.snapshot()
+    assert (snapshot['filters'], snapshot['conjunctions'], snapshot['predicates'], snapshot['fields']) == (0, 0, 0, 0)
+
+
+def test_bad_replacement_keeps_the_old_filter():
+    index = FilterIndex()
+    index.set('a', 'region == "eu"')
+    with pytest.raises(FilterError):
+        index.set('a', 'region ==')
+    assert index.match({'region': 'eu'}) == {'a'}
+
+
+@pytest.mark.parametrize('payload, expected', [
+    (b'{"a": 1}', {'a': 1}), (memoryview(b'{"a": 1}'), {'a': 1}),
+    (b'[1, 2]', None), (b'not json', None), (b'\xff', None),
+])
+def test_parse_document(payload, expected):
+    assert parse_document(payload) == expected
+
+
+@pytest.fixture
+def subscriber():
+    client = broker.Client(('filters', 'subscriber'))
+    assert client.hello((HELLO, 'orders', b'SUBSCRIBER'), conn=socket.socket()) is None
+    yield client
+    client.close()
+    client.queue.conn.close()
+
+
+def test_broker_applies_the_subscriber_filter(subscriber):
+    subscriber.handle([(FILTER, '', b'region == "eu" and total > 100')])
+    publisher = broker.Client(('filters', 'publisher'))
+    assert publisher.hello((HELLO, 'orders', b'PUBLISHER'), conn=socket.socket()) is None
+    documents = [{'region': 'eu', 'total': 150}, {'region': 'us', 'total': 150}, {'region': 'eu', 'total': 50}]
+    publisher.handle([(PUBLISH, 'orders', json.dumps(document).encode()) for document in documents]
+                     + [(PUBLISH, 'orders', b'not json')])
+    publisher.close()
+    frames = FrameDecoder().feed(b''.join(b''.join(item) for item in subscriber.queue.take(timeout=0)))
+    assert [(opcode, json.loads(payload)) for opcode, _, payload in frames] == [(MESSAGE, documents[0])]
+
+
+def test_broker_reports_an_invalid_filter(subscriber):
+    subscriber.handle([(FILTER, '', b'total >')])
+    (opcode, _, payload), = FrameDecoder().feed(b''.join(*subscriber.queue.take(timeout=0)))
+    assert opcode == ERROR and payload.startswith(b'Invalid filter')
+    assert subscriber.connected
@@ -0,0 +1,129 @@
+import time
+import socket
+import pytest
+import broker
+from groups import ConsumerGroups
+from outbound import OutboundQueue
+from protocol import (HELLO, PUBLISH, ACK, ERROR, DELIVER, CONSUME, CONSUME_OPTIONS, DELIVERY, DELIVERY_ID, MESSAGE,
+                      FrameDecoder, encode_prefix)
+
+
+def publish(groups, topic, payload):
+    return groups.offer((encode_prefix(MESSAGE, topic, len(payload)), payload), topic)
+
+
+def deliveries(queue):
+    # [(delivery id, attempt, message)] of the DELIVER frames waiting in queue
+    received = []
+    for opcode, _, payload in FrameDecoder().feed(b''.join(b''.join(item) for item in queue.take(timeout=0))):
+        assert opcode == DELIVER
+        received.append(DELIVERY.unpack_from(payload) + (payload[DELIVERY.size:],))
+    return received
+
+
+def test_named_group_balances_round_robin():
+    groups = ConsumerGroups()
+    first, second = OutboundQueue(None), OutboundQueue(None)
+    groups.join(('c', 1), first, 'jobs.*', 'workers')
+    groups.join(('c', 2), second, 'jobs.*', 'workers')
+    for number in range(4):
+        assert publish(groups, 'jobs.resize', b'%d' % number) == 1
+    assert [message for _, _, message in deliveries(first)] == [b'0', b'2']
+    assert [message for _, _, message in deliveries(second)] == [b'1', b'3']
+    assert publish(groups, 'other', b'x') == 0
+
+
+def test_window_holds_messages_until_acked():
+    groups = ConsumerGroups()
+    queue = OutboundQueue(None)
+    groups.join(('c', 1), queue, 'jobs', window=2)
+    for number in range(3):
+        publish(groups, 'jobs', b'%d' % number)
+    (first, _, _), (second, _, _) = deliveries(queue)
+    assert deliveries(queue) == []  # The third waits in the backlog
+    groups.ack(('c', 1), [first, first, 999])  # Repeats and unknown ids are ignored
+    (third, attempt, message), = deliveries(queue)
+    assert (attempt, message) == (1, b'2')
+    stats, = groups.snapshot().values()
+    assert (stats['acked'], stats['inflight'], stats['backlog']) == (1, 2, 0)
+
+
+def test_unacked_deliveries_are_redelivered_after_the_timeout():
+    groups = ConsumerGroups()
+    queue = OutboundQueue(None)
+    groups.join(('c', 1), queue, 'jobs', timeout=5)
+    publish(groups, 'jobs', b'a')
+    publish(groups, 'jobs', b'b')
+    (first, _, _), (second, _, _) = deliveries(queue)
+    groups.ack(('c', 1), [second])
+    groups.sweep(now=float('inf'))
+    (again, attempt, message), = deliveries(queue)
+    assert (attempt, message) == (2, b'a') and again != first
+    groups.ack(('c', 1), [first])  # The old id no longer settles anything
+    assert next(iter(groups.snapshot().values()))['inflight'] == 1
+
+
+def test_rejoining_with_a_shorter_timeout_sweeps_out_of_order():
+    groups = ConsumerGroups()
+    queue = OutboundQueue(None)
+    groups.join(('c', 1), queue, 'jobs', timeout=1000)
+    publish(groups, 'jobs', b'slow')
+    groups.join(('c', 1), queue, 'jobs', timeout=1)
+    publish(groups, 'jobs', b'fast')
+    deliveries(queue)
+    groups.sweep(now=time.monotonic() + 2)
+    assert [message for _, _, message in deliveries(queue)] == [b'fast']  # Found behind the not-yet-due one
+
+
+def test_leaving_hands_inflight_deliveries_to_the_rest():
+    groups = ConsumerGroups()
+    first, second = OutboundQueue(None), OutboundQueue(None)
+    groups.join(('c', 1), first, 'jobs', 'workers', window=1)
+    groups.join(('c', 2), second, 'jobs', 'workers', window=5)
+    publish(groups, 'jobs', b'a')
+    deliveries(first)
+    assert groups.leave(('c', 1)) == {'jobs'}
+    (_, attempt, message), = deliveries(second)
+    assert (attempt, message) == (2, b'a')
+
+
+def test_private_group_goes_away_with_its_member():
+    groups = ConsumerGroups()
+    groups.join(('c', 1), OutboundQueue(None), 'jobs')
+    groups.leave(('c', 1))
+    assert not groups
+
+
+@pytest.fixture
+def consumer():
+    client = broker.Client(('groups', 'consumer'))
+    assert client.hello((HELLO, '', b'SUBSCRIBER'), conn=socket.socket()) is None
+    yield client
+    client.close()
+    client.queue.conn.close()
+
+
+def test_broker_delivers_to_consumers_and_takes_acks(consumer):
+    consumer.handle([(CONSUME, 'tasks', CONSUME_OPTIONS.pack(1, 0))])
+    publisher = broker.Client(('groups', 'publisher'))
+    assert publisher.hello((HELLO, 'tasks', b'PUBLISHER'), conn=socket.socket()) is None
+    publisher.handle([(PUBLISH, 'tasks', b'one'), (PUBLISH, 'tasks', b'two')])
+    (delivery_id, _, message), = deliveries(consumer.queue)
+    assert message == b'one'
+    consumer.handle([(ACK, '', DELIVERY_ID.pack(delivery_id))])
+    assert [message for _, _, message in deliveries(consumer.queue)] == [b'two']
+    publisher.close()
+
+
+@pytest.mark.parametrize('options', [CONSUME_OPTIONS.pack(0, 0), b'\x00'])
+def test_broker_refuses_consume_without_a_window(consumer, options):
+    consumer.handle([(CONSUME, 'tasks', options)])
+    (opcode, _, _), = FrameDecoder().feed(b''.join(b''.join(item) for item in consumer.queue.take(timeout=0)))
+    assert opcode == ERROR
+
+
+def test_broker_refuses_a_torn_ack(consumer):
+    replies, _ = consumer.handle([(ACK, '', DELIVERY_ID.pack(1)[:5])])
+    (opcode, _, payload), = FrameDecoder().feed(b''.join(replies))
+    assert opcode == ERROR and b'8-byte' in payload
+    assert consumer.connected
@@ -0,0 +1,78 @@
+import socket
+import threading
+import pytest
+import client
+from timer_wheel import TimerWheel
+from protocol import HEARTBEAT, DELIVER, ACK, DELIVERY, DELIVERY_ID, FrameDecoder, encode_frame
+
+
+@pytest.fixture
+def wheel():
+    # interval 2 ticks, timeout 5 ticks, on a clock the test moves by hand
+    wheel = TimerWheel(interval=2, timeout=5, tick=1)
+    wheel.clock = wheel.now
+    wheel._current = lambda: wheel.clock
+    return wheel
+
+
+def advance_to(wheel, tick):
+    wheel.clock = wheel.now + tick
+    return wheel.advance()
+
+
+def test_silent_connection_is_pinged_then_reaped(wheel):
+    wheel.add('quiet', 'conn')
+    assert advance_to(wheel, 1) == ([], [])
+    assert advance_to(wheel, 1) == ([('quiet', 'conn')], [])
+    pings, reaps = advance_to(wheel, 3)
+    assert reaps == [('quiet', 'conn')]
+    assert len(wheel) == 0
+
+
+def test_touched_connection_is_left_alone(wheel):
+    wheel.add('chatty', 'conn')
+    for _ in range(20):
+        assert advance_to(wheel, 1) == ([], [])
+        wheel.touch('chatty')
+    assert len(wheel) == 1
+
+
+def test_answering_the_ping_keeps_the_connection(wheel):
+    wheel.add('answers', 'conn')
+    pings, _ = advance_to(wheel, 2)
+    assert pings == [('answers', 'conn')]
+    wheel.touch('answers')
+    assert advance_to(wheel, 2) == ([('answers', 'conn')], [])  # Pinged again after a new silence, not reaped
+
+
+def test_removed_and_readded_connections(wheel):
+    wheel.add('gone', 'old')
+    wheel.remove('gone')
+    wheel.touch('gone')  # After removal this is a no-op
+    assert advance_to(wheel, 10) == ([], [])
+    wheel.add('back', 'first')
+    wheel.add('back', 'second')  # Re-filing replaces the connection
+    pings, _ = advance_to(wheel, 2)
+    assert pings == [('back', 'second')]
+
+
+def test_client_answers_heartbeats_and_acks_deliveries():
+    ours, broker_side = socket.socketpair()
+    with ours, broker_side:
+        listener = threading.Thread(target=client.listen_for_messages, args=(ours,), daemon=True)
+        with client.SEND_LOCK:
+            # The prompt is mid-send: the listener's answers must wait instead of interleaving
+            listener.start()
+            broker_side.sendall(encode_frame(HEARTBEAT)
+                                + encode_frame(DELIVER, 'jobs', DELIVERY.pack(7, 1) + b'work'))
+            broker_side.settimeout(0.2)
+            with pytest.raises(socket.timeout):
+                broker_side.recv(1)
+        broker_side.settimeout(5)
+        decoder = FrameDecoder()
+        frames = []
+        while len(frames) < 2:
+            frames += decoder.feed(broker_side.recv(1024))
+        assert frames == [(HEARTBEAT, '', b''), (ACK, '', DELIVERY_ID.pack(7))]
+        ours.shutdown(socket.SHUT_RDWR)
+        listener.join(5)
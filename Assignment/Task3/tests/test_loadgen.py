@@ -0,0 +1,42 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+import loadgen
+from conftest import TASK3, free_port
+
+
+def run_loadgen(*arguments):
+    command = [sys.executable, os.path.join(TASK3, 'loadgen.py'), '--port', str(free_port()), '--json',
+               '--duration', '1', '--warmup', '0', '--drain', '3', '--settle', '0.3',
+               '--publishers', '2', '--subscribers', '4', '--rate', '200', *arguments]
+    finished = subprocess.run(command, capture_output=True, text=True, timeout=60)
+    assert finished.returncode == 0, finished.stderr
+    return json.loads(finished.stdout)
+
+
+@pytest.mark.parametrize('server', ['threaded', 'async'])
+def test_spawned_broker_delivers_everything(server):
+    report = run_loadgen('--spawn', server)
+    assert report['errors'] == []
+    assert report['published'] > 0
+    assert report['delivered'] == report['expected'] == report['published']  # One subscriber per topic
+    assert set(report['latency_ms']) == {'p50', 'p99', 'p99.9', 'max', 'mean'}
+    assert report['broker']['rss_kib'] > 0
+
+
+def test_compression_run_reports_the_ratio():
+    report = run_loadgen('--spawn', 'async', '--codec', 'zlib', '--payload-kind', 'json', '--payload-size', '2048')
+    assert report['delivered'] == report['expected']
+    assert report['codec'] == 'zlib'
+    assert 0 < report['compression']['ratio'] < 0.5
+
+
+@pytest.mark.parametrize('kind', ['filler', 'json'])
+def test_payloads_are_stamped_and_sized(kind):
+    bodies = loadgen.payload_bodies(kind, 300)
+    payload = loadgen.make_payload(bodies)
+    assert len(payload) == 300
+    match = loadgen.STAMP_PATTERN.match(payload)
+    assert match and len(loadgen.STAMP_PATTERN.findall(payload)) == 1
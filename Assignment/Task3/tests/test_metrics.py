@@ -0,0 +1,101 @@
+import json
+import socket
+import threading
+import broker
+import metrics
+from metrics import Counters, Histogram, Metrics, Stamped
+from protocol import HELLO, PUBLISH, STATS, ERROR, STATS_PROMETHEUS, FrameDecoder
+
+
+def test_counters_add_up_across_threads_including_finished_ones():
+    counters = Counters()
+
+    def bump():
+        for _ in range(1000):
+            counters.add('hits')
+
+    threads = [threading.Thread(target=bump) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counters.add('hits', 5)
+    assert counters.snapshot() == {'hits': 4005}
+    assert counters.snapshot() == {'hits': 4005}  # Retired shards are folded in once, not twice
+
+
+def test_histogram_percentiles_stay_within_bucket_error():
+    histogram = Histogram()
+    for value in range(1, 10001):
+        histogram.record(value)
+    summary = histogram.summary()
+    assert summary['count'] == 10000
+    assert summary['mean'] == 5000.5
+    for quantile, exact in (('p50', 5000), ('p99', 9900), ('p99.9', 9990)):
+        assert exact <= summary[quantile] <= exact * 1.04  # Upper bound of a bucket keeping 6 significant bits
+    assert 10000 <= summary['max'] <= 10400
+
+
+def test_empty_histogram_summary():
+    assert Histogram().summary() == {'count': 0, 'mean': 0, 'max': 0}
+
+
+def test_small_values_get_exact_buckets():
+    for value in range(64):
+        assert Histogram.bucket_bounds(value) == (value, value + 1)
+    assert Histogram.bucket_bounds(114) == (200, 204)  # Where 200 lands: 6 significant bits, 4 values wide
+
+
+def test_delivered_records_latency_only_for_stamped_frames():
+    recorder = Metrics(('deliveries',))
+    recorder.delivered([Stamped((b'frame',)), (b'reply',)])
+    snapshot = recorder.snapshot()
+    assert snapshot['latency_us']['count'] == 1
+    assert snapshot['counters'] == {'deliveries': 0}  # Named counters show up before their first increment
+
+
+def test_per_topic_counts_and_prometheus_labels():
+    recorder = Metrics()
+    recorder.published('say "hi"', 3)
+    recorder.published('say "hi"', 2)
+    text = recorder.prometheus({'subscribers': 7})
+    assert 'pubsub_subscribers 7' in text
+    assert 'pubsub_topic_publishes_total{topic="say \\"hi\\""} 2' in text
+    assert 'pubsub_topic_deliveries_total{topic="say \\"hi\\""} 5' in text
+    assert 'pubsub_deliver_latency_seconds_count 0' in text
+
+
+def test_log_respects_the_level(capsys, monkeypatch):
+    monkeypatch.setattr(metrics, 'LOG_LEVEL', metrics.LOG_LEVEL)
+    metrics.set_level('warning')
+    metrics.log(metrics.INFO, 'quiet')
+    metrics.log(metrics.ERROR, 'loud')
+    assert capsys.readouterr().out == 'loud\n'
+    assert not metrics.enabled(metrics.DEBUG)
+
+
+def monitor():
+    client = broker.Client(('test', 'monitor'))
+    assert client.hello((HELLO, '', b'MONITOR'), conn=socket.socket()) is None
+    return client
+
+
+def test_stats_reports_counters_as_json_and_prometheus():
+    publisher = broker.Client(('test', 'publisher'))
+    assert publisher.hello((HELLO, 'measured', b'PUBLISHER'), conn=socket.socket()) is None
+    publisher.handle([(PUBLISH, 'measured', b'x')])
+    client = monitor()
+    replies, _ = client.handle([(STATS, '', b''), (STATS, '', STATS_PROMETHEUS)])
+    (_, _, report), (_, _, text) = FrameDecoder().feed(b''.join(replies))
+    stats = json.loads(report)
+    assert stats['publishes_received'] >= 1
+    assert stats['metrics']['topics']['measured']['publishes'] == 1
+    assert 'pubsub_publishes_received_total' in text.decode()
+    publisher.close()
+    client.close()
+
+
+def test_first_frame_must_be_hello():
+    refused = broker.Client(('test', 'rude')).hello((STATS, '', b''), conn=socket.socket())
+    (opcode, _, payload), = FrameDecoder().feed(refused)
+    assert opcode == ERROR and payload == b'Expected HELLO handshake'
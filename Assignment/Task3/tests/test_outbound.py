@@ -0,0 +1,76 @@
+import json
+import time
+import socket
+import pytest
+from outbound import OutboundQueue, DROP_OLDEST, DROP_NEWEST, DISCONNECT
+from protocol import NORMAL, PUBLISH, ACK, STATS, decode_ack
+
+
+def fill(queue, count):
+    return [queue.put(number, NORMAL) for number in range(count)]
+
+
+def test_drop_oldest_keeps_the_newest_frames():
+    queue = OutboundQueue(None, limit=3, policy=DROP_OLDEST)
+    assert all(fill(queue, 5))
+    assert queue.take(timeout=0) == [2, 3, 4]
+    assert queue.snapshot()['dropped'] == 2
+
+
+def test_drop_newest_keeps_the_oldest_frames():
+    queue = OutboundQueue(None, limit=3, policy=DROP_NEWEST)
+    assert all(fill(queue, 5))
+    assert queue.take(timeout=0) == [0, 1, 2]
+
+
+def test_disconnect_policy_refuses_and_closes():
+    queue = OutboundQueue(None, limit=3, policy=DISCONNECT)
+    assert fill(queue, 4) == [True, True, True, False]
+    assert queue.closed
+    assert queue.take(timeout=0) == [0, 1, 2]
+    assert queue.take(timeout=0) is None  # Closed and drained
+
+
+def test_take_is_bounded_per_call():
+    queue = OutboundQueue(None, limit=10)
+    fill(queue, 10)
+    assert queue.take(timeout=0, limit=4) == [0, 1, 2, 3]
+    assert queue.depth == 6
+
+
+def test_on_ready_fires_for_every_put_and_close():
+    calls = []
+    queue = OutboundQueue(None, on_ready=lambda: calls.append(1))
+    fill(queue, 2)
+    queue.close()
+    assert len(calls) == 3
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        OutboundQueue(None, policy='block')
+
+
+@pytest.mark.parametrize('program', ['server.py', 'async_server.py'])
+def test_slow_subscriber_is_disconnected_without_stalling_the_publisher(start_broker, wires, program):
+    port = start_broker(program, 10, DISCONNECT)
+    slow = wires(port)
+    slow.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    slow.hello('SUBSCRIBER', 'bulk')  # ...and never reads
+    time.sleep(0.3)
+    publisher = wires(port)
+    publisher.hello('PUBLISHER', 'bulk')
+    payload = b'x' * 65536
+    for _ in range(200):
+        publisher.send(PUBLISH, 'bulk', payload)
+    seq = 0
+    while seq < 200:
+        (_, _, ack), = publisher.frames(1, ACK)
+        seq = decode_ack(ack)[0]
+    monitor = wires(port)
+    monitor.hello('MONITOR')
+    monitor.send(STATS)
+    (_, _, report), = monitor.frames(1, STATS)
+    stats = json.loads(report)
+    assert stats['slow_consumers_disconnected'] == 1
+    assert stats['subscribers'] == 0
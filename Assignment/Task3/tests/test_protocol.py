@@ -0,0 +1,136 @@
+import socket
+import pytest
+from protocol import (HEADER, MAX_PAYLOAD, RECV_BUFFER, MAX_RECV_BUFFER, HELLO, PUBLISH, MESSAGE, ERROR,
+                      FrameDecoder, ProtocolError, encode_batch, encode_frame, encode_prefix, send_parts,
+                      split_batch, split_hello)
+
+
+def test_frame_round_trip():
+    frame = encode_frame(PUBLISH, 'sports.tennis', b'15-0')
+    assert len(frame) == HEADER.size + len('sports.tennis') + 4
+    assert FrameDecoder().feed(frame) == [(PUBLISH, 'sports.tennis', b'15-0')]
+
+
+def test_payload_is_opaque_bytes():
+    payload = bytes(range(256))
+    assert FrameDecoder().feed(encode_frame(MESSAGE, 't', payload)) == [(MESSAGE, 't', payload)]
+
+
+def test_frames_split_across_reads():
+    stream = encode_frame(PUBLISH, 'a', b'first') + encode_frame(PUBLISH, 'b', b'second')
+    decoder = FrameDecoder()
+    frames = []
+    for byte in range(len(stream)):
+        frames += decoder.feed(stream[byte:byte + 1])
+    assert frames == [(PUBLISH, 'a', b'first'), (PUBLISH, 'b', b'second')]
+
+
+def test_several_frames_in_one_read():
+    stream = b''.join(encode_frame(MESSAGE, 't', str(number)) for number in range(50))
+    assert [payload for _, _, payload in FrameDecoder().feed(stream)] == [str(n).encode() for n in range(50)]
+
+
+def test_prefix_matches_frame_header():
+    assert encode_prefix(MESSAGE, 'topic', 3) + b'abc' == encode_frame(MESSAGE, 'topic', b'abc')
+
+
+def test_oversized_frame_is_rejected():
+    with pytest.raises(ProtocolError):
+        FrameDecoder().feed(HEADER.pack(MAX_PAYLOAD + 1, PUBLISH, 0))
+
+
+def test_unknown_opcode_is_rejected():
+    with pytest.raises(ProtocolError):
+        FrameDecoder().feed(HEADER.pack(0, 250, 0))
+
+
+@pytest.mark.parametrize('payload, expected', [
+    (b'PUBLISHER', ('PUBLISHER', '', '')),
+    (b'SUBSCRIBER zlib,lz4', ('SUBSCRIBER', 'zlib,lz4', '')),
+    (b'SUBSCRIBER  new', ('SUBSCRIBER', '', 'new')),
+])
+def test_split_hello(payload, expected):
+    assert split_hello(payload) == expected
+
+
+def test_recv_into_grows_while_reads_fill_the_buffer():
+    left, right = socket.socketpair()
+    with left, right:
+        stream = b''.join(encode_frame(PUBLISH, 'busy', bytes(1000)) for _ in range(100))
+        left.sendall(stream)
+        decoder = FrameDecoder()
+        frames = decoder.recv_into(right)
+        assert decoder.capacity == 2 * RECV_BUFFER  # That read filled the whole tail
+        while len(frames) < 100:
+            frames += decoder.recv_into(right)
+        assert decoder.capacity <= MAX_RECV_BUFFER
+        assert frames == [(PUBLISH, 'busy', bytes(1000))] * 100
+        left.close()
+        assert decoder.recv_into(right) is None
+
+
+def test_partial_frame_is_moved_to_the_front_not_reallocated():
+    decoder = FrameDecoder(capacity=64)
+    frame = encode_frame(PUBLISH, 't', bytes(40))
+    assert decoder.feed(frame + frame[:20]) == [(PUBLISH, 't', bytes(40))]
+    buffer = decoder.buffer
+    assert decoder.feed(frame[20:]) == [(PUBLISH, 't', bytes(40))]
+    assert decoder.buffer is buffer and decoder.start == decoder.end == 0
+
+
+def test_buffer_grown_for_a_huge_frame_is_given_back():
+    decoder = FrameDecoder()
+    decoder.feed(encode_frame(PUBLISH, 't', bytes(2 * MAX_RECV_BUFFER)))
+    assert len(decoder.buffer) == RECV_BUFFER
+
+
+def test_split_batch_returns_views_of_the_payload():
+    payload = encode_batch([b'one', b'', b'three'])
+    messages = split_batch(payload)
+    assert [bytes(message) for message in messages] == [b'one', b'', b'three']
+    assert all(isinstance(message, memoryview) and message.obj is payload for message in messages)
+
+
+@pytest.mark.parametrize('payload', [b'\x00\x00', encode_batch([b'abc'])[:-1]])
+def test_truncated_batch_is_rejected(payload):
+    with pytest.raises(ProtocolError):
+        split_batch(payload)
+
+
+class TrickleSocket:
+    """Takes at most a few bytes per sendmsg, like a nearly full socket buffer."""
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.received = b''
+
+    def sendmsg(self, buffers):
+        data = b''.join(buffers)[:self.chunk]
+        self.received += data
+        return len(data)
+
+
+@pytest.mark.parametrize('chunk', [1, 3, 7, 1000])
+def test_send_parts_finishes_partial_writes(chunk):
+    parts = [b'prefix-', b'', bytearray(b'payload'), memoryview(b'-tail')]
+    sock = TrickleSocket(chunk)
+    send_parts(sock, parts)
+    assert sock.received == b'prefix-payload-tail'
+
+
+@pytest.mark.parametrize('program', ['server.py', 'async_server.py'])
+def test_broker_refuses_a_first_frame_that_is_not_hello(start_broker, wires, program):
+    port = start_broker(program)
+    wire = wires(port)
+    wire.send(PUBLISH, 'news', b'no handshake')
+    (opcode, _, payload), = wire.frames(1)
+    assert opcode == ERROR and b'HELLO' in payload
+
+
+@pytest.mark.parametrize('program', ['server.py', 'async_server.py'])
+def test_broker_refuses_a_hello_that_is_not_utf8(start_broker, wires, program):
+    port = start_broker(program)
+    wire = wires(port)
+    wire.send(HELLO, 'news', b'\xff\xfe')
+    (opcode, _, _), = wire.frames(1)
+    assert opcode == ERROR
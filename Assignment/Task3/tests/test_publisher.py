@@ -0,0 +1,63 @@
+import socket
+import pytest
+from publisher import Publisher
+from protocol import HELLO, PUBLISH, BATCH, MESSAGE, QOS, QOS_OPTIONS, HIGH, NORMAL, FrameDecoder, split_batch
+
+
+@pytest.fixture
+def fake_broker():
+    # A listening socket that records frames instead of routing them
+    server = socket.create_server(('127.0.0.1', 0))
+    yield server
+    server.close()
+
+
+def read_frames(conn, count):
+    decoder = FrameDecoder()
+    frames = []
+    conn.settimeout(5)
+    while len(frames) < count:
+        frames += decoder.recv_into(conn)
+    return frames
+
+
+def test_messages_go_out_as_one_batch(fake_broker):
+    publisher = Publisher('127.0.0.1', fake_broker.getsockname()[1], 'jobs', max_batch=10, flush_interval=0)
+    conn, _ = fake_broker.accept()
+    for number in range(10):
+        publisher.publish(f'job {number}')
+    hello, batch = read_frames(conn, 2)
+    assert hello[0] == HELLO
+    assert batch[0] == BATCH and batch[1] == 'jobs'
+    assert [bytes(message) for message in split_batch(batch[2])] == [f'job {n}'.encode() for n in range(10)]
+    publisher.close()
+    conn.close()
+
+
+def test_qos_change_closes_the_batch(fake_broker):
+    publisher = Publisher('127.0.0.1', fake_broker.getsockname()[1], 'jobs', max_batch=10, flush_interval=0)
+    conn, _ = fake_broker.accept()
+    publisher.publish('a')
+    publisher.publish('b', lane=HIGH, ttl=500)
+    publisher.flush()
+    frames = read_frames(conn, 4)
+    assert [opcode for opcode, _, _ in frames] == [HELLO, PUBLISH, QOS, PUBLISH]
+    assert QOS_OPTIONS.unpack(frames[2][2]) == (HIGH, 500)
+    publisher.close()
+    conn.close()
+
+
+@pytest.mark.parametrize('program', ['server.py', 'async_server.py'])
+def test_pipelined_publishes_are_acked_and_delivered_in_order(start_broker, wires, program):
+    port = start_broker(program, 10000)
+    subscriber = wires(port)
+    subscriber.hello('SUBSCRIBER zlib', 'jobs')
+    subscriber.frames(1, HELLO)
+    publisher = Publisher('127.0.0.1', port, 'jobs', max_batch=50)
+    sequence_numbers = [publisher.publish(f'job {number}', NORMAL) for number in range(500)]
+    assert sequence_numbers == list(range(1, 501))
+    assert publisher.wait_for_ack(timeout=10)
+    assert publisher.acked_seq == 500
+    received = subscriber.frames(500, MESSAGE)
+    assert [payload for _, _, payload in received] == [f'job {n}'.encode() for n in range(500)]
+    publisher.close()
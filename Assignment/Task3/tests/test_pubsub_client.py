@@ -0,0 +1,135 @@
+import asyncio
+import pytest
+from pubsub_client import AsyncClient, Client, RECONNECT_DELAY
+from protocol import HELLO, SESSION, COMPRESSED, ERROR, encode_frame
+
+PROBE = b'probe'
+
+
+async def wait_until(condition, timeout=5):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+
+async def settle(client, ready, topics, timeout=5):
+    # A SUBSCRIBE is only written, not confirmed, so publish probes until ready() says every
+    # subscription has seen one; after that the broker has them all
+    async def probe():
+        while not ready():
+            for topic in topics:
+                await client.publish(topic, PROBE)
+            await client.flush()
+            await asyncio.sleep(0.02)
+    await asyncio.wait_for(probe(), timeout)
+
+
+def payloads(subscription):
+    return [payload for _, payload in subscription.messages if payload != PROBE]
+
+
+@pytest.mark.parametrize('program', ['server.py', 'async_server.py'])
+@pytest.mark.parametrize('logged', [False, True])
+def test_publish_and_subscribe_through_the_pool(start_broker, tmp_path, program, logged):
+    port = start_broker(program, 1000, 'drop-oldest', *([tmp_path / 'log'] if logged else []))
+
+    async def run():
+        async with AsyncClient('127.0.0.1', port, publisher_connections=2) as client:
+            sports = await client.subscribe('sports.#')
+            news = await client.subscribe('news.*')
+            await settle(client, lambda: sports.messages and news.messages, ('sports.probe', 'news.probe'))
+            for number in range(100):
+                await client.publish('sports.tennis' if number % 2 else 'news.uk', b'%d' % number)
+            await client.publish('weather', b'nobody')
+            await client.flush(5)
+            await wait_until(lambda: len(payloads(sports)) == 50 and len(payloads(news)) == 50)
+            return payloads(sports), client.stats
+
+    received, stats = asyncio.run(run())
+    assert received == [b'%d' % number for number in range(1, 100, 2)]  # Per-topic order holds
+    assert stats['reconnects'] == 0
+
+
+def test_a_failing_callback_only_loses_its_own_message(start_broker):
+    port = start_broker()
+    received = []
+
+    def fragile(topic, payload):
+        if payload == b'boom':
+            raise RuntimeError('callback blew up')
+        received.append(payload)
+
+    client = Client('127.0.0.1', port)
+    try:
+        client.subscribe('a.#', fragile)
+        client._call(settle(client.client, lambda: received, ('a.probe',)))
+        for message in ('1', 'boom', '2'):
+            client.publish('a.b', message)
+        client.flush(5)
+        client._call(wait_until(lambda: len([payload for payload in received if payload != PROBE]) == 2))
+        assert [payload for payload in received if payload != PROBE] == [b'1', b'2']
+        assert client.stats['reconnects'] == 0
+    finally:
+        client.close()
+
+
+def test_wildcard_publish_is_refused_locally():
+    client = AsyncClient('127.0.0.1', 1)
+    with pytest.raises(ValueError):
+        asyncio.run(client.publish('sports.*', b'x'))
+
+
+async def fake_broker(handler):
+    connections = []
+
+    async def accept(reader, writer):
+        connections.append(writer)
+        await handler(reader, writer)
+
+    server = await asyncio.start_server(accept, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1], connections
+
+
+def test_refused_hello_backs_off():
+    async def refuse(reader, writer):
+        await reader.read(100)
+        writer.write(encode_frame(ERROR, payload='no'))
+        writer.close()
+
+    async def run():
+        server, port, connections = await fake_broker(refuse)
+        client = AsyncClient('127.0.0.1', port, subscriber_connections=0)
+        client.publishers[0].start()
+        await asyncio.sleep(1)
+        client.closed = True
+        client.publishers[0].task.cancel()
+        server.close()
+        return len(connections), client.publishers[0].delay
+
+    connections, delay = asyncio.run(run())
+    assert 2 <= connections <= 6  # 0.1s doubling with jitter, not a tight reconnect loop
+    assert delay > RECONNECT_DELAY
+
+
+def test_undecodable_frame_starts_a_new_connection():
+    async def corrupt(reader, writer):
+        await reader.read(1000)
+        writer.write(encode_frame(HELLO, '', 'zlib') + encode_frame(SESSION, 'token', 'new')
+                     + encode_frame(COMPRESSED, 'a', b'not zlib'))
+        await asyncio.sleep(5)
+
+    async def run():
+        server, port, connections = await fake_broker(corrupt)
+        client = AsyncClient('127.0.0.1', port, subscriber_connections=1, publisher_connections=0)
+        await client.subscribe('a')
+        client.subscribers[0].start()
+        await wait_until(lambda: len(connections) >= 2)
+        stats = dict(client.stats)
+        await client.close()
+        server.close()
+        return stats, client.subscribers[0].session
+
+    stats, session = asyncio.run(run())
+    assert stats['reconnects'] >= 1
+    assert session == 'token'  # The next connection tries to resume the session it was given
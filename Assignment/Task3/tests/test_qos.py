@@ -0,0 +1,82 @@
+import time
+import socket
+import pytest
+import broker
+from metrics import Metrics, Stamped
+from outbound import OutboundQueue, DROP_OLDEST
+from protocol import HIGH, NORMAL, LOW, HELLO, PUBLISH, QOS, QOS_OPTIONS, ERROR, FrameDecoder
+
+
+def test_lanes_drain_most_urgent_first():
+    queue = OutboundQueue(None)
+    for item, lane in (('low', LOW), ('normal', NORMAL), ('high', HIGH), ('normal-2', NORMAL)):
+        queue.put(item, lane)
+    assert queue.take(timeout=0) == ['high', 'normal', 'normal-2', 'low']
+
+
+def test_drop_oldest_evicts_from_the_lowest_lane():
+    queue = OutboundQueue(None, limit=3, policy=DROP_OLDEST)
+    queue.put('low', LOW)
+    queue.put('normal', NORMAL)
+    queue.put('high', HIGH)
+    queue.put('urgent', HIGH)
+    assert queue.take(timeout=0) == ['high', 'urgent', 'normal']
+
+
+def test_less_urgent_frame_is_dropped_when_everything_queued_outranks_it():
+    queue = OutboundQueue(None, limit=2, policy=DROP_OLDEST)
+    queue.put('high', HIGH)
+    queue.put('normal', NORMAL)
+    queue.put('low', LOW)
+    assert queue.take(timeout=0) == ['high', 'normal']
+    assert queue.snapshot()['dropped'] == 1
+
+
+def test_expired_frames_are_discarded_and_counted():
+    metrics = Metrics()
+    queue = OutboundQueue(None, metrics=metrics)
+    now = time.perf_counter_ns()
+    queue.put(Stamped((b'stale',)), LOW, deadline=now - 1)
+    queue.put(Stamped((b'fresh',)), LOW, deadline=now + 10 ** 10)
+    queue.put(Stamped((b'forever',)), NORMAL)
+    assert [item[0] for item in queue.take(timeout=0)] == [b'forever', b'fresh']
+    assert queue.snapshot()['expired'] == 1
+    assert metrics.counters.snapshot()['expired_low'] == 1
+    assert metrics.snapshot()['queue_delay_us']['normal']['count'] == 1
+
+
+@pytest.fixture
+def pair():
+    subscriber, publisher = broker.Client(('qos', 'subscriber')), broker.Client(('qos', 'publisher'))
+    assert subscriber.hello((HELLO, 'alerts', b'SUBSCRIBER'), conn=socket.socket()) is None
+    assert publisher.hello((HELLO, 'alerts', b'PUBLISHER'), conn=socket.socket()) is None
+    yield subscriber, publisher
+    publisher.close()
+    subscriber.close()
+    subscriber.queue.conn.close()
+
+
+def test_publisher_qos_picks_the_lane(pair):
+    subscriber, publisher = pair
+    publisher.handle([(PUBLISH, 'alerts', b'routine'), (QOS, '', QOS_OPTIONS.pack(HIGH, 0)),
+                      (PUBLISH, 'alerts', b'fire')])
+    assert subscriber.queue.snapshot()['lanes'] == {'high': 1, 'normal': 1, 'low': 0}
+    frames = FrameDecoder().feed(b''.join(b''.join(item) for item in subscriber.queue.take(timeout=0)))
+    assert [payload for _, _, payload in frames] == [b'fire', b'routine']
+
+
+def test_publisher_ttl_expires_queued_messages(pair):
+    subscriber, publisher = pair
+    publisher.handle([(QOS, '', QOS_OPTIONS.pack(LOW, 1)), (PUBLISH, 'alerts', b'short-lived')])
+    time.sleep(0.01)
+    assert subscriber.queue.take(timeout=0) == []
+    assert subscriber.queue.snapshot()['expired'] == 1
+
+
+@pytest.mark.parametrize('options', [QOS_OPTIONS.pack(3, 0), b'\x00'])
+def test_invalid_qos_is_refused(pair, options):
+    _, publisher = pair
+    replies, _ = publisher.handle([(QOS, '', options)])
+    (opcode, _, _), = FrameDecoder().feed(b''.join(replies))
+    assert opcode == ERROR
+    assert (publisher.lane, publisher.ttl) == (NORMAL, 0)
@@ -0,0 +1,43 @@
+import pytest
+from protocol import HELLO, PUBLISH, MESSAGE, ACK, TERMINATE, decode_ack
+
+SERVERS = ['server.py', 'async_server.py']
+
+
+def subscribe(wires, port, topic):
+    wire = wires(port)
+    wire.hello('SUBSCRIBER zlib', topic)
+    wire.frames(1, HELLO)  # The codec answer comes after the subscription is in place
+    return wire
+
+
+@pytest.mark.parametrize('program', SERVERS)
+def test_publish_reaches_subscriber(start_broker, wires, program):
+    port = start_broker(program)
+    subscriber = subscribe(wires, port, 'news')
+    publisher = wires(port)
+    publisher.hello('PUBLISHER', 'news')
+    publisher.send(PUBLISH, 'news', b'hello')
+    assert subscriber.frames(1, MESSAGE) == [(MESSAGE, 'news', b'hello')]
+    (_, _, ack), = publisher.frames(1, ACK)
+    assert decode_ack(ack)[0] == 1
+
+
+@pytest.mark.parametrize('program', SERVERS)
+def test_many_subscribers_each_get_the_message(start_broker, wires, program):
+    port = start_broker(program)
+    subscribers = [subscribe(wires, port, 'load') for _ in range(100)]
+    publisher = wires(port)
+    publisher.hello('PUBLISHER', 'load')
+    publisher.send(PUBLISH, 'load', b'x')
+    for subscriber in subscribers:
+        assert subscriber.frames(1, MESSAGE) == [(MESSAGE, 'load', b'x')]
+
+
+@pytest.mark.parametrize('program', SERVERS)
+def test_terminate_closes_the_connection(start_broker, wires, program):
+    port = start_broker(program)
+    subscriber = subscribe(wires, port, 'news')
+    subscriber.send(TERMINATE)
+    with pytest.raises(ConnectionError):
+        subscriber.frames(1)
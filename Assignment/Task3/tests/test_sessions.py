@@ -0,0 +1,177 @@
+import os
+import socket
+import threading
+import broker
+from sessions import SessionStore, StateLog
+from protocol import HELLO, PUBLISH, SESSION, SUBSCRIBE, MESSAGE, SESSION_NEW, SESSION_RESUMED, FrameDecoder
+
+
+def reload(directory):
+    store = SessionStore(str(directory))
+    store.load()
+    return store
+
+
+def test_sessions_come_back_detached_after_a_restart(tmp_path):
+    store = reload(tmp_path)
+    session = store.open()
+    store.subscribed(session.token, 'orders.*')
+    store.subscribed(session.token, 'alerts')
+    store.filtered(session.token, 'region == "eu"')
+    store.joined(session.token, 'jobs', 'workers', 10, 5000)
+    store.compact()
+    store.unsubscribed(session.token, 'alerts')  # After the snapshot: only in the changelog
+    gone = store.open()
+    store.close(gone.token)
+    restored = reload(tmp_path)
+    assert list(restored.sessions) == [session.token]
+    back = restored.sessions[session.token]
+    assert (back.patterns, back.filter, back.groups) == ({'orders.*'}, 'region == "eu"', {'jobs': ('workers', 10, 5000)})
+    assert back.detached_at is not None
+    assert restored.attach(session.token) is back
+    assert restored.attach(session.token) is None  # Already in use
+
+
+def test_torn_changelog_record_is_dropped(tmp_path):
+    store = reload(tmp_path)
+    session = store.open()
+    store.subscribed(session.token, 'kept')
+    store.subscribed(session.token, 'torn')
+    store.log.changelog.close()
+    size = os.path.getsize(store.log.changelog_path)
+    os.truncate(store.log.changelog_path, size - 2)  # The process died mid-write
+    restored = reload(tmp_path)
+    assert restored.sessions[session.token].patterns == {'kept'}
+    restored.subscribed(session.token, 'after')  # Appends start where the good records end
+    assert reload(tmp_path).sessions[session.token].patterns == {'kept', 'after'}
+
+
+def test_detached_sessions_expire_after_the_ttl():
+    store = SessionStore(ttl=10)
+    attached, detached = store.open(), store.open()
+    store.detach(detached.token)
+    assert store.expire(now=detached.detached_at + 5) == []
+    assert store.expire(now=detached.detached_at + 11) == [detached]
+    assert list(store.sessions) == [attached.token]
+    assert store.attach(detached.token) is None
+
+
+def test_compaction_writes_the_snapshot_without_the_store_lock(tmp_path, monkeypatch):
+    store = reload(tmp_path)
+    session = store.open()
+    held = []
+    write_snapshot = StateLog.write_snapshot
+
+    def spy(log, state):
+        held.append(store.lock.locked())
+        write_snapshot(log, state)
+
+    monkeypatch.setattr(StateLog, 'write_snapshot', spy)
+    store.compact()
+    assert held == [False]
+    assert list(reload(tmp_path).sessions) == [session.token]
+
+
+def test_changes_made_during_compaction_survive(tmp_path):
+    store = reload(tmp_path)
+    session = store.open()
+    store.subscribed(session.token, 'before')
+    with store.lock:
+        state = [entry.state() for entry in store.sessions.values()]
+        store.log.rotate()
+    store.subscribed(session.token, 'during')  # Lands in the new changelog while the snapshot is written
+    store.log.write_snapshot(state)
+    assert reload(tmp_path).sessions[session.token].patterns == {'before', 'during'}
+
+
+def test_interrupted_compaction_loses_nothing(tmp_path):
+    store = reload(tmp_path)
+    first = store.open()
+    store.subscribed(first.token, 'a')
+    store.compact()
+    store.unsubscribed(first.token, 'a')
+    store.subscribed(first.token, 'b')
+    second = store.open()
+    with store.lock:
+        store.log.rotate()  # ...and the process dies before the snapshot is written
+    store.subscribed(second.token, 'c')
+    assert os.path.exists(store.log.aside_path)
+    restored = reload(tmp_path)
+    assert restored.sessions[first.token].patterns == {'b'}
+    assert restored.sessions[second.token].patterns == {'c'}
+    assert not os.path.exists(restored.log.aside_path)  # Folded back into the changelog
+
+
+def test_replaying_set_aside_records_over_their_snapshot_is_harmless(tmp_path):
+    store = reload(tmp_path)
+    session = store.open()
+    store.subscribed(session.token, 'a')
+    store.unsubscribed(session.token, 'a')
+    store.filtered(session.token, 'x == 1')
+    with store.lock:
+        state = [entry.state() for entry in store.sessions.values()]
+        store.log.rotate()
+    store.log.write_snapshot(state)
+    # A crash between the snapshot and removing the set-aside changelog replays it on top
+    os.rename(store.log.changelog_path, store.log.aside_path)
+    open(store.log.changelog_path, 'wb').close()
+    restored = reload(tmp_path).sessions[session.token]
+    assert restored.patterns == set() and restored.filter == 'x == 1'
+
+
+def test_concurrent_compactions_and_changes(tmp_path):
+    store = reload(tmp_path)
+    tokens = [store.open().token for _ in range(20)]
+
+    def churn(token):
+        for number in range(50):
+            store.subscribed(token, f'p{number}')
+
+    threads = [threading.Thread(target=churn, args=(token,)) for token in tokens]
+    for thread in threads:
+        thread.start()
+    for _ in range(5):
+        store.compact()
+    for thread in threads:
+        thread.join()
+    restored = reload(tmp_path)
+    assert all(len(restored.sessions[token].patterns) == 50 for token in tokens)
+
+
+def drain(client):
+    return FrameDecoder().feed(b''.join(b''.join(item) for item in client.queue.take(timeout=0)))
+
+
+def hello(number, role):
+    client = broker.Client(('sessions', number))
+    assert client.hello((HELLO, '', role), conn=socket.socket()) is None
+    return client
+
+
+def test_broker_holds_messages_for_a_detached_session():
+    first = hello(1, f'SUBSCRIBER  {SESSION_NEW}'.encode())
+    (opcode, token, status), = drain(first)
+    assert (opcode, status) == (SESSION, SESSION_NEW.encode())
+    first.handle([(SUBSCRIBE, 'held.*', b'')])
+    first.close()
+    first.queue.conn.close()
+
+    publisher = hello(2, b'PUBLISHER')
+    publisher.handle([(PUBLISH, 'held.one', b'while away')])
+    publisher.close()
+
+    second = hello(3, f'SUBSCRIBER  {token}'.encode())
+    assert drain(second) == [(SESSION, token, SESSION_RESUMED.encode()), (MESSAGE, 'held.one', b'while away')]
+    assert broker.SESSION_TOKENS[second.address] == token
+    second.close()
+    second.queue.conn.close()
+    broker.SESSIONS.close(token)
+
+
+def test_broker_gives_a_fresh_session_for_an_unknown_token():
+    client = hello(4, b'SUBSCRIBER  no-such-token')
+    (opcode, token, status), = drain(client)
+    assert opcode == SESSION and status == SESSION_NEW.encode() and token != 'no-such-token'
+    client.close()
+    client.queue.conn.close()
+    broker.SESSIONS.close(token)
@@ -0,0 +1,90 @@
+import asyncio
+import pytest
+from metrics import Metrics, Stamped
+from protocol import MESSAGE, NOTIFY, RING_OFFSET, FrameDecoder, encode_prefix
+from shm_transport import RECORD, NOTIFY_PREFIX, RingWriter, RingReader
+from pubsub_client import AsyncClient
+
+
+@pytest.fixture
+def ring():
+    writer = RingWriter(size=256)
+    reader = RingReader(writer.name)
+    yield writer, reader
+    reader.close()
+    writer.close()
+
+
+def test_messages_are_read_back_by_offset(ring):
+    writer, reader = ring
+    first = writer.write('news', b'one')
+    second = writer.write('news.uk', b'two')
+    assert second == first + RECORD.size + len('news') + 3
+    assert reader.read(first) == ('news', b'one')
+    assert reader.read(second) == ('news.uk', b'two')
+
+
+def test_records_are_never_split_across_the_end(ring):
+    writer, reader = ring
+    writer.write('t', bytes(200))
+    offset = writer.write('t', b'x' * 45)  # Doesn't fit in what is left of the first lap
+    assert offset == 256
+    assert reader.read(offset) == ('t', b'x' * 45)
+
+
+def test_overwritten_messages_are_reported_lost(ring):
+    writer, reader = ring
+    old = writer.write('t', b'old')
+    for _ in range(30):
+        writer.write('t', bytes(20))
+    assert reader.read(old) is None
+
+
+def test_message_larger_than_the_ring_is_sent_as_is(ring):
+    writer, _ = ring
+    assert writer.write('t', bytes(300)) is None
+    parts = Stamped((encode_prefix(MESSAGE, 't', 300), bytes(300)))
+    assert writer.frame(parts, 't', Metrics()) is parts
+
+
+def test_runs_of_notifications_are_coalesced(ring):
+    writer, reader = ring
+    metrics = Metrics()
+    notes = [writer.frame((encode_prefix(MESSAGE, 't', 1), b'%d' % number), 't', metrics) for number in range(3)]
+    control = (b'control',)
+    merged = RingWriter.coalesce(notes[:2] + [control] + notes[2:])
+    assert merged[1] is control and len(merged) == 3
+    (opcode, _, payload), = FrameDecoder().feed(b''.join(merged[0]))
+    assert opcode == NOTIFY
+    assert [reader.read(offset) for (offset,) in RING_OFFSET.iter_unpack(payload)] == [('t', b'0'), ('t', b'1')]
+    assert merged[2][0] is NOTIFY_PREFIX  # A run of one is left as it was
+    assert metrics.counters.snapshot()['bytes_shared'] == 3
+
+
+@pytest.mark.parametrize('program', ['server.py', 'async_server.py'])
+def test_local_subscriber_reads_from_the_ring(start_broker, tmp_path, program):
+    path = str(tmp_path / 'broker.sock')
+    port = start_broker(program, env={'PUBSUB_SHM_SOCKET': path})
+
+    async def run():
+        async with AsyncClient(None, None, path=path, subscriber_connections=1, publisher_connections=0) as local, \
+                AsyncClient('127.0.0.1', port, subscriber_connections=0) as remote:
+            subscription = await local.subscribe('ring.#')
+
+            async def probe():
+                while not subscription.messages:
+                    await remote.publish('ring.probe', b'probe')
+                    await remote.flush()
+                    await asyncio.sleep(0.02)
+            await asyncio.wait_for(probe(), 5)
+            for number in range(50):
+                await remote.publish('ring.data', b'%d' % number)
+            await remote.flush(5)
+            while len([topic for topic, _ in subscription.messages if topic == 'ring.data']) < 50:
+                await asyncio.sleep(0.01)
+            return [payload for topic, payload in subscription.messages if topic == 'ring.data'], \
+                local.subscribers[0].codec, local.stats
+
+    received, codec, stats = asyncio.run(asyncio.wait_for(run(), 20))
+    assert received == [b'%d' % number for number in range(50)]
+    assert codec == 'shm' and stats['overrun'] == 0
@@ -0,0 +1,91 @@
+import pytest
+from topic_index import TopicIndex, is_pattern
+
+
+def addresses(index, topic):
+    return sorted(address for address, _ in index.subscribers(topic))
+
+
+def test_publish_reaches_only_its_topic():
+    index = TopicIndex()
+    index.add('news', 'a', 'conn-a')
+    index.add('news', 'b', 'conn-b')
+    index.add('sports', 'c', 'conn-c')
+    assert sorted(index.subscribers('news')) == [('a', 'conn-a'), ('b', 'conn-b')]
+    assert addresses(index, 'weather') == []
+
+
+def test_remove_drops_the_subscription():
+    index = TopicIndex()
+    index.add('news', 'a', 'conn-a')
+    assert index.remove('news', 'a')
+    assert not index.remove('news', 'a')
+    assert addresses(index, 'news') == []
+    assert index.topics == {} and index.size == 0
+
+
+def test_duplicate_subscription_counts_once():
+    index = TopicIndex()
+    index.add('news', 'a', 'conn-a')
+    index.add('news', 'a', 'conn-a')
+    assert index.size == 1
+    assert addresses(index, 'news') == ['a']
+
+
+def test_routing_counters_show_the_skipped_subscribers():
+    index = TopicIndex()
+    for number in range(10):
+        index.add(f'topic.{number}', number, f'conn-{number}')
+    index.subscribers('topic.3')
+    stats = index.snapshot()
+    assert stats['publishes'] == 1
+    assert stats['subscribers_visited'] == 1
+    assert stats['subscribers_skipped'] == 9
+    assert stats['subscribers'] == 10
+
+
+@pytest.mark.parametrize('pattern, topic, matches', [
+    ('sports.*', 'sports.tennis', True),
+    ('sports.*', 'sports', False),
+    ('sports.*', 'sports.tennis.uk', False),
+    ('sports.#', 'sports', True),
+    ('sports.#', 'sports.tennis.uk', True),
+    ('#', 'anything.at.all', True),
+    ('*.tennis', 'sports.tennis', True),
+    ('sports.#.final', 'sports.final', True),
+    ('sports.#.final', 'sports.tennis.uk.final', True),
+    ('sports.#.final', 'sports.tennis', False),
+    ('news', 'news.local', False),
+])
+def test_wildcards(pattern, topic, matches):
+    index = TopicIndex()
+    index.add(pattern, 'a', 'conn-a')
+    assert (addresses(index, topic) == ['a']) == matches
+
+
+def test_subscriber_matching_several_patterns_gets_one_copy():
+    index = TopicIndex()
+    for pattern in ('sports.*', 'sports.#', 'sports.tennis'):
+        index.add(pattern, 'a', 'conn-a')
+    assert index.subscribers('sports.tennis') == [('a', 'conn-a')]
+
+
+def test_removing_the_last_pattern_prunes_its_branch():
+    index = TopicIndex()
+    index.add('a.b.c', 'x', 'conn-x')
+    index.add('a.*', 'y', 'conn-y')
+    index.remove('a.b.c', 'x')
+    assert list(index.root.children['a'].children) == ['*']
+
+
+def test_move_rekeys_a_subscription():
+    index = TopicIndex()
+    index.add('jobs.#', 'old', 'conn-old')
+    assert index.move('jobs.#', 'old', 'new', 'conn-new')
+    assert index.subscribers('jobs.x') == [('new', 'conn-new')]
+    assert index.size == 1
+
+
+@pytest.mark.parametrize('topic, expected', [('a.b', False), ('a.*', True), ('#', True), ('a.b*', False)])
+def test_is_pattern(topic, expected):
+    assert is_pattern(topic) == expected
@@ -0,0 +1,97 @@
+import os
+import pytest
+from topic_log import TopicLog, PARTITION_PREFIX
+from protocol import (HELLO, PUBLISH, MESSAGE, SUBSCRIBE, REPLAY, ACK, REPLAY_FROM, REPLAY_RANGE,
+                      FrameDecoder, encode_frame, decode_ack)
+
+
+def message(topic, payload):
+    return (encode_frame(MESSAGE, topic, payload),)
+
+
+def replay(log, topic, from_offset):
+    first, end, regions = log.regions(topic, from_offset)
+    data = b''
+    for region in regions:
+        with region.file as segment:
+            segment.seek(region.position)
+            data += segment.read(region.count)
+    return first, end, [payload for _, _, payload in FrameDecoder().feed(data)]
+
+
+@pytest.fixture
+def log(tmp_path):
+    log = TopicLog(str(tmp_path), fsync_interval=60)
+    yield log
+    log.close()
+
+
+def test_offsets_and_replay(log):
+    assert [log.append('orders', message('orders', f'm{n}')) for n in range(5)] == [0, 1, 2, 3, 4]
+    assert log.offsets('orders') == (0, 5)
+    assert replay(log, 'orders', 2) == (2, 5, [b'm2', b'm3', b'm4'])
+    assert replay(log, 'orders', 5) == (5, 5, [])
+
+
+def test_segments_roll_and_retention_drops_the_oldest(tmp_path):
+    log = TopicLog(str(tmp_path), segment_bytes=100, fsync_interval=60, retention_bytes=250)
+    for number in range(20):
+        log.append('t', message('t', b'x' * 40))
+    first, end = log.offsets('t')
+    assert end == 20 and first > 0
+    replayed_first, _, payloads = replay(log, 't', 0)
+    assert replayed_first == first and len(payloads) == 20 - first
+    log.close()
+
+
+def test_reopen_recovers_and_drops_a_torn_record(tmp_path):
+    log = TopicLog(str(tmp_path), fsync_interval=60)
+    for number in range(3):
+        log.append('t', message('t', f'm{number}'))
+    log.close()
+    segment = os.path.join(tmp_path, PARTITION_PREFIX + 't', f"{0:020d}.log")
+    with open(segment, 'ab') as torn:
+        torn.write(b'\x00\x00')  # A crash in the middle of the next write
+    reopened = TopicLog(str(tmp_path), fsync_interval=60)
+    assert reopened.offsets('t') == (0, 3)
+    assert reopened.append('t', message('t', 'm3')) == 3
+    assert replay(reopened, 't', 0)[2] == [b'm0', b'm1', b'm2', b'm3']
+    reopened.close()
+
+
+def test_topics_stay_inside_the_log_directory(log, tmp_path):
+    for topic in ('..', '../escape', 'a/b'):
+        log.append(topic, message(topic, 'x'))
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        PARTITION_PREFIX + name for name in ('..', '..%2Fescape', 'a%2Fb'))
+    with pytest.raises(ValueError):
+        log.append('', message('', 'x'))
+
+
+def test_other_directories_are_left_alone(tmp_path):
+    os.mkdir(os.path.join(tmp_path, 'unrelated'))
+    log = TopicLog(str(tmp_path), fsync_interval=60)
+    assert log.partitions == {}
+    assert os.path.isdir(os.path.join(tmp_path, 'unrelated'))
+    log.close()
+
+
+@pytest.mark.parametrize('program', ['server.py', 'async_server.py'])
+def test_subscriber_replays_from_an_offset_then_goes_live(start_broker, wires, tmp_path, program):
+    port = start_broker(program, 1024, 'drop-oldest', tmp_path / 'log')
+    publisher = wires(port)
+    publisher.hello('PUBLISHER', 'orders')
+    for number in range(5):
+        publisher.send(PUBLISH, 'orders', f'm{number}')
+    seq = 0
+    while seq < 5:
+        seq = decode_ack(publisher.frames(1, ACK)[0][2])[0]
+    subscriber = wires(port)
+    subscriber.hello('SUBSCRIBER zlib')
+    subscriber.frames(1, HELLO)
+    subscriber.send(SUBSCRIBE, 'orders', REPLAY_FROM.pack(2))
+    (_, topic, payload), = subscriber.frames(1, REPLAY)
+    assert topic == 'orders' and REPLAY_RANGE.unpack(payload) == (2, 5)
+    assert [payload for _, _, payload in subscriber.frames(3, MESSAGE)] == [b'm2', b'm3', b'm4']
+    publisher.send(PUBLISH, 'orders', 'live')
+    assert subscriber.frames(1, MESSAGE)[0][2] == b'live'
@@ -0,0 +1,27 @@
+from protocol import HELLO, PUBLISH, MESSAGE, ERROR, CONSUME, CONSUME_OPTIONS
+
+
+def test_publish_reaches_subscribers_on_every_worker(start_broker, wires):
+    port = start_broker('workers.py', 1024, 'drop-oldest', 3)
+    subscribers = []
+    for _ in range(12):
+        subscriber = wires(port)
+        subscriber.hello('SUBSCRIBER zlib', 'news')
+        subscriber.frames(1, HELLO)
+        subscribers.append(subscriber)
+    publisher = wires(port)
+    publisher.hello('PUBLISHER', 'news')
+    publisher.send(PUBLISH, 'news', b'everyone')
+    for subscriber in subscribers:
+        assert subscriber.frames(1, MESSAGE) == [(MESSAGE, 'news', b'everyone')]
+
+
+def test_named_consumer_groups_are_refused(start_broker, wires):
+    # Each worker would hold its own copy of the group
+    port = start_broker('workers.py', 1024, 'drop-oldest', 2)
+    consumer = wires(port)
+    consumer.hello('SUBSCRIBER zlib')
+    consumer.frames(1, HELLO)
+    consumer.send(CONSUME, 'jobs', CONSUME_OPTIONS.pack(10, 0) + b'workers')
+    (_, topic, payload), = consumer.frames(1, ERROR)
+    assert topic == 'jobs' and b'single broker process' in payload
@@ -0,0 +1,81 @@
+import time
+import threading
+
+HEARTBEAT_INTERVAL = 10.0  # Seconds of silence before the broker sends a connection a HEARTBEAT
+IDLE_TIMEOUT = 30.0        # Seconds of silence (heartbeats unanswered) before the connection is reaped
+TICK = 1.0                 # Wheel resolution in seconds
+
+
+class TimerWheel:
+    """Hashed timing wheel tracking when each connection was last heard from.
+
+    Every connection has one entry, filed in the slot of the tick at which
+    it next needs looking at. Marking activity (touch) only stamps the
+    entry with the current tick, so the hot read path never reschedules
+    anything; advance() walks the slots that came due since the last call
+    and, for each entry there, either files it again for later (it has
+    been heard from since), reports it for a ping (silent for interval) or
+    reports it for reaping (silent for timeout). One timer serves every
+    connection, and a tick costs only the entries that came due in it.
+
+    Slot entries left behind by removed or rescheduled connections are
+    skipped lazily. touch() and remove() should be called by the thread or
+    task that owns the connection; add() and advance() may race with them."""
+
+    def __init__(self, interval=HEARTBEAT_INTERVAL, timeout=IDLE_TIMEOUT, tick=TICK):
+        self.tick = tick
+        self.interval = max(1, round(interval / tick))  # In ticks
+        self.timeout = max(self.interval, round(timeout / tick))
+        self.slots = [[] for _ in range(self.timeout + 2)]
+        self.lock = threading.Lock()
+        self.entries = {}  # {key: [conn, last heard tick, scheduled tick]}
+        self.now = self._current()
+
+    def _current(self):
+        return int(time.monotonic() / self.tick)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key, conn):
+        with self.lock:
+            entry = self.entries[key] = [conn, self.now, None]
+            self._schedule(key, entry, self.now + self.interval)
+
+    def touch(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[1] = self.now
+
+    def remove(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def _schedule(self, key, entry, tick):
+        entry[2] = tick
+        self.slots[tick % len(self.slots)].append(key)
+
+    def advance(self):
+        """Move the wheel up to the current time. Returns ([(key, conn)] to
+        ping, [(key, conn)] to reap); reaped entries are already removed."""
+        current = self._current()
+        pings, reaps = [], []
+        with self.lock:
+            while self.now < current:
+                self.now += 1
+                position = self.now % len(self.slots)
+                due, self.slots[position] = self.slots[position], []
+                for key in due:
+                    entry = self.entries.get(key)
+                    if entry is None or entry[2] != self.now:
+                        continue  # Removed, or filed again under a later tick
+                    silent = self.now - entry[1]
+                    if silent >= self.timeout:
+                        del self.entries[key]
+                        reaps.append((key, entry[0]))
+                    elif silent >= self.interval:
+                        pings.append((key, entry[0]))
+                        self._schedule(key, entry, self.now + min(self.interval, self.timeout - silent))
+                    else:
+                        self._schedule(key, entry, entry[1] + self.interval)
+        return pings, reaps
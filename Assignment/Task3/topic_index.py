@@ -0,0 +1,136 @@
+import threading
+
+SEPARATOR = '.'
+ONE_LEVEL = '*'   # Matches exactly one topic level: sports.* matches sports.football
+ANY_LEVELS = '#'  # Matches zero or more levels: sports.# matches sports and sports.football.uk
+
+
+def is_pattern(topic):
+    return any(level in (ONE_LEVEL, ANY_LEVELS) for level in topic.split(SEPARATOR))
+
+
+class _Node:
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self):
+        self.children = {}     # {level: _Node}, wildcards included as '*' and '#'
+        self.subscribers = {}  # {address: conn} for patterns ending at this node
+
+
+class TopicIndex:
+    """Subscription index over hierarchical, dot-separated topics.
+
+    Patterns are stored in a trie keyed by topic level, so matching a
+    published topic walks at most the topic's depth (plus the wildcard
+    branches that actually exist) instead of testing every pattern. It is
+    updated incrementally on subscribe and disconnect.
+
+    All access goes through one lock, and lookups hand back a copy, so a
+    handler thread can iterate recipients while others (un)subscribe."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.root = _Node()
+        self.topics = {}  # {pattern: {address: conn}}
+        self.size = 0     # Total subscriptions across all patterns
+        self.stats = {
+            'publishes': 0,
+            'nodes_visited': 0,         # trie nodes touched while routing
+            'subscribers_visited': 0,   # index entries touched while routing
+            'subscribers_skipped': 0,   # extra entries a full scan would have touched
+        }
+
+    def add(self, topic, address, conn):
+        with self.lock:
+            subscribers = self.topics.setdefault(topic, {})
+            if address not in subscribers:
+                self.size += 1
+            subscribers[address] = conn
+            node = self.root
+            for level in topic.split(SEPARATOR):
+                node = node.children.setdefault(level, _Node())
+            node.subscribers[address] = conn
+
+    def remove(self, topic, address):
+        with self.lock:
+            subscribers = self.topics.get(topic)
+            if subscribers is None or subscribers.pop(address, None) is None:
+                return False
+            self.size -= 1
+            if not subscribers:
+                del self.topics[topic]
+            self._prune(topic.split(SEPARATOR), address)
+            return True
+
+    def move(self, topic, address, new_address, conn):
+        # Re-key one subscription in a single step, so no publish sees it under both keys or neither
+        with self.lock:
+            subscribers = self.topics.get(topic)
+            if subscribers is None or subscribers.pop(address, None) is None:
+                return False
+            if new_address in subscribers:
+                self.size -= 1
+            subscribers[new_address] = conn
+            node = self.root
+            for level in topic.split(SEPARATOR):
+                node = node.children[level]
+            node.subscribers.pop(address, None)
+            node.subscribers[new_address] = conn
+            return True
+
+    def _prune(self, levels, address):
+        # Remove the subscriber and any branch left empty behind it
+        path = [self.root]
+        for level in levels:
+            path.append(path[-1].children[level])
+        path[-1].subscribers.pop(address, None)
+        for depth in range(len(levels), 0, -1):
+            node = path[depth]
+            if node.subscribers or node.children:
+                break
+            del path[depth - 1].children[levels[depth - 1]]
+
+    def subscribers(self, topic):
+        # Snapshot of (address, conn) pairs for one publish; each subscriber appears once
+        # however many of its patterns match
+        with self.lock:
+            recipients = {}
+            visited = self._match(self.root, topic.split(SEPARATOR), 0, recipients)
+            self.stats['publishes'] += 1
+            self.stats['nodes_visited'] += visited
+            self.stats['subscribers_visited'] += len(recipients)
+            self.stats['subscribers_skipped'] += self.size - len(recipients)
+        return list(recipients.items())
+
+    def _match(self, node, levels, depth, recipients):
+        visited = 1
+        if depth == len(levels):
+            recipients.update(node.subscribers)
+        else:
+            child = node.children.get(levels[depth])
+            if child is not None:
+                visited += self._match(child, levels, depth + 1, recipients)
+            child = node.children.get(ONE_LEVEL)
+            if child is not None:
+                visited += self._match(child, levels, depth + 1, recipients)
+        hash_node = node.children.get(ANY_LEVELS)
+        if hash_node is not None:
+            # '#' swallows zero or more of the remaining levels
+            for rest in range(depth, len(levels) + 1):
+                visited += self._match(hash_node, levels, rest, recipients)
+        return visited
+
+    def all_subscribers(self):
+        with self.lock:
+            unique = {}
+            for subscribers in self.topics.values():
+                unique.update(subscribers)
+            return list(unique.items())
+
+    def snapshot(self):
+        # Counters plus the per-pattern audience sizes, safe to serialise
+        with self.lock:
+            stats = dict(self.stats)
+            stats['topics'] = {topic: len(subscribers) for topic, subscribers in self.topics.items()}
+            stats['subscribers'] = self.size
+        return stats
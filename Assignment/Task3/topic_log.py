@@ -0,0 +1,214 @@
+import os
+import time
+import struct
+import threading
+from collections import namedtuple
+from urllib.parse import quote, unquote
+from protocol import HEADER
+
+INDEX_ENTRY = struct.Struct('!Q')  # File position of each record, one entry per offset
+SEGMENT_BYTES = 64 * 1024 * 1024
+FSYNC_INTERVAL = 0.05              # Seconds between batched fsyncs
+PARTITION_PREFIX = 'topic-'        # Directory names are this plus the quoted topic, so never '.', '..' or ''
+
+# A byte range of a segment file, sent to a subscriber with sendfile instead of read + send. The
+# file is opened when the region is made, so retention can unlink the segment but not its bytes.
+FileRegion = namedtuple('FileRegion', 'file position count')
+
+
+class _Segment:
+    def __init__(self, directory, base):
+        self.base = base
+        self.path = os.path.join(directory, f"{base:020d}.log")
+        self.index_path = os.path.join(directory, f"{base:020d}.index")
+        self.log_fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.count = os.fstat(self.index_fd).st_size // INDEX_ENTRY.size
+        self.size = self._recover()
+        self.dirty = False
+
+    def _recover(self):
+        # Anything past the last complete, indexed record is a torn write from a crash
+        os.ftruncate(self.index_fd, self.count * INDEX_ENTRY.size)
+        if not self.count:
+            os.ftruncate(self.log_fd, 0)
+            return 0
+        position = self.position(self.base + self.count - 1)
+        payload_length, _, topic_length = HEADER.unpack(os.pread(self.log_fd, HEADER.size, position))
+        size = position + HEADER.size + topic_length + payload_length
+        if os.fstat(self.log_fd).st_size != size:
+            os.ftruncate(self.log_fd, size)
+        return size
+
+    def position(self, offset):
+        (position,) = INDEX_ENTRY.unpack(os.pread(self.index_fd, INDEX_ENTRY.size,
+                                                  (offset - self.base) * INDEX_ENTRY.size))
+        return position
+
+    def append(self, parts):
+        written = os.writev(self.log_fd, parts)
+        os.write(self.index_fd, INDEX_ENTRY.pack(self.size))
+        self.size += written
+        self.count += 1
+        self.dirty = True
+
+    def sync(self):
+        os.fsync(self.log_fd)
+        os.fsync(self.index_fd)
+
+    def close(self):
+        os.close(self.log_fd)
+        os.close(self.index_fd)
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
+        os.remove(self.index_path)
+
+
+class _Partition:
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.log'))
+        self.segments = [_Segment(directory, base) for base in bases] or [_Segment(directory, 0)]
+
+    @property
+    def start(self):
+        return self.segments[0].base
+
+    @property
+    def end(self):
+        active = self.segments[-1]
+        return active.base + active.count
+
+
+class TopicLog:
+    """Optional durable, append-only log with one directory per topic.
+
+    Each topic is split into segments: NNN.log holds the records, stored as
+    the exact MESSAGE frames subscribers receive, and NNN.index holds one
+    8-byte file position per offset. Appends are write(2)s to the OS, fsync
+    is batched on a background thread, and old segments are dropped by
+    total size or age. Replays are returned as FileRegions so the broker can
+    sendfile them straight from the page cache."""
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, fsync_interval=FSYNC_INTERVAL,
+                 retention_bytes=None, retention_seconds=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.partitions = {}
+        self.partitions_lock = threading.Lock()
+        self.closed = False
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not name.startswith(PARTITION_PREFIX) or not os.path.isdir(path):
+                continue  # Not a partition of this log
+            topic = unquote(name[len(PARTITION_PREFIX):])
+            self.partitions[topic] = _Partition(os.path.join(directory, name))
+        self.syncer = threading.Thread(target=self._sync_periodically, daemon=True)
+        self.syncer.start()
+
+    def _partition(self, topic):
+        partition = self.partitions.get(topic)
+        if partition is None:
+            if not topic:
+                raise ValueError("the log needs a non-empty topic")
+            with self.partitions_lock:
+                partition = self.partitions.get(topic)
+                if partition is None:
+                    path = os.path.join(self.directory, PARTITION_PREFIX + quote(topic, safe='.-_'))
+                    partition = self.partitions[topic] = _Partition(path)
+        return partition
+
+    def topic_lock(self, topic):
+        """Held across append + fan-out, and across replay + subscribe, so a
+        resuming subscriber sees every offset exactly once."""
+        return self._partition(topic).lock
+
+    def append(self, topic, parts):
+        """Append one encoded MESSAGE frame (given as buffers) and return its offset."""
+        partition = self._partition(topic)
+        with partition.lock:
+            active = partition.segments[-1]
+            if active.size >= self.segment_bytes:
+                active = _Segment(partition.directory, partition.end)
+                partition.segments.append(active)
+                self._apply_retention(partition)
+            offset = active.base + active.count
+            active.append(parts)
+            return offset
+
+    def offsets(self, topic):
+        """(first retained offset, next offset to be written)."""
+        partition = self._partition(topic)
+        with partition.lock:
+            return partition.start, partition.end
+
+    def regions(self, topic, from_offset, to_offset=None):
+        """FileRegions covering [from_offset, to_offset), clamped to what is
+        retained. Returns (first offset covered, end offset, regions); whoever
+        sends a region closes its file."""
+        partition = self._partition(topic)
+        with partition.lock:
+            to_offset = partition.end if to_offset is None else min(to_offset, partition.end)
+            from_offset = max(from_offset, partition.start)
+            regions = []
+            for segment in partition.segments:
+                first = max(from_offset, segment.base)
+                last = min(to_offset, segment.base + segment.count)
+                if first >= last:
+                    continue
+                start = segment.position(first)
+                stop = segment.position(last) if last < segment.base + segment.count else segment.size
+                # Opened under the partition lock, which retention also takes, so the file still exists
+                regions.append(FileRegion(open(segment.path, 'rb'), start, stop - start))
+            return from_offset, to_offset, regions
+
+    def _apply_retention(self, partition):
+        # Never drops the active segment
+        now = time.time()
+        while len(partition.segments) > 1:
+            oldest = partition.segments[0]
+            total = sum(segment.size for segment in partition.segments)
+            too_big = self.retention_bytes is not None and total > self.retention_bytes
+            too_old = (self.retention_seconds is not None
+                       and now - os.stat(oldest.path).st_mtime > self.retention_seconds)
+            if not (too_big or too_old):
+                break
+            partition.segments.pop(0)
+            oldest.delete()
+
+    def _sync_periodically(self):
+        while not self.closed:
+            time.sleep(self.fsync_interval)
+            self.sync()
+
+    def sync(self):
+        # Collect dirty segments under the lock, fsync outside it so publishers don't wait on the disk
+        dirty = []
+        for partition in list(self.partitions.values()):
+            with partition.lock:
+                self._apply_retention(partition)
+                for segment in partition.segments:
+                    if segment.dirty:
+                        segment.dirty = False
+                        dirty.append(segment)
+        for segment in dirty:
+            try:
+                segment.sync()
+            except OSError:
+                pass  # Segment deleted by retention in the meantime
+
+    def close(self):
+        self.closed = True
+        self.sync()
+        for partition in list(self.partitions.values()):
+            with partition.lock:
+                for segment in partition.segments:
+                    segment.close()
@@ -0,0 +1,136 @@
+import os
+import sys
+import signal
+import asyncio
+import tempfile
+import multiprocessing
+import broker
+import async_server
+from metrics import log, INFO
+from protocol import MESSAGE, QOS, QOS_OPTIONS, NORMAL, FrameDecoder, encode_prefix
+from outbound import POLICIES
+
+WORKERS = os.cpu_count() or 1
+CONNECT_RETRY = 0.05  # Seconds between attempts to reach a peer that hasn't bound its bus socket yet
+
+
+class WorkerBus:
+    """Links the worker processes of one broker over Unix sockets.
+
+    Every worker listens on <bus_dir>/worker-<n>.sock and holds one outgoing
+    stream to each peer. A publish received by a worker is fanned out to its
+    own subscribers and its encoded MESSAGE frame is written once to every
+    peer, which routes it through its own topic index, in the lane and with
+    the TTL the publisher asked for. Frames arriving over
+    the bus are never forwarded again, so each publish crosses the bus at
+    most once per peer."""
+
+    def __init__(self, bus_dir, worker_id, workers):
+        self.bus_dir = bus_dir
+        self.worker_id = worker_id
+        self.workers = workers
+        self.peers = {}  # {worker id: StreamWriter}
+        self.stats = {'forwarded': 0, 'received': 0}
+
+    def path(self, worker_id):
+        return os.path.join(self.bus_dir, f"worker-{worker_id}.sock")
+
+    async def start(self):
+        server = await asyncio.start_unix_server(self._handle_peer, self.path(self.worker_id))
+        for peer_id in range(self.workers):
+            if peer_id == self.worker_id:
+                continue
+            while True:
+                try:
+                    _, writer = await asyncio.open_unix_connection(self.path(peer_id))
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    await asyncio.sleep(CONNECT_RETRY)
+            self.peers[peer_id] = writer
+        log(INFO, f"[BUS] Worker {self.worker_id} linked to {len(self.peers)} peer(s)")
+        return server
+
+    def forward(self, parts):
+        for writer in self.peers.values():
+            for part in parts:
+                writer.write(part)
+        self.stats['forwarded'] += 1
+
+    async def drain(self):
+        # Publishers slow down to the pace of the slowest peer instead of growing its buffer
+        for writer in self.peers.values():
+            await writer.drain()
+
+    async def _handle_peer(self, reader, writer):
+        decoder = FrameDecoder()
+        qos = (NORMAL, 0)  # Lane and TTL of the next MESSAGE only
+        try:
+            while True:
+                data = await reader.read(async_server.READ_SIZE)
+                if not data:
+                    break
+                for opcode, topic, payload in decoder.feed(data):
+                    if opcode == MESSAGE:
+                        self.stats['received'] += 1
+                        broker.deliver_relayed((encode_prefix(MESSAGE, topic, len(payload)), payload), topic, *qos)
+                        qos = (NORMAL, 0)
+                    elif opcode == QOS:
+                        qos = QOS_OPTIONS.unpack(payload)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def worker_program(port, host, worker_id, workers, bus_dir):
+    bus = WorkerBus(bus_dir, worker_id, workers)
+    broker.BUS = bus
+    bus_server = await bus.start()
+    async with bus_server:
+        await async_server.server_program(port, host, reuse_port=True)
+
+
+def run_worker(port, host, worker_id, workers, bus_dir, queue_limit, policy):
+    broker.QUEUE_LIMIT = queue_limit
+    broker.OVERFLOW_POLICY = policy
+    try:
+        asyncio.run(worker_program(port, host, worker_id, workers, bus_dir))
+    except KeyboardInterrupt:
+        pass
+
+
+def server_program(port=5000, host=None, workers=WORKERS, queue_limit=broker.QUEUE_LIMIT,
+                   policy=broker.OVERFLOW_POLICY):
+    host = host or async_server.socket.gethostbyname(async_server.socket.gethostname())
+    with tempfile.TemporaryDirectory(prefix="pubsub-bus-") as bus_dir:
+        processes = [multiprocessing.Process(target=run_worker,
+                                             args=(port, host, worker_id, workers, bus_dir, queue_limit, policy))
+                     for worker_id in range(workers)]
+        for process in processes:
+            process.start()
+        print(f"[SERVER STARTING] {workers} worker process(es) sharing {host}:{port}")
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+
+
+if __name__ == "__main__":
+    port = (int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
+    host = sys.argv[2] if len(sys.argv) > 2 else None
+    queue_limit = int(sys.argv[3]) if len(sys.argv) > 3 else broker.QUEUE_LIMIT
+    policy = sys.argv[4] if len(sys.argv) > 4 else broker.OVERFLOW_POLICY
+    workers = int(sys.argv[5]) if len(sys.argv) > 5 else WORKERS
+    if policy not in POLICIES:
+        print(f"Usage: python workers.py <port> <host> <queue_limit> <{'|'.join(POLICIES)}> [workers]")
+        sys.exit(1)
+    # Workers exit with the parent: SIGTERM to the parent terminates them in the finally block
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    server_program(port, host, workers, queue_limit, policy)
+    print("[SERVER STOPPED]")
@@ -1,37 +1,188 @@
+import os
+import sys
+import asyncio
 import threading
+from collections import deque
+
+# The Demo shares the Task3 broker's content filters and state log instead of keeping copies;
+# importing this module puts that directory on the path for server.py as well
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Assignment', 'Task3'))
+from filters import FilterIndex
+
+MAILBOX_SIZE = 1000  # Messages kept per subscriber before the oldest unread one is overwritten
+STRIPES = 64         # Locks the topic table is split across; writers on different topics rarely share one
+
+
+class _Topic:
+    __slots__ = ('members', 'snapshot')
 
-class Publisher:
     def __init__(self):
-        self.subscribers = {}
+        self.members = {}     # {subscriber: None}, an insertion-ordered set
+        self.snapshot = None  # Tuple of members that publish iterates; rebuilt after changes
+
+
+class Publisher:
+    """In-process topic router that is safe to share between threads.
+
+    publish() takes no lock: it reads the topic's subscriber tuple, which
+    writers never modify but replace. subscribe() and unsubscribe() are
+    O(1) dict operations under one of STRIPES locks chosen by topic, and
+    only drop the cached tuple; the next publish on that topic rebuilds it
+    once. So publishers never wait for each other, and a burst of
+    subscriptions costs one rebuild rather than one copy each."""
+
+    def __init__(self, stripes=STRIPES):
+        self.subscribers = {}  # {topic: _Topic}
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.filters = FilterIndex()  # One content filter per subscriber, across all its topics
+
+    def _lock(self, topic):
+        return self.locks[hash(topic) % len(self.locks)]
+
+    def subscribe(self, subscriber, topic, content_filter=None):
+        # A filter (e.g. 'region == "eu" and priority >= 3') replaces the subscriber's previous one;
+        # '' removes it. Raises FilterError before subscribing if it doesn't parse.
+        if content_filter is not None:
+            self.filters.set(subscriber, content_filter)
+        with self._lock(topic):
+            entry = self.subscribers.get(topic)
+            if entry is None:
+                entry = self.subscribers[topic] = _Topic()
+            if subscriber not in entry.members:  # Prevent duplicate subscriptions
+                entry.members[subscriber] = None
+                entry.snapshot = None
+        subscriber._joined(topic)
 
-    def subscribe(self, subscriber, topic):
-        if topic not in self.subscribers:
-            self.subscribers[topic] = []
-        # Prevent duplicate subscriptions
-        if subscriber not in self.subscribers[topic]:
-            self.subscribers[topic].append(subscriber)
+    def unsubscribe(self, subscriber, topic):
+        """Returns False if subscriber wasn't on topic."""
+        with self._lock(topic):
+            entry = self.subscribers.get(topic)
+            if entry is None or entry.members.pop(subscriber, False) is False:
+                return False
+            entry.snapshot = None
+            if not entry.members:
+                del self.subscribers[topic]
+        subscriber._left(topic)
+        return True
 
-        # ✅ Add topic to subscriber's topic list
-        subscriber.topics.add(topic)
+    def _members(self, topic, entry):
+        with self._lock(topic):
+            if entry.snapshot is None:
+                entry.snapshot = tuple(entry.members)
+            return entry.snapshot
 
     def publish(self, message, topic):
-        if topic in self.subscribers:
-            for subscriber in self.subscribers[topic]:
-                subscriber.event.set()
-                subscriber.message = message
+        """Deliver message to every subscriber of topic; returns how many got it."""
+        entry = self.subscribers.get(topic)
+        if entry is None:
+            return 0
+        members = entry.snapshot
+        if members is None:
+            members = self._members(topic, entry)
+        if not len(self.filters):
+            for subscriber in members:
+                subscriber.deliver(message, topic)
+            return len(members)
+        passed = None  # Subscribers whose filter the message satisfies, evaluated once on demand
+        delivered = 0
+        for subscriber in members:
+            if subscriber in self.filters:
+                if passed is None:
+                    passed = self.filters.match(message if isinstance(message, dict) else None)
+                if subscriber not in passed:
+                    continue
+            subscriber.deliver(message, topic)
+            delivered += 1
+        return delivered
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
 
 class Subscriber:
-    def __init__(self, name):
+    def __init__(self, name, mailbox_size=MAILBOX_SIZE):
         self.name = name
-        self.event = threading.Event()
-        self.message = None
+        # Ring buffer of unread messages; a burst only loses data once it exceeds mailbox_size
+        self.mailbox = deque(maxlen=mailbox_size)
+        self.ready = threading.Condition()
+        self.dropped = 0  # Unread messages overwritten because the mailbox was full
         self.topics = set()
+        self.listeners = ()  # Callbacks (message, topic) for streaming connections, replaced on change
+        self.waiters = []    # (loop, future) of coroutines waiting in receive_async
+
+    def _joined(self, topic):
+        with self.ready:
+            self.topics.add(topic)
+
+    def _left(self, topic):
+        with self.ready:
+            self.topics.discard(topic)
+
+    def deliver(self, message, topic):
+        # Store first, then wake readers, so nobody wakes up to a stale or missing message
+        with self.ready:
+            if len(self.mailbox) == self.mailbox.maxlen:
+                self.dropped += 1
+            self.mailbox.append(message)
+            self.ready.notify()
+            waiters = self.waiters
+            if waiters:
+                self.waiters = []
+        if waiters:
+            for loop, future in waiters:
+                loop.call_soon_threadsafe(_wake, future)
+        # Push to any open streams; the tuple is never modified, only replaced
+        for listener in self.listeners:
+            listener(message, topic)
+
+    def add_listener(self, listener):
+        with self.ready:
+            self.listeners = self.listeners + (listener,)
+
+    def remove_listener(self, listener):
+        with self.ready:
+            self.listeners = tuple(other for other in self.listeners if other is not listener)
+
+    def receive(self, timeout=None):
+        messages = self.receive_many(1, timeout)
+        return messages[0] if messages else None
+
+    def receive_many(self, max_n, timeout=None):
+        """Wait up to timeout seconds (forever if None) for at least one message,
+        then drain up to max_n pending messages in arrival order."""
+        with self.ready:
+            self.ready.wait_for(lambda: self.mailbox, timeout)
+            count = min(max_n, len(self.mailbox))
+            return [self.mailbox.popleft() for _ in range(count)]
+
+    async def receive_async(self, max_n=1):
+        """Coroutine form of receive_many without a timeout (wrap it in
+        asyncio.wait_for for one): waits on the caller's event loop, never
+        blocking it, however many threads publish."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.ready:
+                if self.mailbox:
+                    count = min(max_n, len(self.mailbox))
+                    return [self.mailbox.popleft() for _ in range(count)]
+                future = loop.create_future()
+                self.waiters.append((loop, future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self.ready:
+                    if (loop, future) in self.waiters:
+                        self.waiters.remove((loop, future))
+                raise
+
+    def __aiter__(self):
+        # async for message in subscriber: ...
+        return self
 
-    def receive(self):
-        self.event.wait()
-        msg = self.message
-        self.event.clear()
-        return msg
+    async def __anext__(self):
+        return (await self.receive_async())[0]
 
 
 # publisher = Publisher()
@@ -0,0 +1,81 @@
+import time
+import asyncio
+import argparse
+import threading
+from pubsub import Publisher, Subscriber
+
+
+def publish_rate(threads, topics, subscribers, messages):
+    # Every thread publishes to its own share of the topics while the others do the same
+    publisher = Publisher()
+    for number in range(subscribers):
+        publisher.subscribe(Subscriber(f"s{number}", mailbox_size=1), f"topic.{number % topics}")
+    barrier = threading.Barrier(threads + 1)
+
+    def run(offset):
+        names = [f"topic.{(offset + step) % topics}" for step in range(topics)]
+        barrier.wait()
+        for number in range(messages):
+            publisher.publish(number, names[number % topics])
+
+    workers = [threading.Thread(target=run, args=(offset,)) for offset in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    total = threads * messages
+    print(f"[PUBLISH] {threads} threads, {topics} topics, {subscribers} subscribers: "
+          f"{total / elapsed:,.0f} publishes/s, {total * subscribers / topics / elapsed:,.0f} deliveries/s")
+
+
+def churn_rate(subscribers):
+    publisher = Publisher()
+    people = [Subscriber(f"s{number}") for number in range(subscribers)]
+    started = time.perf_counter()
+    for subscriber in people:
+        publisher.subscribe(subscriber, "busy")
+    for subscriber in people:
+        publisher.unsubscribe(subscriber, "busy")
+    elapsed = time.perf_counter() - started
+    print(f"[CHURN] {subscribers} subscribe + unsubscribe on one topic: {elapsed / subscribers * 1e6:.2f} us each")
+
+
+def async_rate(messages):
+    # One publishing thread, one coroutine consuming with async for
+    publisher = Publisher()
+    subscriber = Subscriber("async", mailbox_size=messages)
+    publisher.subscribe(subscriber, "feed")
+
+    async def consume():
+        received = 0
+        async for _ in subscriber:
+            received += 1
+            if received == messages:
+                return
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        feeder = loop.run_in_executor(None, lambda: [publisher.publish(n, "feed") for n in range(messages)])
+        await asyncio.gather(consume(), feeder)
+        return time.perf_counter() - started
+
+    elapsed = asyncio.run(main())
+    print(f"[ASYNC] {messages} messages from a thread into async for: {messages / elapsed:,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput of the Demo's in-process Publisher")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--topics", type=int, default=64)
+    parser.add_argument("--subscribers", type=int, default=64, help="spread evenly over the topics")
+    parser.add_argument("--messages", type=int, default=200000, help="publishes per thread")
+    args = parser.parse_args()
+
+    for threads in args.threads:
+        publish_rate(threads, args.topics, args.subscribers, args.messages)
+    churn_rate(100000)
+    async_rate(args.messages)
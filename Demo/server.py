@@ -1,15 +1,131 @@
+import os
+import re
+import time
+import threading
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from pubsub import Publisher, Subscriber
+# From Assignment/Task3, which importing pubsub puts on the path
+from filters import FilterError
+from sessions import StateLog, SNAPSHOT_INTERVAL, SUBSCRIBE, UNSUBSCRIBE, FILTER
 from flask import send_from_directory
 from flask_cors import CORS
+from stream import StreamServer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# A run of 19 digits may be an integer wider than 64 bits, which orjson would quietly parse as a
+# float; such documents (or ones with merely long decimals or digit strings) go to the json module
+WIDE_INTEGER = re.compile(r'\d{19}')
+WIDE_INTEGER_BYTES = re.compile(rb'\d{19}')
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    # request.json and jsonify through orjson, several times faster than the json module both ways.
+    # orjson refuses to write integers wider than 64 bits and numbers like 1e400 that the json
+    # module accepts, so those documents fall back to it and behave as they did before.
+    def dumps(self, obj, **kwargs):
+        try:
+            return orjson.dumps(obj, default=self.default).decode('utf-8')
+        except orjson.JSONEncodeError:
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if (WIDE_INTEGER_BYTES if isinstance(s, (bytes, bytearray)) else WIDE_INTEGER).search(s):
+            return super().loads(s, **kwargs)
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return super().loads(s, **kwargs)  # Still a 400 if it isn't JSON at all
+
+    def response(self, *args, **kwargs):
+        # Straight to bytes, skipping the str round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        try:
+            return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
+        except orjson.JSONEncodeError:
+            return super().response(*args, **kwargs)
+
 
 app = Flask(__name__)
+if orjson is not None:
+    app.json = FastJSONProvider(app)
 CORS(app)  # Enable CORS for all routes
 
 CORS(app , origins="http://localhost:5000")  # Adjust the origin as needed
 
+RECEIVE_BATCH = 100       # Pending messages returned by one /receive call unless it asks for ?max=N
+MAX_RECEIVE_BATCH = 10000
+MAX_PUBLISH_BATCH = 10000  # Messages accepted by one /publish/batch call
+
 publisher = Publisher()
 subscribers_map = {}  # {name: Subscriber instance}
+stream_server = StreamServer(subscribers_map)  # Push endpoint: GET http://localhost:5001/stream/<name>
+# With DEMO_STATE_DIR set, subscribers and their topics and filters survive a restart: every change
+# goes to a changelog there, compacted into a snapshot every SNAPSHOT_INTERVAL (mailboxes are not kept)
+state_log = StateLog(os.environ['DEMO_STATE_DIR'], 'demo') if os.environ.get('DEMO_STATE_DIR') else None
+state_lock = threading.Lock()
+
+
+def record(kind, *fields):
+    if state_log is not None:
+        with state_lock:
+            state_log.append(kind, fields)
+
+
+def subscriber_named(name):
+    # setdefault: two first requests for the same name racing on Flask threads end up with one mailbox
+    if name not in subscribers_map:
+        subscribers_map.setdefault(name, Subscriber(name))
+    return subscribers_map[name]
+
+
+def restore_state():
+    started = time.perf_counter()
+    state, records = state_log.load()
+    for name, topics, expression in state or ():
+        subscriber = subscriber_named(name)
+        if expression:
+            publisher.filters.set(subscriber, expression)
+        for topic in topics:
+            publisher.subscribe(subscriber, topic)
+    for kind, fields in records:
+        subscriber = subscriber_named(fields[0])
+        if kind == SUBSCRIBE:
+            publisher.subscribe(subscriber, fields[1])
+        elif kind == UNSUBSCRIBE:
+            publisher.unsubscribe(subscriber, fields[1])
+        elif kind == FILTER:
+            publisher.filters.set(subscriber, fields[1])
+    print(f"[STATE] Restored {len(subscribers_map)} subscriber(s) in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+
+def compact_periodically():
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        with state_lock:
+            # Copied under the locks their writers hold, so a request changing them can't break the iteration
+            with publisher.filters.lock:
+                expressions = {subscriber: entry[0] for subscriber, entry in publisher.filters.filters.items()}
+            state = []
+            for name, subscriber in list(subscribers_map.items()):
+                with subscriber.ready:
+                    topics = tuple(subscriber.topics)
+                state.append((name, topics, expressions.get(subscriber, '')))
+            state_log.rotate()
+        # The fsync happens with the lock released, so /subscribe calls don't wait for the disk
+        state_log.write_snapshot(state)
+
+
+# Restored here rather than under __main__, so an app imported by a WSGI server has its state too
+if state_log is not None:
+    restore_state()
+    threading.Thread(target=compact_periodically, daemon=True).start()
+
 
 @app.route('/')
 def home():
@@ -21,13 +137,29 @@ def subscribe():
     name = data['name']
     topic = data['topic']
 
-    if name not in subscribers_map:
-        subscribers_map[name] = Subscriber(name)
-
-    publisher.subscribe(subscribers_map[name], topic)
+    try:
+        # Optional "filter": only JSON-object messages whose fields satisfy it are delivered
+        publisher.subscribe(subscriber_named(name), topic, data.get('filter'))
+    except FilterError as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+    if data.get('filter') is not None:
+        record(FILTER, name, data['filter'])
+    record(SUBSCRIBE, name, topic)
     return jsonify({"message": f"{name} subscribed to {topic}"}), 200
 
 
+@app.route('/unsubscribe', methods=['POST'])
+def unsubscribe():
+    data = request.json
+    name = data['name']
+    topic = data['topic']
+
+    if name in subscribers_map and publisher.unsubscribe(subscribers_map[name], topic):
+        record(UNSUBSCRIBE, name, topic)
+        return jsonify({"message": f"{name} unsubscribed from {topic}"}), 200
+    return jsonify({"error": f"{name} is not subscribed to {topic}"}), 404
+
+
 @app.route('/publish', methods=['POST'])
 def publish():
     data = request.json
@@ -38,11 +170,41 @@ def publish():
     return jsonify({"message": f"Published '{message}' to {topic}"}), 200
 
 
+@app.route('/publish/batch', methods=['POST'])
+def publish_batch():
+    # {"messages": [[topic, message], ...]}, or {"topic": t, "messages": [message, ...]} for one topic
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({"error": "The body must be a JSON object"}), 400
+    messages = data.get('messages')
+    if not isinstance(messages, list) or len(messages) > MAX_PUBLISH_BATCH:
+        return jsonify({"error": f"'messages' must be a list of at most {MAX_PUBLISH_BATCH}"}), 400
+    topic = data.get('topic')
+    if topic is not None and not isinstance(topic, str):
+        return jsonify({"error": "'topic' must be a string"}), 400
+    if topic is None and not all(isinstance(pair, list) and len(pair) == 2 and isinstance(pair[0], str)
+                                 for pair in messages):
+        return jsonify({"error": "'messages' must hold [topic, message] pairs when no 'topic' is given"}), 400
+
+    delivered = 0
+    if topic is not None:
+        for message in messages:
+            delivered += publisher.publish(message, topic)
+    else:
+        for topic, message in messages:
+            delivered += publisher.publish(message, topic)
+    return jsonify({"published": len(messages), "delivered": delivered}), 200
+
+
 @app.route('/receive/<name>', methods=['GET'])
 def receive(name):
     if name in subscribers_map:
-        msg = subscribers_map[name].receive()
-        return jsonify({"message": msg}), 200
+        # Up to ?max=N pending messages in one response, waiting at most ?timeout=S seconds for the
+        # first (forever if not given); "message" keeps the old single-message field
+        limit = min(request.args.get('max', RECEIVE_BATCH, type=int), MAX_RECEIVE_BATCH)
+        timeout = request.args.get('timeout', type=float)
+        messages = subscribers_map[name].receive_many(max(1, limit), timeout)
+        return jsonify({"message": messages[0] if messages else None, "messages": messages}), 200
     return jsonify({"error": "Subscriber not found"}), 404
 
 @app.route('/topics', methods=['GET'])
@@ -51,4 +213,6 @@ def get_topics():
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # The reloader would start a second process with its own streams, so it stays off
+    stream_server.start()
+    app.run(debug=True, use_reloader=False, threaded=True)
@@ -0,0 +1,100 @@
+import json
+import asyncio
+import threading
+from urllib.parse import unquote
+
+STREAM_PORT = 5001
+HEARTBEAT_INTERVAL = 15  # Seconds between SSE comments that keep idle connections open
+STREAM_QUEUE_SIZE = 1000  # Messages waiting for a slow stream before the oldest is dropped, like a full mailbox
+STREAM_HEADERS = (
+    "HTTP/1.1 200 OK\r\n"
+    "Content-Type: text/event-stream\r\n"
+    "Cache-Control: no-cache\r\n"
+    "Connection: keep-alive\r\n"
+    "Access-Control-Allow-Origin: *\r\n"
+    "\r\n"
+)
+
+
+class StreamServer:
+    """Server-Sent Events endpoint (GET /stream/<name>) running on its own
+    asyncio event loop in a background thread of the Flask process.
+
+    Each open stream is a listener on the named Subscriber: publish() hands
+    the message to the loop with call_soon_threadsafe and the connection's
+    coroutine writes it out, so a browser subscriber costs one socket and
+    one small queue instead of a blocked Flask worker per message. The
+    queue holds at most STREAM_QUEUE_SIZE messages; a stream that can't
+    keep up loses the oldest ones, counted in `dropped`."""
+
+    def __init__(self, subscribers_map, host='localhost', port=STREAM_PORT):
+        self.subscribers_map = subscribers_map
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.streams = 0
+        self.dropped = 0
+
+    def start(self):
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(
+            asyncio.start_server(self._handle, self.host, self.port, backlog=4096))
+        print(f"[STREAM] Server-Sent Events on http://{self.host}:{self.port}/stream/<name>")
+        self.loop.run_forever()
+
+    async def _handle(self, reader, writer):
+        listener = None
+        subscriber = None
+        try:
+            request_line = (await reader.readline()).decode('latin-1')
+            # Skip the remaining request headers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            method, _, rest = request_line.partition(' ')
+            path = rest.split(' ')[0]
+            name = unquote(path[len('/stream/'):]) if path.startswith('/stream/') else None
+            subscriber = self.subscribers_map.get(name) if method == 'GET' and name else None
+            if subscriber is None:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nAccess-Control-Allow-Origin: *\r\n"
+                             b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+                return
+
+            queue = asyncio.Queue(STREAM_QUEUE_SIZE)
+
+            def offer(item):
+                if queue.full():
+                    queue.get_nowait()
+                    self.dropped += 1
+                queue.put_nowait(item)
+
+            def listener(message, topic):
+                # Called from whichever thread published; hop onto the loop
+                self.loop.call_soon_threadsafe(offer, (message, topic))
+
+            subscriber.add_listener(listener)
+            self.streams += 1
+            writer.write(STREAM_HEADERS.encode('latin-1'))
+            await writer.drain()
+
+            while True:
+                try:
+                    message, topic = await asyncio.wait_for(queue.get(), HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    writer.write(b": heartbeat\n\n")
+                else:
+                    event = json.dumps({"topic": topic, "message": message})
+                    writer.write(f"data: {event}\n\n".encode('utf-8'))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if listener is not None:
+                subscriber.remove_listener(listener)
+                self.streams -= 1
+            writer.close()
@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import pytest
+from pubsub import Publisher, Subscriber
+from filters import FilterError
+
+
+def test_mailbox_keeps_every_unread_message_in_order():
+    publisher = Publisher()
+    subscriber = Subscriber('reader')
+    publisher.subscribe(subscriber, 'news')
+    for number in range(5):
+        publisher.publish(number, 'news')
+    assert subscriber.receive_many(10, timeout=0) == [0, 1, 2, 3, 4]
+    assert subscriber.receive(timeout=0) is None
+
+
+def test_full_mailbox_drops_the_oldest_and_counts_it():
+    subscriber = Subscriber('slow', mailbox_size=3)
+    for number in range(5):
+        subscriber.deliver(number, 'news')
+    assert subscriber.dropped == 2
+    assert subscriber.receive_many(10, timeout=0) == [2, 3, 4]
+
+
+def test_receive_waits_for_a_message():
+    subscriber = Subscriber('waiting')
+    timer = threading.Timer(0.05, subscriber.deliver, ('late', 'news'))
+    timer.start()
+    assert subscriber.receive(timeout=5) == 'late'
+    timer.join()
+
+
+def test_receive_many_is_bounded():
+    subscriber = Subscriber('batch')
+    for number in range(10):
+        subscriber.deliver(number, 'news')
+    assert subscriber.receive_many(4, timeout=0) == [0, 1, 2, 3]
+    assert len(subscriber.mailbox) == 6
+
+
+def test_subscribe_twice_delivers_once_and_unsubscribe_reports():
+    publisher = Publisher()
+    subscriber = Subscriber('twice')
+    publisher.subscribe(subscriber, 'news')
+    publisher.subscribe(subscriber, 'news')
+    assert publisher.publish('once', 'news') == 1
+    assert subscriber.topics == {'news'}
+    assert publisher.unsubscribe(subscriber, 'news')
+    assert not publisher.unsubscribe(subscriber, 'news')
+    assert 'news' not in publisher.subscribers
+    assert publisher.publish('nobody', 'news') == 0
+
+
+def test_concurrent_publishers_and_subscription_churn():
+    publisher = Publisher(stripes=4)
+    steady = [Subscriber(f'steady-{number}', mailbox_size=100000) for number in range(4)]
+    for subscriber in steady:
+        publisher.subscribe(subscriber, 'load')
+    stop = threading.Event()
+
+    def churn():
+        extra = Subscriber('churn')
+        while not stop.is_set():
+            publisher.subscribe(extra, 'load')
+            publisher.unsubscribe(extra, 'load')
+
+    def publish(offset):
+        for number in range(2000):
+            publisher.publish(offset + number, 'load')
+
+    churner = threading.Thread(target=churn)
+    churner.start()
+    publishers = [threading.Thread(target=publish, args=(offset,)) for offset in (0, 10000, 20000)]
+    for thread in publishers:
+        thread.start()
+    for thread in publishers:
+        thread.join()
+    stop.set()
+    churner.join()
+    for subscriber in steady:
+        received = subscriber.receive_many(100000, timeout=0)
+        assert len(received) == 6000 and subscriber.dropped == 0
+        for offset in (0, 10000, 20000):
+            mine = [message for message in received if offset <= message < offset + 10000]
+            assert mine == list(range(offset, offset + 2000))  # Each publisher's order is kept
+
+
+def test_filtered_subscriber_only_gets_matching_documents():
+    publisher = Publisher()
+    picky, everything = Subscriber('picky'), Subscriber('everything')
+    publisher.subscribe(picky, 'orders', 'region == "eu"')
+    publisher.subscribe(everything, 'orders')
+    documents = [{'region': 'eu'}, {'region': 'us'}, 'plain text']
+    assert [publisher.publish(document, 'orders') for document in documents] == [2, 1, 1]
+    assert picky.receive_many(10, timeout=0) == [{'region': 'eu'}]
+    assert everything.receive_many(10, timeout=0) == documents
+
+
+def test_bad_filter_leaves_the_subscription_alone():
+    publisher = Publisher()
+    subscriber = Subscriber('typo')
+    with pytest.raises(FilterError):
+        publisher.subscribe(subscriber, 'orders', 'region ==')
+    assert 'orders' not in publisher.subscribers
+
+
+def test_receive_async_wakes_on_a_publish_from_another_thread():
+    subscriber = Subscriber('async')
+
+    async def wait():
+        threading.Timer(0.05, subscriber.deliver, ('from a thread', 'news')).start()
+        return await asyncio.wait_for(subscriber.receive_async(5), timeout=5)
+
+    assert asyncio.run(wait()) == ['from a thread']
+
+
+def test_cancelled_receive_async_leaves_no_waiter():
+    subscriber = Subscriber('impatient')
+
+    async def give_up():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(subscriber.receive_async(), timeout=0.05)
+
+    asyncio.run(give_up())
+    assert subscriber.waiters == []
+    subscriber.deliver('later', 'news')
+    assert subscriber.receive(timeout=0) == 'later'
+
+
+def test_async_iteration():
+    subscriber = Subscriber('iterating')
+    for number in range(3):
+        subscriber.deliver(number, 'news')
+
+    async def first_three():
+        received = []
+        async for message in subscriber:
+            received.append(message)
+            if len(received) == 3:
+                return received
+
+    assert asyncio.run(first_three()) == [0, 1, 2]
@@ -0,0 +1,60 @@
+import json
+import pytest
+import server
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+def test_wide_integers_round_trip(client):
+    client.post('/subscribe', json={'name': 'wide', 'topic': 'numbers'})
+    # 2**70 + 1 has no exact float, so a parser that widens to float can't get it back
+    body = json.dumps({'topic': 'numbers', 'message': {'n': 2 ** 70, 'odd': 2 ** 70 + 1, 'small': 7}})
+    assert client.post('/publish', data=body, content_type='application/json').status_code == 200
+    message = json.loads(client.get('/receive/wide?timeout=1').data)['message']
+    assert message == {'n': 2 ** 70, 'odd': 2 ** 70 + 1, 'small': 7}
+    assert type(message['n']) is int
+
+
+@pytest.mark.parametrize('expression', [5, ['a == 1'], {'a': 1}, True])
+def test_non_string_filter_is_rejected(client, expression):
+    response = client.post('/subscribe', json={'name': 'picky', 'topic': 'orders', 'filter': expression})
+    assert response.status_code == 400
+    assert 'Invalid filter' in response.get_json()['error']
+
+
+def test_batch_publish_with_pairs_and_with_one_topic(client):
+    client.post('/subscribe', json={'name': 'bulk-a', 'topic': 'bulk.a'})
+    client.post('/subscribe', json={'name': 'bulk-b', 'topic': 'bulk.b'})
+    response = client.post('/publish/batch', json={'messages': [['bulk.a', 1], ['bulk.b', {'x': 2}], ['none', 3]]})
+    assert response.get_json() == {'published': 3, 'delivered': 2}
+    response = client.post('/publish/batch', json={'topic': 'bulk.a', 'messages': [4, 5]})
+    assert response.get_json() == {'published': 2, 'delivered': 2}
+    assert client.get('/receive/bulk-a?timeout=0').get_json()['messages'] == [1, 4, 5]
+    assert client.get('/receive/bulk-b?timeout=0').get_json()['messages'] == [{'x': 2}]
+
+
+@pytest.mark.parametrize('body', [
+    [], {'messages': 'not a list'}, {'topic': 7, 'messages': [1]}, {'messages': [['only-topic']]},
+    {'messages': [[1, 'topic not a string']]}, {'messages': [None] * (server.MAX_PUBLISH_BATCH + 1), 'topic': 't'},
+])
+def test_malformed_batch_is_rejected(client, body):
+    response = client.post('/publish/batch', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_receive_drains_up_to_max(client):
+    client.post('/subscribe', json={'name': 'drain', 'topic': 'drained'})
+    client.post('/publish/batch', json={'topic': 'drained', 'messages': list(range(5))})
+    first = client.get('/receive/drain?max=3&timeout=0').get_json()
+    assert first == {'message': 0, 'messages': [0, 1, 2]}
+    assert client.get('/receive/drain?max=0&timeout=0').get_json()['messages'] == [3]  # At least one
+    assert client.get('/receive/drain?timeout=0').get_json()['messages'] == [4]
+    assert client.get('/receive/drain?timeout=0').get_json() == {'message': None, 'messages': []}
+
+
+def test_receive_for_an_unknown_subscriber(client):
+    assert client.get('/receive/nobody?timeout=0').status_code == 404
@@ -0,0 +1,54 @@
+import json
+import time
+import socket
+import pytest
+from pubsub import Publisher, Subscriber
+from stream import StreamServer
+
+
+@pytest.fixture
+def streams():
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        port = probe.getsockname()[1]
+    subscribers = {'alice': Subscriber('alice')}
+    server = StreamServer(subscribers, port=port)
+    server.start()
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            socket.create_connection(('localhost', port)).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.02)
+    return server
+
+
+def open_stream(server, name):
+    sock = socket.create_connection(('localhost', server.port), timeout=5)
+    sock.sendall(f"GET /stream/{name} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    return sock, sock.makefile('rb')
+
+
+def test_published_messages_are_pushed_as_events(streams):
+    publisher = Publisher()
+    subscriber = streams.subscribers_map['alice']
+    publisher.subscribe(subscriber, 'news')
+    sock, stream = open_stream(streams, 'alice')
+    assert stream.readline() == b'HTTP/1.1 200 OK\r\n'
+    while stream.readline() != b'\r\n':
+        pass  # The stream's listener is in place once the headers are out
+    publisher.publish({'n': 1}, 'news')
+    publisher.publish('second', 'news')
+    events = [stream.readline(), stream.readline(), stream.readline(), stream.readline()]
+    assert json.loads(events[0][len(b'data: '):]) == {'topic': 'news', 'message': {'n': 1}}
+    assert json.loads(events[2][len(b'data: '):]) == {'topic': 'news', 'message': 'second'}
+    sock.close()
+
+
+def test_unknown_subscriber_gets_404(streams):
+    sock, stream = open_stream(streams, 'nobody')
+    assert stream.readline().startswith(b'HTTP/1.1 404')
+    sock.close()